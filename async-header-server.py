@@ -0,0 +1,63 @@
+import asyncio
+from argparse import ArgumentParser, Namespace
+
+from async_handler_lib import ServerProtocol, install_uvloop, serve
+from cache_lib import ResponseCache
+from log_lib import log, setup_logging
+from search_lib import load_backend
+from server_lib import ResponseBuilder
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser()
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--keep-alive', action='store_true',
+                        help="serve many requests on each connection")
+    parser.add_argument('--no-uvloop', action='store_true',
+                        help="use the pure-Python asyncio event loop")
+    parser.add_argument('--log-level', default='INFO')
+    parser.add_argument('--files', metavar='DIR',
+                        help="serve files under DIR to the 'fetch' action")
+    parser.add_argument('--index', metavar='PATH',
+                        help="answer searches from PATH: a JSON object, "
+                             "loaded into memory, or a file written by "
+                             "build-index.py, memory-mapped")
+    parser.add_argument('--fuzzy', action='store_true',
+                        help="build a trigram index of a JSON --index for "
+                             "fuzzy searches")
+    parser.add_argument('--cache-bytes', type=int, default=2**24,
+                        help="keep this many bytes of encoded search "
+                             "responses (0: no cache)")
+    parser.add_argument('--cache-ttl', type=float, default=0,
+                        help="answer from the cache for at most this many "
+                             "seconds (0: forever)")
+    parser.add_argument('--chunk-size', type=int,
+                        help="stream binary request bodies in pieces of "
+                             "this many bytes instead of buffering them")
+    return parser.parse_args()
+
+
+def main(host: str, port: int, keep_alive: bool = False,
+         use_uvloop: bool = True) -> None:
+    if use_uvloop and install_uvloop():
+        log.info("Using uvloop")
+    try:
+        asyncio.run(serve(host, port, keep_alive))
+    except KeyboardInterrupt:
+        log.info("Keyboard interrupt received, exiting.")
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    setup_logging(args.log_level)
+    ResponseBuilder.files_root = args.files
+    if args.cache_bytes:
+        ResponseBuilder.response_cache = ResponseCache(
+            args.cache_bytes, args.cache_ttl)
+    if args.index:
+        ResponseBuilder.search_backend = load_backend(args.index, args.fuzzy)
+        log.info("Loaded %s search keys from %s",
+                 len(ResponseBuilder.search_backend), args.index)
+    ServerProtocol.chunk_size = args.chunk_size
+    main(args.host, args.port, args.keep_alive, not args.no_uvloop)
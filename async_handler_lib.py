@@ -0,0 +1,160 @@
+import asyncio
+from collections import deque
+
+from handler_lib import FrameParser, encode_header, encode_request
+from log_lib import log
+from server_lib import ResponseBuilder
+
+
+def install_uvloop() -> bool:
+    """Use uvloop for new event loops if it is installed."""
+    try:
+        import uvloop
+    except ImportError:
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
+
+class FrameProtocol(FrameParser, asyncio.Protocol):
+    """FrameParser driven by an asyncio transport."""
+
+    __slots__ = ("transport",)
+
+    def __init__(self, keep_alive: bool = False,
+                 header_format: str = "json") -> None:
+        FrameParser.__init__(
+            self, keep_alive=keep_alive, header_format=header_format)
+        self.transport: asyncio.Transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        peer = transport.get_extra_info("peername")
+        self.label = f"{peer[0]}:{peer[1]}" if peer else "peer"
+
+    def data_received(self, data):
+        try:
+            self.feed(data)
+        except (ValueError, TypeError) as error:
+            log.error("Error on %s: %s", self, error)
+            self.transport.abort()
+
+    def create_message(self, content_bytes, content_type, content_encoding,
+                       request_id=None):
+        self.transport.writelines((encode_header(
+            len(content_bytes), content_type, content_encoding,
+            self.header_format, request_id), content_bytes))
+
+    def send_frame(self, frame: bytes):
+        self.transport.write(frame)
+
+    def create_file_message(self, content_file, content_type,
+                            content_encoding, request_id=None):
+        # loop.sendfile() refuses other writes until it finishes, which
+        # pipelined responses can't wait for, so the file is read instead
+        with content_file:
+            self.create_message(
+                content_file.read(), content_type, content_encoding,
+                request_id)
+
+
+class ServerProtocol(ResponseBuilder, FrameProtocol):
+    __slots__ = ResponseBuilder.SLOTS
+
+    def message_received(self):
+        self.create_response()
+        if not self.keep_alive:
+            # close() still flushes the response before closing
+            self.transport.close()
+
+
+class ClientProtocol(FrameProtocol):
+    __slots__ = ("_waiters", "closed")
+
+    def __init__(self, header_format: str = "json") -> None:
+        FrameProtocol.__init__(
+            self, keep_alive=True, header_format=header_format)
+        # Replies arrive in request order, so futures are queued FIFO
+        self._waiters: deque[asyncio.Future] = deque()
+        self.closed = asyncio.get_running_loop().create_future()
+
+    def request(self, request: dict) -> asyncio.Future:
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self.create_message(**encode_request(request))
+        return waiter
+
+    def message_received(self):
+        content = self.content
+        if self.json_header["content-type"] != "text/json":
+            content = bytes(content)
+        waiter = self._waiters.popleft()
+        if not waiter.done():
+            waiter.set_result(content)
+
+    def connection_lost(self, error):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_exception(
+                    ConnectionAbortedError("Connection closed."))
+        self.closed.set_result(None)
+
+
+class AsyncClient:
+    """Asynchronous client for the header protocol.
+
+    With keep_alive, requests are pipelined over one connection, which is
+    reopened if the server closes it. Without it every request gets its
+    own connection, as header-server.py expects by default.
+    """
+
+    def __init__(self, host: str, port: int, keep_alive: bool = False,
+                 header_format: str = "json"):
+        self.host = host
+        self.port = port
+        self.keep_alive = keep_alive
+        self.header_format = header_format
+        self._protocol: ClientProtocol = None
+        self._connecting = asyncio.Lock()
+
+    async def _connect(self) -> ClientProtocol:
+        loop = asyncio.get_running_loop()
+        _, protocol = await loop.create_connection(
+            lambda: ClientProtocol(self.header_format), self.host, self.port)
+        return protocol
+
+    async def request(self, request: dict):
+        """Send a request dict and return the decoded response content."""
+        if not self.keep_alive:
+            protocol = await self._connect()
+            try:
+                return await protocol.request(request)
+            finally:
+                protocol.transport.close()
+        async with self._connecting:
+            if (self._protocol is None
+                    or self._protocol.transport.is_closing()):
+                self._protocol = await self._connect()
+        return await self._protocol.request(request)
+
+    async def close(self):
+        if self._protocol is not None:
+            self._protocol.transport.close()
+            await self._protocol.closed
+            self._protocol = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+async def serve(host: str, port: int, keep_alive: bool = False) -> None:
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(
+        lambda: ServerProtocol(keep_alive), host, port)
+    log.info("Listening on %s:%s", host, port)
+    async with server:
+        await server.serve_forever()
@@ -0,0 +1,83 @@
+import asyncio
+import importlib.util
+import resource
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser, Namespace
+
+from async_handler_lib import AsyncClient
+from handler_lib import create_request
+
+
+SERVERS = {
+    "selectors": ["header-server.py"],
+    "asyncio": ["async-header-server.py", "--no-uvloop"],
+    "uvloop": ["async-header-server.py"],
+}
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(
+        description="Compare the selector and asyncio header servers.")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8020)
+    parser.add_argument('--servers', nargs='+', default=list(SERVERS),
+                        choices=list(SERVERS))
+    parser.add_argument('--connections', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=5.0)
+    return parser.parse_args()
+
+
+async def connection_loop(client: AsyncClient, deadline: float) -> int:
+    request = create_request("search", "morpheus")
+    completed = 0
+    while time.monotonic() < deadline:
+        await client.request(request)
+        completed += 1
+    await client.close()
+    return completed
+
+
+async def load(host: str, port: int, connections: int,
+               duration: float) -> float:
+    clients = [AsyncClient(host, port, keep_alive=True)
+               for _ in range(connections)]
+    deadline = time.monotonic() + duration
+    completed = await asyncio.gather(
+        *(connection_loop(client, deadline) for client in clients))
+    return sum(completed) / duration
+
+
+def measure(args: Namespace, server: str) -> float:
+    process = subprocess.Popen(
+        [sys.executable, *SERVERS[server], "--host", args.host,
+         "--port", str(args.port), "--keep-alive"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        time.sleep(1)
+        return asyncio.run(
+            load(args.host, args.port, args.connections, args.duration))
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main(args: Namespace) -> None:
+    # Both ends need a descriptor per connection
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = min(hard, args.connections + 100)
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+    print(f"{args.connections} keep-alive connections, "
+          f"{args.duration}s per server")
+    for server in args.servers:
+        if server == "uvloop" and not importlib.util.find_spec("uvloop"):
+            print(f"{server:>10}: not installed, skipped")
+            continue
+        rate = measure(args, server)
+        print(f"{server:>10}: {rate:10.0f} requests/s")
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,151 @@
+import subprocess
+import sys
+import threading
+import time
+from argparse import ArgumentParser, Namespace
+from socket import AF_INET, SOCK_STREAM, SOL_SOCKET, SO_RCVBUF
+from socket import socket as Socket
+from socket import timeout as SocketTimeout
+
+from handler_lib import encode_message, json_encode
+
+SERVERS = {
+    "multiconn": ["multiconn-server.py", "{host}", "{port}"],
+    "header": ["header-server.py", "--host", "{host}", "--port", "{port}",
+               "--keep-alive", "--log-level", "WARNING"],
+}
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(
+        description="Server memory with clients that send faster than "
+                    "they read the replies.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8040)
+    parser.add_argument('--servers', nargs='+', choices=list(SERVERS),
+                        default=list(SERVERS))
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--read-rate', type=int, default=64,
+                        help="KiB per second each client reads")
+    parser.add_argument('--duration', type=float, default=20.0)
+    parser.add_argument('--receive-buffer', type=int, default=65536,
+                        help="client SO_RCVBUF, so the backlog piles up in "
+                             "the server rather than in the kernel")
+    return parser.parse_args()
+
+
+def rss_mib(pid: int) -> float:
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def payload(server: str) -> bytes:
+    """About 64 KiB of what each client keeps sending."""
+    if server == "multiconn":
+        return bytes(range(256)) * 256
+    # Pipelined search requests, each answered with a small response
+    request = encode_message(
+        json_encode({"action": "search", "value": "morpheus"}, "utf-8"),
+        "text/json", "utf-8")
+    return request * (65536 // len(request))
+
+
+def client(args: Namespace, block: bytes, stop: threading.Event,
+           totals: list) -> None:
+    connection = Socket(AF_INET, SOCK_STREAM)
+    # Set before connecting, so the window is never scaled past it
+    connection.setsockopt(SOL_SOCKET, SO_RCVBUF, args.receive_buffer)
+    connection.connect((args.host, args.port))
+    connection.settimeout(0.1)
+    sent = received = 0
+
+    def read_slowly():
+        nonlocal received
+        piece = args.read_rate * 1024 // 10
+        while not stop.is_set():
+            try:
+                data = connection.recv(piece)
+            except SocketTimeout:
+                continue
+            except OSError:
+                break
+            if not data:
+                break
+            received += len(data)
+            time.sleep(0.1)
+
+    reader = threading.Thread(target=read_slowly)
+    reader.start()
+    view = memoryview(block)
+    offset = 0
+    try:
+        while not stop.is_set():
+            try:
+                count = connection.send(view[offset:])
+            except SocketTimeout:
+                continue
+            except OSError:
+                break
+            sent += count
+            offset = (offset + count) % len(block)
+    finally:
+        reader.join()
+        connection.close()
+        totals.append((sent, received))
+
+
+def measure(args: Namespace, server: str) -> dict:
+    command = [part.format(host=args.host, port=args.port)
+               for part in SERVERS[server]]
+    process = subprocess.Popen(
+        [sys.executable, *command],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    stop = threading.Event()
+    totals = []
+    threads = []
+    try:
+        time.sleep(1)
+        baseline = rss_mib(process.pid)
+        block = payload(server)
+        for _ in range(args.clients):
+            thread = threading.Thread(
+                target=client, args=(args, block, stop, totals))
+            thread.start()
+            threads.append(thread)
+        samples = []
+        deadline = time.monotonic() + args.duration
+        while time.monotonic() < deadline:
+            time.sleep(args.duration / 10)
+            samples.append(rss_mib(process.pid))
+        stop.set()
+        for thread in threads:
+            thread.join()
+    finally:
+        stop.set()
+        process.terminate()
+        process.wait()
+    return {
+        "baseline": baseline,
+        "samples": samples,
+        "sent": sum(sent for sent, _ in totals),
+        "received": sum(received for _, received in totals),
+    }
+
+
+def main(args: Namespace) -> None:
+    print(f"{args.clients} clients reading {args.read_rate} KiB/s each, "
+          f"{args.duration:.0f}s")
+    for server in args.servers:
+        result = measure(args, server)
+        samples = " ".join(f"{sample:.0f}" for sample in result["samples"])
+        print(f"{server:>10}: RSS {result['baseline']:.0f} MiB idle, "
+              f"then {samples} MiB; "
+              f"sent {result['sent'] / 2**20:.0f} MiB, "
+              f"read back {result['received'] / 2**20:.0f} MiB")
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,103 @@
+import json
+import os
+import random
+import string
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser, Namespace
+from socket import create_connection
+
+from handler_lib import FrameParser, create_request, encode_message
+from handler_lib import encode_request
+
+
+class Responses(FrameParser):
+    def __init__(self) -> None:
+        FrameParser.__init__(self, keep_alive=True)
+        self.count = 0
+
+    def message_received(self):
+        self.count += 1
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(
+        description="Lookups per second over one connection, one search "
+                    "per frame and batched.")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8050)
+    parser.add_argument('--keys', type=int, default=100_000)
+    parser.add_argument('--batch-sizes', type=int, nargs='+',
+                        default=[1, 10, 100, 1000])
+    parser.add_argument('--pipeline', type=int, default=1,
+                        help="frames in flight")
+    parser.add_argument('--duration', type=float, default=3.0)
+    return parser.parse_args()
+
+
+def frames(keys: list, batch_size: int, count: int) -> list[bytes]:
+    """count requests, batch_search or plain search for batch_size 0."""
+    encoded = []
+    for _ in range(count):
+        if batch_size:
+            request = create_request(
+                "batch_search", random.sample(keys, batch_size))
+        else:
+            request = create_request("search", random.choice(keys))
+        encoded.append(encode_message(**encode_request(request)))
+    return encoded
+
+
+def run(args: Namespace, requests: list[bytes]) -> int:
+    """Frames answered in args.duration, args.pipeline at a time."""
+    connection = create_connection((args.host, args.port))
+    responses = Responses()
+    window = b"".join(requests[:args.pipeline])
+    deadline = time.perf_counter() + args.duration
+    try:
+        while time.perf_counter() < deadline:
+            connection.sendall(window)
+            expected = responses.count + args.pipeline
+            while responses.count < expected:
+                data = connection.recv(262144)
+                if not data:
+                    raise ConnectionError("Server closed the connection.")
+                responses.feed(data)
+    finally:
+        connection.close()
+    return responses.count
+
+
+def main(args: Namespace) -> None:
+    random.seed(1)
+    keys = ["".join(random.choices(string.ascii_lowercase, k=10))
+            for _ in range(args.keys)]
+    with tempfile.TemporaryDirectory() as directory:
+        index = os.path.join(directory, "keys.json")
+        with open(index, "w", encoding="utf-8") as file:
+            json.dump({key: f"Value for {key}." for key in keys}, file)
+        process = subprocess.Popen(
+            [sys.executable, "header-server.py", "--host", args.host,
+             "--port", str(args.port), "--keep-alive", "--index", index,
+             "--cache-bytes", "0", "--log-level", "WARNING"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            time.sleep(2)
+            print(f"{args.keys} keys, {args.pipeline} frames in flight")
+            # Batch size 0 is the plain search action
+            for batch_size in [0, *args.batch_sizes]:
+                answered = run(args, frames(keys, batch_size, args.pipeline))
+                lookups = answered * max(batch_size, 1)
+                name = (f"batch_search x{batch_size}" if batch_size
+                        else "search")
+                print(f"{name:>20}: {lookups / args.duration:10.0f} "
+                      f"lookups/s, {answered / args.duration:7.0f} frames/s")
+        finally:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    main(parse_args())
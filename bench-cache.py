@@ -0,0 +1,102 @@
+import random
+import string
+import tempfile
+import time
+from argparse import ArgumentParser, Namespace
+
+from cache_lib import ResponseCache
+from handler_lib import NO_SEGMENTS, MessageHandler, create_request
+from handler_lib import encode_message, encode_request
+from search_lib import MappedBackend, MemoryBackend, write_index
+from server_lib import ResponseBuilder
+
+
+class Responder(ResponseBuilder, MessageHandler):
+    """Answers fed requests, dropping the responses instead of sending."""
+
+    def __init__(self) -> None:
+        MessageHandler.__init__(self, None, "bench", keep_alive=True)
+
+    def message_received(self):
+        self.create_response()
+        self._out_queue = NO_SEGMENTS
+        self._out_size = self._out_buffered = 0
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(
+        description="Cost of answering hot searches, with and without the "
+                    "response cache.")
+    parser.add_argument('--keys', type=int, default=100_000)
+    parser.add_argument('--hot', type=int, default=1000,
+                        help="distinct queries in the traffic")
+    parser.add_argument('--requests', type=int, default=100_000)
+    parser.add_argument('--cache-bytes', type=int, default=2**24)
+    return parser.parse_args()
+
+
+def make_entries(count: int) -> dict[str, str]:
+    entries = {}
+    while len(entries) < count:
+        key = "".join(random.choices(string.ascii_lowercase, k=10))
+        entries[key] = f"Value {len(entries)} for {key}."
+    return entries
+
+
+def make_traffic(keys: list, args: Namespace, mode: str,
+                 request_ids: bool) -> bytes:
+    """Encoded requests, most of them for the first few hot queries."""
+    hot = random.sample(keys, args.hot)
+    if mode == "prefix":
+        hot = [key[:3] for key in hot]
+    # Zipf-like: query i is about 1 / (i + 1) as common as the first
+    weights = [1 / (rank + 1) for rank in range(len(hot))]
+    frames = []
+    for number, query in enumerate(
+            random.choices(hot, weights, k=args.requests)):
+        request = create_request(
+            "search", query, **({"mode": mode, "limit": 10}
+                                if mode == "prefix" else {}))
+        frames.append(encode_message(
+            **encode_request(request),
+            request_id=number if request_ids else None))
+    return b"".join(frames)
+
+
+def run(traffic: bytes, args: Namespace, cached: bool) -> tuple:
+    ResponseBuilder.response_cache = (
+        ResponseCache(args.cache_bytes) if cached else None)
+    responder = Responder()
+    start = time.perf_counter()
+    responder.feed(traffic)
+    elapsed = time.perf_counter() - start
+    stats = cached and ResponseBuilder.response_cache.stats()
+    return elapsed / args.requests, stats
+
+
+def main(args: Namespace) -> None:
+    random.seed(1)
+    entries = make_entries(args.keys)
+    keys = list(entries)
+    print(f"{args.requests} searches over {args.hot} hot queries, "
+          f"{args.keys} keys")
+    with tempfile.NamedTemporaryFile() as index:
+        write_index(index.name, entries)
+        for backend_name, backend in (
+                ("memory", MemoryBackend(entries)),
+                ("mapped", MappedBackend(index.name))):
+            ResponseBuilder.search_backend = backend
+            for mode in ("exact", "prefix"):
+                for request_ids in (False, True):
+                    traffic = make_traffic(keys, args, mode, request_ids)
+                    uncached, _ = run(traffic, args, False)
+                    cached, stats = run(traffic, args, True)
+                    ids = "with ids" if request_ids else "no ids"
+                    print(f"{backend_name:>6} {mode:>6} {ids:>8}: "
+                          f"{uncached * 1e6:5.1f}us uncached, "
+                          f"{cached * 1e6:5.1f}us cached "
+                          f"({stats['hit_rate']:.1%} hits)")
+
+
+if __name__ == '__main__':
+    main(parse_args())
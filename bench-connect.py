@@ -0,0 +1,222 @@
+import socket
+import struct
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser, Namespace
+from selectors import EVENT_READ, EVENT_WRITE, DefaultSelector
+
+from handler_lib import FrameParser, create_request, encode_message
+from handler_lib import encode_request
+
+SERVERS = {
+    "header": ["header-server.py", "--host", "{host}", "--port", "{port}",
+               "--keep-alive", "--log-level", "WARNING"],
+    "multiconn": ["multiconn-server.py", "{host}", "{port}"],
+}
+# Server options compared; "before" is what the servers used to do
+CONFIGS = {
+    "before": ["--backlog", "128", "--accept-batch", "1", "--no-nodelay"],
+    "backlog": ["--accept-batch", "1", "--no-nodelay"],
+    "batched": ["--no-nodelay"],
+    "nodelay": [],
+}
+ECHO_SIZE = 1024
+
+
+class Reply(FrameParser):
+    """Counts the frames fed to it."""
+
+    __slots__ = ("count",)
+
+    def __init__(self) -> None:
+        FrameParser.__init__(self, keep_alive=True)
+        self.count = 0
+
+    def message_received(self):
+        self.count += 1
+
+
+class Probe:
+    """One connection of a burst: connect, send a request, await a reply."""
+
+    __slots__ = ("socket", "reply", "echoed")
+
+    def __init__(self, address: tuple, framed: bool) -> None:
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setblocking(False)
+        # Reset on close, so bursts don't use up the ports in TIME_WAIT
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                               struct.pack("ii", 1, 0))
+        self.socket.connect_ex(address)
+        self.reply = Reply() if framed else None
+        self.echoed = 0
+
+    def received(self, data: bytes) -> bool:
+        """Take reply bytes; True once the whole reply is in."""
+        if self.reply is not None:
+            self.reply.feed(data)
+            return self.reply.count > 0
+        self.echoed += len(data)
+        return self.echoed >= ECHO_SIZE
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(
+        description="Connection bursts and pipelined small frames, with "
+                    "and without the accept and socket option tuning.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--servers', nargs='+', choices=list(SERVERS),
+                        default=list(SERVERS))
+    parser.add_argument('--configs', nargs='+', choices=list(CONFIGS),
+                        default=list(CONFIGS))
+    parser.add_argument('--burst', type=int, default=1000,
+                        help="connections opened at once")
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--pipeline', type=int, default=16,
+                        help="frames in flight on the pipelined connection")
+    parser.add_argument('--duration', type=float, default=2.0,
+                        help="seconds of pipelined frames")
+    return parser.parse_args()
+
+
+def listen_overflows() -> int:
+    """Handshakes dropped so far for a full accept queue, system wide."""
+    with open("/proc/net/netstat") as netstat:
+        lines = netstat.read().splitlines()
+    for names, values in zip(lines[::2], lines[1::2]):
+        if names.startswith("TcpExt:"):
+            counters = dict(zip(names.split(), values.split()))
+            return int(counters["ListenOverflows"])
+    return 0
+
+
+def wait_for_server(args: Namespace) -> None:
+    deadline = time.perf_counter() + 10
+    while True:
+        try:
+            socket.create_connection((args.host, args.port)).close()
+            return
+        except ConnectionRefusedError:
+            if time.perf_counter() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def burst(args: Namespace, request: bytes, framed: bool) -> tuple:
+    """Seconds from the start of a burst to each reply, and failures."""
+    selector = DefaultSelector()
+    started = time.perf_counter()
+    for _ in range(args.burst):
+        probe = Probe((args.host, args.port), framed)
+        selector.register(probe.socket, EVENT_WRITE, probe)
+    replied, failed = [], 0
+    deadline = started + 30
+    while selector.get_map() and time.perf_counter() < deadline:
+        for key, events in selector.select(timeout=1):
+            probe = key.data
+            try:
+                if events & EVENT_WRITE:
+                    error = probe.socket.getsockopt(
+                        socket.SOL_SOCKET, socket.SO_ERROR)
+                    if error:
+                        raise ConnectionError(error)
+                    probe.socket.sendall(request)
+                    selector.modify(probe.socket, EVENT_READ, probe)
+                    continue
+                data = probe.socket.recv(65536)
+                if not data:
+                    raise ConnectionError("closed")
+                if not probe.received(data):
+                    continue
+                replied.append(time.perf_counter() - started)
+            except OSError:
+                failed += 1
+            selector.unregister(probe.socket)
+            probe.socket.close()
+    for key in list(selector.get_map().values()):
+        failed += 1
+        key.fileobj.close()
+    selector.close()
+    return replied, failed
+
+
+def pipelined(args: Namespace, request: bytes, framed: bool) -> float:
+    """Frames per second with args.pipeline in flight on one connection."""
+    connection = socket.create_connection((args.host, args.port))
+    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    reply = Reply()
+    window = request * args.pipeline
+    answered = 0
+    deadline = time.perf_counter() + args.duration
+    try:
+        while time.perf_counter() < deadline:
+            connection.sendall(window)
+            if framed:
+                expected = reply.count + args.pipeline
+                while reply.count < expected:
+                    reply.feed(connection.recv(262144))
+            else:
+                left = len(window)
+                while left:
+                    left -= len(connection.recv(262144))
+            answered += args.pipeline
+    finally:
+        connection.close()
+    return answered / args.duration
+
+
+def measure(args: Namespace, server: str, config: str) -> dict:
+    command = [part.format(host=args.host, port=args.port)
+               for part in SERVERS[server]]
+    process = subprocess.Popen(
+        [sys.executable, *command, *CONFIGS[config]],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    framed = server == "header"
+    if framed:
+        request = encode_message(**encode_request(
+            create_request("search", "morpheus")))
+        # Replies of a few KiB, big enough to go out as several segments
+        batch = encode_message(**encode_request(
+            create_request("batch_search", ["morpheus"] * 100)))
+    else:
+        request = batch = b"x" * ECHO_SIZE
+    try:
+        wait_for_server(args)
+        overflows = listen_overflows()
+        replied, failed = [], 0
+        for _ in range(args.rounds):
+            times, failures = burst(args, request, framed)
+            replied += times
+            failed += failures
+        overflows = listen_overflows() - overflows
+        return {
+            "replied": sorted(replied),
+            "failed": failed,
+            "overflows": overflows,
+            "frames_per_second": pipelined(args, batch, framed),
+        }
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main(args: Namespace) -> None:
+    print(f"{args.rounds} bursts of {args.burst} connections, "
+          f"{args.pipeline} frames in flight when pipelined")
+    for server in args.servers:
+        for config in args.configs:
+            result = measure(args, server, config)
+            replied = result["replied"] or [0]
+            p99 = replied[int(len(replied) * 0.99)] * 1000
+            print(f"{server:>10} {config:>8}: "
+                  f"{args.burst / replied[-1]:7.0f} connections/s, "
+                  f"p99 reply {p99:6.1f}ms, max {replied[-1] * 1000:6.1f}ms, "
+                  f"{result['overflows']:5d} overflows, "
+                  f"{result['failed']:4d} failed; pipelined "
+                  f"{result['frames_per_second']:6.0f} frames/s")
+
+
+if __name__ == '__main__':
+    main(parse_args())
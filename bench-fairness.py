@@ -0,0 +1,177 @@
+import multiprocessing
+import socket
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser, Namespace
+from selectors import EVENT_READ, DefaultSelector
+
+from handler_lib import FrameParser, create_request, encode_header
+from handler_lib import encode_message, encode_request
+from metrics_lib import Histogram
+
+# Server options compared; "before" handles whatever a read brings in
+CONFIGS = {
+    "before": ["--frame-budget", "0"],
+    "fair": [],
+}
+
+
+class Replies(FrameParser):
+    __slots__ = ("count",)
+
+    def __init__(self) -> None:
+        FrameParser.__init__(self, keep_alive=True)
+        self.count = 0
+
+    def message_received(self):
+        self.count += 1
+
+
+class Interactive:
+    """A connection sending one small request at a time, then pausing."""
+
+    __slots__ = ("socket", "replies", "sent_at", "wake_at")
+
+    def __init__(self, address: tuple) -> None:
+        self.socket = socket.create_connection(address)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.setblocking(False)
+        self.replies = Replies()
+        self.sent_at: float = None
+        self.wake_at = 0.0
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(
+        description="Latency of small interactive requests while bulk "
+                    "clients share the server.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8093)
+    parser.add_argument('--configs', nargs='+', choices=list(CONFIGS),
+                        default=list(CONFIGS))
+    parser.add_argument('--interactive', type=int, default=32,
+                        help="connections sending one search at a time")
+    parser.add_argument('--think', type=float, default=0.01,
+                        help="seconds each waits between requests")
+    parser.add_argument('--uploaders', type=int, default=2,
+                        help="connections sending large binary requests")
+    parser.add_argument('--upload-mb', type=int, default=8)
+    parser.add_argument('--pipeliners', type=int, default=1,
+                        help="connections pipelining windows of searches")
+    parser.add_argument('--window', type=int, default=1000,
+                        help="searches each pipeliner sends at once")
+    parser.add_argument('--duration', type=float, default=5.0)
+    return parser.parse_args()
+
+
+def bulk(address: tuple, payload: bytes, requests: int, count,
+         stop) -> None:
+    """Send payload and read its requests' replies, over and over."""
+    connection = socket.create_connection(address)
+    replies = Replies()
+    try:
+        while not stop.is_set():
+            connection.sendall(payload)
+            expected = replies.count + requests
+            while replies.count < expected:
+                data = connection.recv(262144)
+                if not data:
+                    return
+                replies.feed(data)
+            with count.get_lock():
+                count.value += requests
+    except OSError:
+        pass
+    finally:
+        connection.close()
+
+
+def interact(args: Namespace, address: tuple) -> Histogram:
+    """Latency of the interactive requests, in seconds."""
+    frame = encode_message(**encode_request(
+        create_request("search", "morpheus")))
+    selector = DefaultSelector()
+    clients = [Interactive(address) for _ in range(args.interactive)]
+    for client in clients:
+        selector.register(client.socket, EVENT_READ, client)
+    latency = Histogram()
+    started = time.perf_counter()
+    deadline = started + args.duration
+    while (now := time.perf_counter()) < deadline:
+        for client in clients:
+            if client.sent_at is None and now >= client.wake_at:
+                client.sent_at = time.perf_counter()
+                client.socket.sendall(frame)
+        for key, _ in selector.select(timeout=args.think / 4):
+            client = key.data
+            client.replies.feed(client.socket.recv(65536))
+            if client.replies.count and client.sent_at is not None:
+                now = time.perf_counter()
+                # The first second warms up the bulk clients
+                if now - started > 1:
+                    latency.record(now - client.sent_at)
+                client.replies.count = 0
+                client.sent_at = None
+                client.wake_at = now + args.think
+    for client in clients:
+        client.socket.close()
+    selector.close()
+    return latency
+
+
+def measure(args: Namespace, config: str) -> tuple:
+    address = (args.host, args.port)
+    process = subprocess.Popen(
+        [sys.executable, "header-server.py", "--host", args.host,
+         "--port", str(args.port), "--keep-alive", "--log-level",
+         "WARNING", *CONFIGS[config]],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    stop = multiprocessing.Event()
+    uploaded = multiprocessing.Value("q", 0)
+    searched = multiprocessing.Value("q", 0)
+    size = args.upload_mb * 2**20
+    upload = encode_header(
+        size, "binary/custom-client-binary-type", "binary") + b"u" * size
+    window = encode_message(**encode_request(
+        create_request("search", "morpheus"))) * args.window
+    workers = []
+    try:
+        time.sleep(1)
+        for payload, requests, count, number in (
+                (upload, 1, uploaded, args.uploaders),
+                (window, args.window, searched, args.pipeliners)):
+            for _ in range(number):
+                worker = multiprocessing.Process(
+                    target=bulk,
+                    args=(address, payload, requests, count, stop))
+                worker.start()
+                workers.append(worker)
+        latency = interact(args, address)
+    finally:
+        stop.set()
+        process.terminate()
+        process.wait()
+        for worker in workers:
+            worker.join()
+    return latency, uploaded.value, searched.value
+
+
+def main(args: Namespace) -> None:
+    print(f"{args.interactive} interactive connections, {args.uploaders} "
+          f"uploading {args.upload_mb} MiB requests, {args.pipeliners} "
+          f"pipelining {args.window} searches; {args.duration:.0f}s each")
+    for config in args.configs:
+        latency, uploaded, searched = measure(args, config)
+        summary = latency.summary()
+        print(f"{config:>7}: interactive " + ", ".join(
+            f"{name} {summary[name] * 1000:6.1f}ms"
+            for name in ("p50", "p99", "p99.9", "max")))
+        print(f"{'':>7}  {summary['count']} interactive requests, "
+              f"{uploaded * args.upload_mb / args.duration:.0f} MiB/s "
+              f"uploaded, {searched / args.duration:.0f} searches/s "
+              f"pipelined")
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,51 @@
+import time
+from argparse import ArgumentParser, Namespace
+
+from handler_lib import FrameParser, encode_message, encode_request
+from handler_lib import create_request
+
+
+class CountingParser(FrameParser):
+    def __init__(self, header_format: str) -> None:
+        FrameParser.__init__(self, keep_alive=True,
+                             header_format=header_format)
+        self.frames = 0
+
+    def message_received(self):
+        self.frames += 1
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(
+        description="Per-message cost of JSON and binary headers.")
+    parser.add_argument('--messages', type=int, default=100_000)
+    parser.add_argument('--value', default='morpheus')
+    return parser.parse_args()
+
+
+def main(messages: int, value: str) -> None:
+    request = encode_request(create_request("search", value))
+    payload = len(request["content_bytes"])
+    print(f"search request for {value!r}: {payload} byte payload, "
+          f"{messages} messages")
+    for header_format in ("json", "binary"):
+        start = time.process_time()
+        frames = [encode_message(**request, header_format=header_format)
+                  for _ in range(messages)]
+        encode_time = time.process_time() - start
+        parser = CountingParser(header_format)
+        start = time.process_time()
+        for frame in frames:
+            parser.feed(frame)
+        decode_time = time.process_time() - start
+        assert parser.frames == messages
+        header = len(frames[0]) - payload
+        print(f"{header_format:>6}: {header:3} header bytes "
+              f"({header / payload:.0%} of payload), "
+              f"encode {encode_time / messages * 1e6:5.2f}us, "
+              f"decode {decode_time / messages * 1e6:5.2f}us per message")
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args.messages, args.value)
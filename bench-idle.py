@@ -0,0 +1,93 @@
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser, Namespace
+from socket import create_connection
+
+SERVERS = {
+    "multiconn": ["multiconn-server.py", "{host}", "{port}"],
+    "header": ["header-server.py", "--host", "{host}", "--port", "{port}",
+               "--keep-alive", "--log-level", "WARNING"],
+}
+PROTOCOLS = {"multiconn": "echo", "header": "framed"}
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(
+        description="Server CPU with many idle connections open.")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8030)
+    parser.add_argument('--servers', nargs='+', choices=list(SERVERS),
+                        default=list(SERVERS))
+    parser.add_argument('--idle', type=int, default=10000,
+                        help="connections that never send anything")
+    parser.add_argument('--active', type=int, default=10,
+                        help="load-generator connections")
+    parser.add_argument('--duration', type=float, default=5.0)
+    return parser.parse_args()
+
+
+def cpu_seconds(pid: int) -> float:
+    """User plus system CPU time of a process, from /proc."""
+    with open(f"/proc/{pid}/stat") as stat:
+        fields = stat.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def measure(args: Namespace, server: str) -> dict:
+    command = [part.format(host=args.host, port=args.port)
+               for part in SERVERS[server]]
+    process = subprocess.Popen(
+        [sys.executable, *command],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    idle = []
+    try:
+        time.sleep(1)
+        for _ in range(args.idle):
+            idle.append(create_connection((args.host, args.port)))
+        # Let the server accept them all before measuring
+        time.sleep(2)
+        before = cpu_seconds(process.pid)
+        time.sleep(args.duration)
+        idle_cpu = (cpu_seconds(process.pid) - before) / args.duration
+        before = cpu_seconds(process.pid)
+        output = subprocess.run(
+            [sys.executable, "load-generator.py", "--host", args.host,
+             "--port", str(args.port), "--protocol", PROTOCOLS[server],
+             "--concurrency", str(args.active),
+             "--duration", str(args.duration), "--json"],
+            check=True, capture_output=True, text=True).stdout
+        busy_cpu = cpu_seconds(process.pid) - before
+        report = json.loads(output)
+        return {
+            "idle_cpu": idle_cpu,
+            "requests_per_second": report["requests_per_second"],
+            "cpu_per_request": busy_cpu / max(report["completed"], 1),
+        }
+    finally:
+        for connection in idle:
+            connection.close()
+        process.terminate()
+        process.wait()
+
+
+def main(args: Namespace) -> None:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = min(hard, args.idle + args.active + 100)
+    if soft < wanted:
+        # The servers inherit the raised limit
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+    print(f"{args.idle} idle connections, {args.active} active, "
+          f"{args.duration:.0f}s per phase")
+    for server in args.servers:
+        result = measure(args, server)
+        print(f"{server:>10}: idle CPU {result['idle_cpu']:6.1%}, "
+              f"{result['requests_per_second']:8.0f} requests/s, "
+              f"{result['cpu_per_request'] * 1e6:6.1f}us CPU per request")
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,53 @@
+import json
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser, Namespace
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(
+        description="header-server throughput at each --log-level.")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8020)
+    parser.add_argument('--levels', nargs='+',
+                        default=['DEBUG', 'INFO', 'WARNING'])
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=5.0)
+    return parser.parse_args()
+
+
+def measure(args: Namespace, level: str) -> dict:
+    # The server's log goes to a pipe nobody reads quickly, like a slow
+    # terminal would; only the listener thread ever waits on it
+    server = subprocess.Popen(
+        [sys.executable, "header-server.py", "--host", args.host,
+         "--port", str(args.port), "--keep-alive", "--log-level", level],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        time.sleep(1)
+        output = subprocess.run(
+            [sys.executable, "load-generator.py", "--host", args.host,
+             "--port", str(args.port), "--concurrency",
+             str(args.concurrency), "--duration", str(args.duration),
+             "--search", "morpheus", "--json"],
+            check=True, capture_output=True, text=True).stdout
+        return json.loads(output)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main(args: Namespace) -> None:
+    print(f"{args.concurrency} keep-alive connections, "
+          f"{args.duration:.0f}s per level")
+    for level in args.levels:
+        report = measure(args, level)
+        latency = report["latency"]
+        print(f"{level:>8}: {report['requests_per_second']:8.0f} requests/s, "
+              f"p50 {latency['p50'] * 1e3:.3f}ms, "
+              f"p99 {latency['p99'] * 1e3:.3f}ms")
+
+
+if __name__ == '__main__':
+    main(parse_args())
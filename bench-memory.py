@@ -0,0 +1,103 @@
+import ipaddress
+import resource
+import socket
+import struct
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser, Namespace
+
+SERVERS = {
+    "header": ["header-server.py", "--host", "{host}", "--port", "{port}",
+               "--keep-alive", "--log-level", "WARNING"],
+    "async": ["async-header-server.py", "--host", "{host}", "--port",
+              "{port}", "--keep-alive", "--no-uvloop", "--log-level",
+              "WARNING"],
+    "multiconn": ["multiconn-server.py", "{host}", "{port}"],
+}
+# One source address has about 28k ephemeral ports to connect from
+CONNECTIONS_PER_SOURCE = 25000
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(
+        description="Server memory per idle connection.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8070)
+    parser.add_argument('--servers', nargs='+', choices=list(SERVERS),
+                        default=list(SERVERS))
+    parser.add_argument('--connections', type=int, default=100_000,
+                        help="capped by the open files limit")
+    return parser.parse_args()
+
+
+def rss(pid: int) -> int:
+    """Resident set size of a process in bytes, from /proc."""
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    raise ValueError(f"No VmRSS for process {pid}.")
+
+
+def connect(args: Namespace, number: int) -> socket.socket:
+    connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if ipaddress.ip_address(args.host).is_loopback:
+        # All of 127.0.0.0/8 is loopback, so spread the connections over
+        # enough source addresses to have the ports for them
+        source = ipaddress.ip_address("127.0.0.1") + (
+            number // CONNECTIONS_PER_SOURCE)
+        connection.setsockopt(
+            socket.IPPROTO_IP, socket.IP_BIND_ADDRESS_NO_PORT, 1)
+        connection.bind((str(source), 0))
+    # Reset on close rather than leave the ports in TIME_WAIT for the
+    # next run
+    connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                          struct.pack("ii", 1, 0))
+    connection.connect((args.host, args.port))
+    return connection
+
+
+def measure(args: Namespace, server: str, count: int) -> tuple[int, int]:
+    """Server RSS with no connections, then with count idle ones."""
+    command = [part.format(host=args.host, port=args.port)
+               for part in SERVERS[server]]
+    process = subprocess.Popen(
+        [sys.executable, *command],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    idle = []
+    try:
+        time.sleep(1)
+        before = rss(process.pid)
+        for number in range(count):
+            idle.append(connect(args, number))
+        # Let the server accept them all before measuring
+        time.sleep(3)
+        return before, rss(process.pid)
+    finally:
+        for connection in idle:
+            connection.close()
+        process.terminate()
+        process.wait()
+
+
+def main(args: Namespace) -> None:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    # The servers inherit the raised limit; both ends need a descriptor
+    # per connection
+    count = min(args.connections, hard - 100)
+    if soft < count + 100:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (count + 100, hard))
+    if count < args.connections:
+        print(f"Open files limit {hard}: {count} connections, "
+              f"not {args.connections}")
+    print(f"{count} idle connections")
+    for server in args.servers:
+        before, after = measure(args, server, count)
+        print(f"{server:>10}: {before / 2**20:6.1f} MiB without, "
+              f"{after / 2**20:7.1f} MiB with, "
+              f"{(after - before) / count:7.0f} bytes per connection")
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,120 @@
+import subprocess
+import sys
+import threading
+import time
+from argparse import ArgumentParser, Namespace
+from socket import create_connection
+
+from handler_lib import FrameParser, create_request, encode_message
+from handler_lib import encode_request
+
+MODES = {
+    "inline": [],
+    "thread": ["--offload", "thread"],
+    "process": ["--offload", "process"],
+}
+
+
+class Responses(FrameParser):
+    def __init__(self) -> None:
+        FrameParser.__init__(self, keep_alive=True)
+        self.count = 0
+
+    def message_received(self):
+        self.count += 1
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(
+        description="Latency of fast requests while other requests are "
+                    "slow, answered inline or offloaded.")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8060)
+    parser.add_argument('--modes', nargs='+', choices=list(MODES),
+                        default=list(MODES))
+    parser.add_argument('--fast-clients', type=int, default=4)
+    parser.add_argument('--slow-clients', type=int, default=1)
+    parser.add_argument('--slow-mb', type=float, default=8,
+                        help="JSON body size of each slow request")
+    parser.add_argument('--duration', type=float, default=5.0)
+    return parser.parse_args()
+
+
+def request(connection, frame: bytes, responses: Responses) -> None:
+    connection.sendall(frame)
+    expected = responses.count + 1
+    while responses.count < expected:
+        data = connection.recv(65536)
+        if not data:
+            raise ConnectionError("Server closed the connection.")
+        responses.feed(data)
+
+
+def client(args: Namespace, frame: bytes, stop: threading.Event,
+           latencies: list) -> None:
+    connection = create_connection((args.host, args.port))
+    responses = Responses()
+    try:
+        while not stop.is_set():
+            start = time.perf_counter()
+            request(connection, frame, responses)
+            latencies.append(time.perf_counter() - start)
+    finally:
+        connection.close()
+
+
+def measure(args: Namespace, mode: str) -> tuple[list, list]:
+    process = subprocess.Popen(
+        [sys.executable, "header-server.py", "--host", args.host,
+         "--port", str(args.port), "--keep-alive", "--log-level",
+         "WARNING", *MODES[mode]],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    fast_frame = encode_message(
+        **encode_request(create_request("search", "morpheus")))
+    # Mostly padding, which only costs decoding
+    slow_frame = encode_message(**encode_request(create_request(
+        "search", "ring", padding=["x" * 100] * int(
+            args.slow_mb * 2**20 / 105))))
+    stop = threading.Event()
+    fast, slow = [], []
+    threads = [threading.Thread(target=client,
+                                args=(args, fast_frame, stop, fast))
+               for _ in range(args.fast_clients)]
+    threads += [threading.Thread(target=client,
+                                 args=(args, slow_frame, stop, slow))
+                for _ in range(args.slow_clients)]
+    try:
+        time.sleep(1)
+        for thread in threads:
+            thread.start()
+        time.sleep(args.duration)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        process.terminate()
+        process.wait()
+    return fast, slow
+
+
+def summary(latencies: list) -> str:
+    if not latencies:
+        return "none"
+    latencies = sorted(latencies)
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[int(len(latencies) * 0.99)] * 1000
+    return (f"{len(latencies):6d} done, p50 {p50:6.1f}ms, "
+            f"p99 {p99:6.1f}ms, max {latencies[-1] * 1000:6.1f}ms")
+
+
+def main(args: Namespace) -> None:
+    print(f"{args.fast_clients} fast clients, {args.slow_clients} sending "
+          f"{args.slow_mb:g} MiB requests, {args.duration:.0f}s")
+    for mode in args.modes:
+        fast, slow = measure(args, mode)
+        print(f"{mode:>8} fast: {summary(fast)}")
+        print(f"{'':>8} slow: {summary(slow)}")
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,141 @@
+import random
+import struct
+import time
+from argparse import ArgumentParser, Namespace
+
+from handler_lib import MessageHandler, json_decode, json_encode
+
+
+class FakeSocket:
+    """Replays a byte stream in fixed fragments, like a slow network."""
+
+    def __init__(self, stream: bytes, fragments: list[int]) -> None:
+        self.stream = memoryview(stream)
+        self.fragments = fragments
+        self.position = 0
+        self.fragment_index = 0
+        self.fragment_left = fragments[0]
+
+    def _next_size(self, size: int) -> int:
+        if self.position == len(self.stream):
+            # Everything was delivered; frames may still be buffered
+            raise BlockingIOError
+        size = min(size, self.fragment_left,
+                   len(self.stream) - self.position)
+        self.fragment_left -= size
+        if not self.fragment_left:
+            self.fragment_index = (
+                (self.fragment_index + 1) % len(self.fragments))
+            self.fragment_left = self.fragments[self.fragment_index]
+        return size
+
+    def recv(self, size: int) -> bytes:
+        size = self._next_size(size)
+        data = bytes(self.stream[self.position:self.position + size])
+        self.position += size
+        return data
+
+    def recv_into(self, buffer, size: int = 0) -> int:
+        size = self._next_size(size or len(buffer))
+        buffer[:size] = self.stream[self.position:self.position + size]
+        self.position += size
+        return size
+
+
+class LegacyMessageHandler(MessageHandler):
+    """The receive path before ReceiveBuffer: bytes += and re-slicing."""
+
+    def __init__(self, socket, label) -> None:
+        super().__init__(socket, label)
+        self.received = b""
+
+    def read(self):
+        try:
+            self.received += self.socket.recv(4096)
+        except BlockingIOError:
+            pass
+        if self._json_header_len is None:
+            self._process_protoheader()
+        if self._json_header_len:
+            if self.json_header is None:
+                self._process_json_header()
+            if self.json_header:
+                if self.content is None:
+                    self._process_content()
+                if self.content:
+                    self.decode_content()
+
+    def _process_protoheader(self):
+        if len(self.received) >= 2:
+            self._json_header_len = struct.unpack(">H", self.received[:2])[0]
+            self.received = self.received[2:]
+
+    def _process_json_header(self):
+        header_length = self._json_header_len
+        if len(self.received) >= header_length:
+            self.json_header = json_decode(
+                self.received[:header_length], "utf-8")
+            self.received = self.received[header_length:]
+
+    def _process_content(self):
+        content_len = self.json_header["content-length"]
+        if len(self.received) >= content_len:
+            self.content = self.received[:content_len]
+            self.received = self.received[content_len:]
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(
+        description="Compare the old and new receive paths.")
+    parser.add_argument('--large-mb', type=int, default=16,
+                        help="size of the large message, in MiB")
+    parser.add_argument('--messages', type=int, default=2000,
+                        help="number of small fragmented messages")
+    parser.add_argument('--max-fragment', type=int, default=1500,
+                        help="largest fragment for the fragmented run")
+    return parser.parse_args()
+
+
+def frame(content: bytes) -> bytes:
+    header = json_encode({
+        "byteorder": "big",
+        "content-type": "binary/custom-client-binary-type",
+        "content-encoding": "binary",
+        "content-length": len(content),
+    }, "utf-8")
+    return struct.pack(">H", len(header)) + header + content
+
+
+def run(handler_class, stream: bytes, fragments: list[int],
+        messages: int) -> float:
+    socket = FakeSocket(stream, fragments)
+    handler = handler_class(socket, "bench")
+    start = time.perf_counter()
+    for _ in range(messages):
+        while handler.content is None:
+            handler.read()
+        # Start the next frame on the same receive buffer
+        handler._json_header_len = None
+        handler.json_header = None
+        handler.content = None
+    return time.perf_counter() - start
+
+
+def main(large_mb: int, messages: int, max_fragment: int) -> None:
+    large = frame(random.randbytes(large_mb * 2**20))
+    # Kernel-sized reads of 64 KiB for the large message
+    cases = [(f"1 x {large_mb} MiB message", large, [65536], 1)]
+    small = frame(random.randbytes(1024))
+    fragments = [random.randint(1, max_fragment) for _ in range(997)]
+    cases.append((f"{messages} x 1 KiB in 1-{max_fragment} byte fragments",
+                  small * messages, fragments, messages))
+    for name, stream, fragment_sizes, count in cases:
+        before = run(LegacyMessageHandler, stream, fragment_sizes, count)
+        after = run(MessageHandler, stream, fragment_sizes, count)
+        print(f"{name}: before {before:.3f}s, after {after:.3f}s "
+              f"({before / after:.1f}x)")
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args.large_mb, args.messages, args.max_fragment)
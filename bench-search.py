@@ -0,0 +1,120 @@
+import json
+import os
+import random
+import string
+import tempfile
+import time
+from argparse import ArgumentParser, Namespace
+
+from search_lib import MappedBackend, MemoryBackend, write_index
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(
+        description="Load time and lookup latency of the search backends.")
+    parser.add_argument('--keys', type=int, default=1_000_000)
+    parser.add_argument('--queries', type=int, default=20000)
+    parser.add_argument('--fuzzy-queries', type=int, default=200)
+    parser.add_argument('--no-fuzzy', action='store_true',
+                        help="skip building the trigram index")
+    parser.add_argument('--seed', type=int, default=1)
+    return parser.parse_args()
+
+
+def rss_mib() -> float:
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def make_entries(count: int) -> dict[str, str]:
+    words = ["".join(random.choices(string.ascii_lowercase,
+                                    k=random.randint(4, 8)))
+             for _ in range(max(count // 50, 100))]
+    entries = {}
+    while len(entries) < count:
+        key = f"{random.choice(words)} {random.choice(words)}"
+        entries[key] = f"Value {len(entries)} for {key}."
+    return entries
+
+
+def typo(key: str) -> str:
+    position = random.randrange(len(key))
+    return key[:position] + random.choice(string.ascii_lowercase) + key[
+        position + 1:]
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def latency(lookup, queries: list) -> str:
+    times = []
+    for query in queries:
+        start = time.perf_counter_ns()
+        lookup(query)
+        times.append(time.perf_counter_ns() - start)
+    times.sort()
+    mean = sum(times) / len(times) / 1000
+    p99 = times[int(len(times) * 0.99)] / 1000
+    return f"mean {mean:7.1f}us, p99 {p99:7.1f}us"
+
+
+def main(args: Namespace) -> None:
+    random.seed(args.seed)
+    entries = make_entries(args.keys)
+    keys = list(entries)
+    hits = random.choices(keys, k=args.queries)
+    misses = [typo(key) + "#" for key in hits]
+    prefixes = [key[:len(key) // 2] for key in hits]
+    typos = [typo(key) for key in random.choices(keys, k=args.fuzzy_queries)]
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, "entries.json")
+        index = os.path.join(directory, "entries.index")
+        with open(source, "w", encoding="utf-8") as file:
+            json.dump(entries, file)
+        del entries
+
+        print(f"{args.keys} keys")
+        before = rss_mib()
+        with open(source, encoding="utf-8") as file:
+            loaded, parse_seconds = timed(json.load, file)
+        memory, build_seconds = timed(MemoryBackend, loaded)
+        print(f"{'memory':>14}: load {parse_seconds + build_seconds:6.2f}s "
+              f"(JSON {parse_seconds:.2f}s), "
+              f"+{rss_mib() - before:.0f} MiB RSS")
+        backends = [("memory", memory)]
+        if not args.no_fuzzy:
+            before = rss_mib()
+            fuzzy, seconds = timed(MemoryBackend, loaded, True)
+            print(f"{'memory+ngrams':>14}: load "
+                  f"{parse_seconds + seconds:6.2f}s, "
+                  f"+{rss_mib() - before:.0f} MiB RSS over memory")
+            backends.append(("memory+ngrams", fuzzy))
+        _, seconds = timed(write_index, index, loaded)
+        before = rss_mib()
+        mapped, open_seconds = timed(MappedBackend, index)
+        print(f"{'mapped':>14}: load {open_seconds * 1000:6.2f}ms, "
+              f"+{rss_mib() - before:.0f} MiB RSS; "
+              f"index {os.path.getsize(index) / 2**20:.0f} MiB, "
+              f"written in {seconds:.2f}s")
+        backends.append(("mapped", mapped))
+        for name, backend in backends:
+            print(f"{name:>14}: exact hit  {latency(backend.get, hits)}")
+            print(f"{'':>14}  exact miss {latency(backend.get, misses)}")
+            print(f"{'':>14}  prefix     "
+                  + latency(lambda query: backend.prefix(query, 10),
+                            prefixes))
+            if backend.fuzzy("", 1) is not None:
+                print(f"{'':>14}  fuzzy      "
+                      + latency(lambda query: backend.fuzzy(query, 10),
+                                typos))
+        mapped.close()
+
+
+if __name__ == '__main__':
+    main(parse_args())
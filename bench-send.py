@@ -0,0 +1,126 @@
+import random
+import selectors
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser, Namespace
+from socket import socketpair
+
+from handler_lib import MessageHandler, encode_message
+
+
+class LegacyMessageHandler(MessageHandler):
+    """The send path before the out queue: concatenate and re-slice."""
+
+    def __init__(self, socket, label) -> None:
+        super().__init__(socket, label)
+        self._out_buffer = b""
+
+    def create_message(self, content_bytes, content_type, content_encoding,
+                       request_id=None):
+        self.buffer(encode_message(
+            content_bytes, content_type, content_encoding,
+            self.header_format, request_id))
+
+    def buffer(self, message: bytes):
+        self._out_buffer += message
+        self.finished_writing = False
+
+    def write(self):
+        if not self.finished_writing:
+            try:
+                sent = self.socket.send(self._out_buffer)
+                self._out_buffer = self._out_buffer[sent:]
+            except BlockingIOError:
+                pass
+            if not self._out_buffer:
+                self.finished_writing = True
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(
+        description="Compare the old and new send paths over a socketpair.")
+    parser.add_argument('--large-mb', type=int, default=8,
+                        help="size of each large message, in MiB")
+    parser.add_argument('--large-messages', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=20000,
+                        help="number of small messages")
+    return parser.parse_args()
+
+
+def drain(socket, total: int) -> None:
+    buffer = bytearray(262144)
+    while total > 0:
+        received = socket.recv_into(buffer)
+        if not received:
+            break
+        total -= received
+
+
+def run(handler_class, queue_message, count: int,
+        size: int) -> tuple[float, float]:
+    """Wall and CPU seconds to send count messages, one at a time."""
+    sender, receiver = socketpair()
+    sender.setblocking(False)
+    handler = handler_class(sender, "bench")
+    selector = selectors.DefaultSelector()
+    selector.register(sender, selectors.EVENT_WRITE)
+    reader = threading.Thread(target=drain, args=(receiver, count * size))
+    reader.start()
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    for _ in range(count):
+        queue_message(handler)
+        while not handler.finished_writing:
+            selector.select()
+            handler.write()
+    reader.join()
+    elapsed = time.perf_counter() - start, time.process_time() - cpu_start
+    selector.close()
+    sender.close()
+    receiver.close()
+    return elapsed
+
+
+def compare(name: str, before: tuple, after: tuple) -> None:
+    print(f"{name}: before {before[0]:.3f}s ({before[1]:.3f}s CPU), "
+          f"after {after[0]:.3f}s ({after[1]:.3f}s CPU)")
+
+
+def main(args: Namespace) -> None:
+    content_type = "binary/custom-server-binary-type"
+    large = random.randbytes(args.large_mb * 2**20)
+    small = random.randbytes(1024)
+    large_name = f"{args.large_messages} x {args.large_mb} MiB messages"
+    for name, payload, count in (
+            (large_name, large, args.large_messages),
+            (f"{args.messages} x 1 KiB messages", small, args.messages)):
+        size = len(encode_message(payload, content_type, "binary"))
+
+        def queue_bytes(handler, payload=payload):
+            handler.create_message(payload, content_type, "binary")
+
+        compare(name,
+                run(LegacyMessageHandler, queue_bytes, count, size),
+                run(MessageHandler, queue_bytes, count, size))
+
+    def queue_large(handler):
+        handler.create_message(large, content_type, "binary")
+
+    with tempfile.NamedTemporaryFile() as file:
+        file.write(large)
+        file.flush()
+
+        def queue_file(handler):
+            handler.create_file_message(
+                open(file.name, "rb"), content_type, "binary")
+
+        count = args.large_messages
+        size = len(encode_message(large, content_type, "binary"))
+        compare(f"{large_name} from a file (sendfile)",
+                run(LegacyMessageHandler, queue_large, count, size),
+                run(MessageHandler, queue_file, count, size))
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,124 @@
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser, Namespace
+
+from handler_lib import SHARED_MEMORY, FrameParser, encode_header
+from shm_lib import create_segment, remove_segment
+from socket_lib import Endpoint
+
+CONTENT_TYPE = "binary/custom-client-binary-type"
+
+
+class Replies(FrameParser):
+    __slots__ = ("count",)
+
+    def __init__(self) -> None:
+        FrameParser.__init__(self, keep_alive=True)
+        self.count = 0
+
+    def message_received(self):
+        self.count += 1
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(
+        description="Large binary requests sent through a socket or handed "
+                    "over in shared memory.")
+    parser.add_argument('--port', type=int, default=8091)
+    parser.add_argument('--sizes-mb', type=int, nargs='+',
+                        default=[1, 16, 64])
+    parser.add_argument('--duration', type=float, default=2.0,
+                        help="seconds of each run")
+    return parser.parse_args()
+
+
+def round_trip(connection: socket.socket, segments: tuple,
+               replies: Replies) -> None:
+    for segment in segments:
+        connection.sendall(segment)
+    expected = replies.count + 1
+    while replies.count < expected:
+        data = connection.recv(65536)
+        if not data:
+            raise ConnectionError("Server closed the connection.")
+        replies.feed(data)
+
+
+def sent(connection: socket.socket, payload: bytes,
+         duration: float) -> float:
+    """Requests per second with the payload pushed through the socket."""
+    header = encode_header(len(payload), CONTENT_TYPE, "binary")
+    replies = Replies()
+    deadline = time.perf_counter() + duration
+    start = time.perf_counter()
+    while time.perf_counter() < deadline:
+        round_trip(connection, (header, payload), replies)
+    return replies.count / (time.perf_counter() - start)
+
+
+def shared(connection: socket.socket, payload: bytes,
+           duration: float) -> float:
+    """Requests per second with the payload copied into a segment each."""
+    replies = Replies()
+    deadline = time.perf_counter() + duration
+    start = time.perf_counter()
+    while time.perf_counter() < deadline:
+        name, descriptor = create_segment(payload)
+        try:
+            round_trip(connection, (encode_header(
+                len(descriptor), CONTENT_TYPE, SHARED_MEMORY) + descriptor,),
+                replies)
+        finally:
+            # Already gone once the server read it
+            remove_segment(name)
+    return replies.count / (time.perf_counter() - start)
+
+
+def copied(payload: bytes, duration: float) -> float:
+    """Copies per second of the payload in this process, for reference."""
+    copies = 0
+    deadline = time.perf_counter() + duration
+    start = time.perf_counter()
+    while time.perf_counter() < deadline:
+        bytearray(payload)
+        copies += 1
+    return copies / (time.perf_counter() - start)
+
+
+def main(args: Namespace) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "server.sock")
+        process = subprocess.Popen(
+            [sys.executable, "header-server.py", "--port", str(args.port),
+             "--keep-alive", "--unix", path, "--shared-memory",
+             "--log-level", "WARNING"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            time.sleep(1)
+            tcp = Endpoint.tcp("127.0.0.1", args.port).connect()
+            unix = Endpoint.unix(path).connect()
+            print(f"{args.duration:.0f}s per run; MiB/s of request bodies")
+            for size_mb in args.sizes_mb:
+                payload = os.urandom(size_mb * 2**20)
+                rates = {
+                    "tcp": sent(tcp, payload, args.duration),
+                    "unix": sent(unix, payload, args.duration),
+                    "shared memory": shared(unix, payload, args.duration),
+                    "one copy": copied(payload, args.duration),
+                }
+                print(f"{size_mb:4d} MiB: " + ", ".join(
+                    f"{name} {rate * size_mb:6.0f}"
+                    for name, rate in rates.items()))
+            tcp.close()
+            unix.close()
+        finally:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    main(parse_args())
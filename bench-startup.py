@@ -0,0 +1,68 @@
+import statistics
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser, Namespace
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(
+        description="What a header-client.py process per lookup costs, "
+                    "against one --batch process for all of them.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8094)
+    parser.add_argument('--runs', type=int, default=20,
+                        help="processes started for each startup timing")
+    parser.add_argument('--lookups', type=int, default=10000,
+                        help="lookups sent by one --batch process")
+    return parser.parse_args()
+
+
+def timed(command: list, **kwargs) -> float:
+    start = time.perf_counter()
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL,
+                   **kwargs)
+    return time.perf_counter() - start
+
+
+def median_run(command: list, runs: int) -> float:
+    return statistics.median(timed(command) for _ in range(runs))
+
+
+def main(args: Namespace) -> None:
+    client = [sys.executable, "header-client.py", "--host", args.host,
+              "--port", str(args.port), "--log-level", "WARNING"]
+    process = subprocess.Popen(
+        [sys.executable, "header-server.py", "--host", args.host,
+         "--port", str(args.port), "--keep-alive", "--log-level",
+         "WARNING"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        time.sleep(1)
+        startups = {
+            "interpreter": [sys.executable, "-c", "pass"],
+            "import handler_lib": [
+                sys.executable, "-c", "import handler_lib"],
+            "import client_pool": [
+                sys.executable, "-c", "import client_pool"],
+            "single-shot lookup": [
+                *client, "--action", "search", "--value", "morpheus"],
+        }
+        print(f"Median of {args.runs} processes each")
+        for name, command in startups.items():
+            duration = median_run(command, args.runs)
+            print(f"{name:>20}: {duration * 1000:6.1f}ms")
+        lines = "search morpheus\n" * args.lookups
+        duration = timed([*client, "--batch", "-"], input=lines.encode(),
+                         stderr=subprocess.DEVNULL)
+        print(f"{'batch':>20}: {duration * 1000:6.1f}ms for "
+              f"{args.lookups} lookups, "
+              f"{duration / args.lookups * 1e6:.1f}us each, "
+              f"{args.lookups / duration:.0f} lookups/s")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+if __name__ == '__main__':
+    main(parse_args())
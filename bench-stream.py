@@ -0,0 +1,113 @@
+import hashlib
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser, Namespace
+
+from handler_lib import FrameParser, encode_chunk, encode_header
+
+
+class BufferingParser(FrameParser):
+    """Holds each body whole, as before streaming."""
+
+    def __init__(self) -> None:
+        FrameParser.__init__(self, keep_alive=True)
+        self.frames = 0
+
+    def message_received(self):
+        self.frames += 1
+
+
+class HashingParser(BufferingParser):
+    def __init__(self, chunk_size: int) -> None:
+        BufferingParser.__init__(self)
+        self.chunk_size = chunk_size
+
+    def content_chunk(self, chunk):
+        if self.digest is None:
+            self.digest = hashlib.sha256()
+        self.digest.update(chunk)
+
+    def content_done(self):
+        return self.digest.digest()
+
+    def reset(self):
+        super().reset()
+        self.digest = None
+
+
+class SpillingParser(BufferingParser):
+    def __init__(self, chunk_size: int, directory: str) -> None:
+        BufferingParser.__init__(self)
+        self.chunk_size = chunk_size
+        self.directory = directory
+        self.file = None
+
+    def content_chunk(self, chunk):
+        if self.file is None:
+            self.file = tempfile.TemporaryFile(dir=self.directory)
+        self.file.write(chunk)
+
+    def content_done(self):
+        spilled, self.file = self.file, None
+        return spilled
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(
+        description="Peak memory of buffered and streamed request bodies.")
+    parser.add_argument('--body-mb', type=int, default=256)
+    parser.add_argument('--piece', type=int, default=65536,
+                        help="bytes fed to the parser at a time, like "
+                             "one socket read")
+    parser.add_argument('--chunk-size', type=int, default=65536)
+    return parser.parse_args()
+
+
+def pieces(body_mb: int, piece: int, chunked: bool):
+    """The frame for one body of body_mb MiB, piece bytes at a time."""
+    block = bytes(range(256)) * (piece // 256)
+    size = body_mb * 2**20
+    content_type = "binary/custom-client-binary-type"
+    if chunked:
+        yield encode_header(None, content_type, "binary")
+        for _ in range(size // len(block)):
+            yield encode_chunk(block) + block
+        yield encode_chunk(b"")
+    else:
+        yield encode_header(size, content_type, "binary")
+        for _ in range(size // len(block)):
+            yield block
+
+
+def run(parser: FrameParser, args: Namespace,
+        chunked: bool) -> tuple[float, int]:
+    """Seconds and peak bytes allocated to parse one body."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    for piece in pieces(args.body_mb, args.piece, chunked):
+        parser.feed(piece)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert parser.frames == 1
+    return elapsed, peak
+
+
+def main(args: Namespace) -> None:
+    print(f"one {args.body_mb} MiB body fed {args.piece} bytes at a time, "
+          f"chunk size {args.chunk_size}")
+    with tempfile.TemporaryDirectory() as directory:
+        for chunked in (False, True):
+            body = "chunked" if chunked else "content-length"
+            for name, parser in (
+                    ("buffered", BufferingParser()),
+                    ("hashed", HashingParser(args.chunk_size)),
+                    ("spilled", SpillingParser(args.chunk_size, directory))):
+                elapsed, peak = run(parser, args, chunked)
+                print(f"{body:>14} {name:>8}: {elapsed:6.3f}s, "
+                      f"peak {peak / 2**20:8.2f} MiB")
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,58 @@
+import random
+import time
+from argparse import ArgumentParser, Namespace
+
+from timer_lib import TimerWheel
+
+
+class Timer:
+    __slots__ = ("deadline",)
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(
+        description="Per-operation cost of the timer wheel as it fills.")
+    parser.add_argument('--timers', type=int, nargs='+',
+                        default=[1_000, 10_000, 100_000, 1_000_000])
+    parser.add_argument('--timeout', type=float, default=60.0)
+    return parser.parse_args()
+
+
+def run(count: int, timeout: float) -> dict:
+    now = 0.0
+    wheel = TimerWheel(now=now)
+    timers = [Timer() for _ in range(count)]
+    results = {}
+    start = time.perf_counter()
+    for timer in timers:
+        wheel.schedule(timer, now + random.uniform(timeout / 2, timeout))
+    results["schedule"] = (time.perf_counter() - start) / count
+    # Activity on every connection pushes its idle deadline later
+    now = 1.0
+    start = time.perf_counter()
+    for timer in timers:
+        wheel.schedule(timer, now + timeout)
+    results["refresh"] = (time.perf_counter() - start) / count
+    start = time.perf_counter()
+    for timer in timers[::2]:
+        wheel.cancel(timer)
+    results["cancel"] = (time.perf_counter() - start) / (count // 2)
+    start = time.perf_counter()
+    expired = 0
+    while len(wheel):
+        now += wheel.tick
+        expired += len(wheel.expire(now))
+    results["expire"] = (time.perf_counter() - start) / max(expired, 1)
+    return results
+
+
+def main(args: Namespace) -> None:
+    for count in args.timers:
+        results = run(count, args.timeout)
+        print(f"{count:>9} timers: " + ", ".join(
+            f"{name} {seconds * 1e9:4.0f}ns"
+            for name, seconds in results.items()))
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,182 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser, Namespace
+
+from handler_lib import FrameParser, create_request, encode_message
+from handler_lib import encode_request
+from socket_lib import Endpoint, SocketOptions
+
+
+class Replies(FrameParser):
+    __slots__ = ("count",)
+
+    def __init__(self) -> None:
+        FrameParser.__init__(self, keep_alive=True)
+        self.count = 0
+
+    def message_received(self):
+        self.count += 1
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(
+        description="Small framed requests over loopback TCP, a Unix "
+                    "domain socket and a socketpair().")
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--pipeline', type=int, default=32,
+                        help="frames in flight for the throughput runs")
+    parser.add_argument('--duration', type=float, default=3.0,
+                        help="seconds of each run")
+    return parser.parse_args()
+
+
+def exchange(connection: socket.socket, window: bytes, frames: int,
+             replies: Replies) -> None:
+    connection.sendall(window)
+    expected = replies.count + frames
+    while replies.count < expected:
+        data = connection.recv(262144)
+        if not data:
+            raise ConnectionError("Server closed the connection.")
+        replies.feed(data)
+
+
+def latencies(connection: socket.socket, frame: bytes,
+              duration: float) -> list[float]:
+    """Round trips of one request at a time."""
+    replies = Replies()
+    times = []
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        exchange(connection, frame, 1, replies)
+        times.append(time.perf_counter() - start)
+    return sorted(times)
+
+
+def echo_latencies(connection: socket.socket, frame: bytes,
+                   duration: float) -> list[float]:
+    """Round trips through a process echoing the bytes straight back."""
+    times = []
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        connection.sendall(frame)
+        left = len(frame)
+        while left:
+            left -= len(connection.recv(65536))
+        times.append(time.perf_counter() - start)
+    return sorted(times)
+
+
+def echo_process(connection: socket.socket) -> int:
+    """Fork a process echoing whatever connection receives."""
+    pid = os.fork()
+    if pid:
+        connection.close()
+        return pid
+    try:
+        while data := connection.recv(65536):
+            connection.sendall(data)
+    finally:
+        os._exit(0)
+
+
+def echo_connections(path: str) -> tuple[dict, list[int]]:
+    """Connections to echo processes over each transport, and their pids.
+
+    The processes inherit each other's connections too, so they never see
+    the end of them: kill them when done.
+    """
+    connections, pids = {}, []
+    for name, endpoint in (("tcp", Endpoint.tcp("127.0.0.1", 0)),
+                           ("unix", Endpoint.unix(path))):
+        listening_socket = endpoint.listen(SocketOptions())
+        client = Endpoint(endpoint.family,
+                          listening_socket.getsockname()).connect()
+        listening_socket.setblocking(True)
+        pids.append(echo_process(listening_socket.accept()[0]))
+        listening_socket.close()
+        connections[name] = client
+    connections["tcp"].setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    os.unlink(path)
+    connections["socketpair"], server_end = socket.socketpair()
+    pids.append(echo_process(server_end))
+    return connections, pids
+
+
+def report(name: str, times: list[float], duration: float,
+           rate: float = None) -> None:
+    p50 = times[len(times) // 2] * 1e6
+    p99 = times[int(len(times) * 0.99)] * 1e6
+    line = (f"{name:>10}: round trip p50 {p50:6.1f}us, p99 {p99:6.1f}us, "
+            f"{len(times) / duration:6.0f} requests/s one at a time")
+    if rate is not None:
+        line += f", {rate:6.0f} frames/s pipelined"
+    print(line)
+
+
+def throughput(connection: socket.socket, frame: bytes, pipeline: int,
+               duration: float) -> float:
+    """Frames per second, pipeline of them in flight."""
+    replies = Replies()
+    window = frame * pipeline
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        exchange(connection, window, pipeline, replies)
+    return replies.count / duration
+
+
+def main(args: Namespace) -> None:
+    frame = encode_message(**encode_request(
+        create_request("search", "morpheus")))
+    print(f"{len(frame)} byte search requests, {args.duration:.0f}s per "
+          f"run, {args.pipeline} in flight when pipelined")
+    with tempfile.TemporaryDirectory() as directory:
+        print("Echoed by a bare process, the transport alone:")
+        connections, pids = echo_connections(
+            os.path.join(directory, "echo.sock"))
+        for name, connection in connections.items():
+            report(name, echo_latencies(connection, frame, args.duration),
+                   args.duration)
+            connection.close()
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+        path = os.path.join(directory, "server.sock")
+        channel, server_end = socket.socketpair()
+        process = subprocess.Popen(
+            [sys.executable, "header-server.py", "--port", str(args.port),
+             "--keep-alive", "--unix", path, "--channel-fd",
+             str(server_end.fileno()), "--log-level", "WARNING"],
+            pass_fds=[server_end.fileno()],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        server_end.close()
+        try:
+            time.sleep(1)
+            connections = {
+                "tcp": Endpoint.tcp("127.0.0.1", args.port).connect(),
+                "unix": Endpoint.unix(path).connect(),
+                "socketpair": channel,
+            }
+            connections["tcp"].setsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            print("Answered by header-server:")
+            for name, connection in connections.items():
+                times = latencies(connection, frame, args.duration)
+                rate = throughput(connection, frame, args.pipeline,
+                                  args.duration)
+                report(name, times, args.duration, rate)
+                connection.close()
+        finally:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,108 @@
+import socket
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser, Namespace
+
+from handler_lib import DatagramClient, FrameParser, create_request
+from handler_lib import encode_message, encode_request
+from socket_lib import Endpoint
+
+
+class Reply(FrameParser):
+    __slots__ = ("done",)
+
+    def __init__(self) -> None:
+        FrameParser.__init__(self)
+        self.done = False
+
+    def message_received(self):
+        self.done = True
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(
+        description="Single search lookups: a TCP connection each, one "
+                    "kept-alive connection, or a UDP datagram each.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8092)
+    parser.add_argument('--duration', type=float, default=3.0,
+                        help="seconds of each run")
+    return parser.parse_args()
+
+
+def connection_per_lookup(args: Namespace, request: dict) -> None:
+    """What header-client.py does for each value without --keep-alive."""
+    connection = socket.create_connection((args.host, args.port))
+    try:
+        connection.sendall(encode_message(**encode_request(request)))
+        reply = Reply()
+        while not reply.done:
+            data = connection.recv(65536)
+            if not data:
+                raise ConnectionError("Server closed the connection.")
+            reply.feed(data)
+    finally:
+        connection.close()
+
+
+def lookups(lookup, duration: float) -> list[float]:
+    times = []
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        lookup()
+        times.append(time.perf_counter() - start)
+    return sorted(times)
+
+
+def main(args: Namespace) -> None:
+    request = create_request("search", "morpheus")
+    frame = encode_message(**encode_request(request))
+    runs = {}
+    for keep_alive in (False, True):
+        process = subprocess.Popen(
+            [sys.executable, "header-server.py", "--host", args.host,
+             "--port", str(args.port), "--udp", "--log-level", "WARNING",
+             *(["--keep-alive"] if keep_alive else [])],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            time.sleep(1)
+            if keep_alive:
+                connection = socket.create_connection((args.host, args.port))
+                connection.setsockopt(
+                    socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                reply = Reply()
+                reply.keep_alive = True
+
+                def kept_alive():
+                    reply.done = False
+                    connection.sendall(
+                        encode_message(**encode_request(request)))
+                    while not reply.done:
+                        reply.feed(connection.recv(65536))
+
+                runs["tcp keep-alive"] = lookups(kept_alive, args.duration)
+                connection.close()
+            else:
+                runs["tcp connection each"] = lookups(
+                    lambda: connection_per_lookup(args, request),
+                    args.duration)
+                client = DatagramClient(Endpoint.udp(args.host, args.port))
+                runs["udp"] = lookups(
+                    lambda: client.request(request), args.duration)
+                client.close()
+        finally:
+            process.terminate()
+            process.wait()
+    print(f"{len(frame)} byte search requests, one at a time, each "
+          f"encoded as sent, {args.duration:.0f}s each")
+    for name, times in runs.items():
+        p50 = times[len(times) // 2] * 1e6
+        p99 = times[int(len(times) * 0.99)] * 1e6
+        print(f"{name:>20}: p50 {p50:6.1f}us, p99 {p99:7.1f}us, "
+              f"{len(times) / args.duration:6.0f} lookups/s")
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,99 @@
+import json
+import os
+import struct
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser, Namespace
+from multiprocessing import Pool
+from socket import create_connection
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(
+        description="Measure header-server throughput against --workers.")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8010)
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=sorted({1, 2, os.cpu_count() or 1}))
+    parser.add_argument('--clients', type=int, default=os.cpu_count() or 1,
+                        help="client processes generating load")
+    parser.add_argument('--connections', type=int, default=8,
+                        help="connections per client process")
+    parser.add_argument('--duration', type=float, default=5.0)
+    return parser.parse_args()
+
+
+def search_frame(value: str) -> bytes:
+    content = json.dumps({"action": "search", "value": value}).encode()
+    header = json.dumps({
+        "byteorder": sys.byteorder,
+        "content-type": "text/json",
+        "content-encoding": "utf-8",
+        "content-length": len(content),
+    }).encode()
+    return struct.pack(">H", len(header)) + header + content
+
+
+def read_exactly(connection, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        if not (chunk := connection.recv(size - len(data))):
+            raise ConnectionAbortedError("Server closed.")
+        data += chunk
+    return data
+
+
+def read_reply(connection) -> None:
+    header_length = struct.unpack(">H", read_exactly(connection, 2))[0]
+    header = json.loads(read_exactly(connection, header_length))
+    read_exactly(connection, header["content-length"])
+
+
+def client(host: str, port: int, connections: int, duration: float) -> int:
+    """Closed loop: every connection keeps one request in flight."""
+    frame = search_frame("morpheus")
+    sockets = [create_connection((host, port)) for _ in range(connections)]
+    completed = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        for connection in sockets:
+            connection.sendall(frame)
+        for connection in sockets:
+            read_reply(connection)
+        completed += connections
+    for connection in sockets:
+        connection.close()
+    return completed
+
+
+def measure(args: Namespace, workers: int) -> float:
+    server = subprocess.Popen(
+        [sys.executable, "header-server.py", "--host", args.host,
+         "--port", str(args.port), "--keep-alive", "--workers", str(workers)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        time.sleep(1)
+        with Pool(args.clients) as pool:
+            results = pool.starmap(client, [
+                (args.host, args.port, args.connections, args.duration)
+            ] * args.clients)
+        return sum(results) / args.duration
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main(args: Namespace) -> None:
+    print(f"{os.cpu_count()} CPUs, {args.clients} client processes x "
+          f"{args.connections} connections, {args.duration}s per run")
+    baseline = None
+    for workers in args.workers:
+        rate = measure(args, workers)
+        baseline = baseline or rate
+        print(f"{workers:3} workers: {rate:10.0f} requests/s "
+              f"({rate / baseline:.2f}x of {args.workers[0]} worker)")
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,38 @@
+import json
+import time
+from argparse import ArgumentParser, Namespace
+
+from search_lib import write_index
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(
+        description="Write a search index file for the servers' --index.")
+    parser.add_argument('source',
+                        help="a JSON object of keys to values, or a file "
+                             "of tab-separated key and value lines")
+    parser.add_argument('index', help="the index file to write")
+    return parser.parse_args()
+
+
+def read_entries(path: str) -> dict[str, str]:
+    with open(path, encoding="utf-8") as file:
+        if path.endswith(".json"):
+            return json.load(file)
+        entries = {}
+        for line in file:
+            key, _, value = line.rstrip("\n").partition("\t")
+            entries[key] = value
+        return entries
+
+
+def main(args: Namespace) -> None:
+    start = time.perf_counter()
+    entries = read_entries(args.source)
+    write_index(args.index, entries)
+    print(f"Wrote {len(entries)} keys to {args.index} "
+          f"in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    main(parse_args())
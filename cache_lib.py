@@ -0,0 +1,126 @@
+import time
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """LRU cache of encoded responses, bounded in bytes.
+
+    Values are tuples whose first item is the bytes they are sized by.
+    With a ttl, entries older than ttl seconds are misses. invalidate()
+    drops one key, or everything when the data behind the responses
+    changes.
+
+    A key being computed can be marked with start(): callers that miss
+    it meanwhile join() the computation instead of repeating it, and
+    their callbacks get the value put() for it, or None if abandon()ed.
+    start() returns the cache's generation, which put() and abandon()
+    are given back. Invalidating everything starts a new generation: a
+    value computed from the old data still goes to the callers that
+    joined before, but isn't kept, and later callers don't join it.
+    """
+
+    # Bytes counted per entry besides the value's, for the key and links
+    ENTRY_OVERHEAD = 200
+
+    def __init__(self, max_bytes: int, ttl: float = 0) -> None:
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        # Least recently used first; values are (stored at, value)
+        self._entries: OrderedDict = OrderedDict()
+        self.generation = 0
+        # Callbacks waiting for each key being computed, by (generation,
+        # key)
+        self._pending: dict = {}
+        self.hits = 0
+        self.misses = 0
+        self.joins = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key) -> bool:
+        # Whether get() would find it; not counted as a lookup
+        entry = self._entries.get(key)
+        return entry is not None and not self._expired(entry[0])
+
+    def _expired(self, stored: float) -> bool:
+        return bool(self.ttl) and time.monotonic() - stored > self.ttl
+
+    def _entry_size(self, value) -> int:
+        return len(value[0]) + self.ENTRY_OVERHEAD
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        stored, value = entry
+        if self._expired(stored):
+            self.expirations += 1
+            self.misses += 1
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def start(self, key) -> int:
+        self._pending.setdefault((self.generation, key), [])
+        return self.generation
+
+    def join(self, key, callback) -> bool:
+        """Call callback with key's value once computed, if it's pending."""
+        waiting = self._pending.get((self.generation, key))
+        if waiting is None:
+            return False
+        waiting.append(callback)
+        self.joins += 1
+        return True
+
+    def put(self, key, value, generation: int) -> None:
+        size = self._entry_size(value)
+        # A value too big to keep, or from invalidated data, is still
+        # handed to the waiters
+        if generation == self.generation and size <= self.max_bytes // 4:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic(), value)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+        for callback in self._pending.pop((generation, key), ()):
+            callback(value)
+
+    def abandon(self, key, generation: int) -> None:
+        for callback in self._pending.pop((generation, key), ()):
+            callback(None)
+
+    def invalidate(self, key=None) -> None:
+        """Drop key's entry, or every entry if key is None."""
+        if key is None:
+            self._entries.clear()
+            self.size = 0
+            self.generation += 1
+        elif key in self._entries:
+            self._remove(key)
+
+    def _remove(self, key) -> None:
+        _, value = self._entries.pop(key)
+        self.size -= self._entry_size(value)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "joins": self.joins,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
@@ -0,0 +1,177 @@
+import itertools
+import selectors
+import threading
+from collections import deque
+from concurrent.futures import Future
+from socket import AF_INET, SOCK_STREAM, socketpair
+from socket import socket as Socket
+
+from handler_lib import MessageHandler, SocketSelector, encode_request
+from log_lib import log
+
+
+class PooledConnection(MessageHandler, SocketSelector):
+    """A keep-alive connection carrying many tagged requests at once.
+
+    Every request gets a request-id in its header; the response echoing
+    that id completes the matching future, whatever order replies come in.
+    """
+
+    __slots__ = SocketSelector.SLOTS + ("pool", "pending", "_request_ids")
+
+    def __init__(self, pool, selector, socket, label, header_format="json"):
+        MessageHandler.__init__(
+            self, socket, label, keep_alive=True,
+            header_format=header_format)
+        SocketSelector.__init__(self, selector)
+        self.pool: ClientPool = pool
+        self.pending: dict[int, Future] = {}
+        self._request_ids = itertools.count(1)
+
+    def submit(self, request: dict, future: Future):
+        # Binary headers carry the id as an unsigned 32-bit int
+        request_id = next(self._request_ids) & 0xFFFFFFFF
+        self.pending[request_id] = future
+        self.create_message(**encode_request(request), request_id=request_id)
+        self.set_selector_events_mask("rw")
+
+    def message_received(self):
+        request_id = self.json_header.get("request-id")
+        future = self.pending.pop(request_id, None)
+        if future is None:
+            raise ValueError(f"Response for unknown request-id {request_id}.")
+        content = self.content
+        if self.json_header["content-type"] != "text/json":
+            content = bytes(content)
+        future.set_result(content)
+
+    def close(self, error: Exception = None):
+        self.pool._discard(self)
+        for future in self.pending.values():
+            future.set_exception(
+                error or ConnectionAbortedError("Connection closed."))
+        self.pending.clear()
+        super().close()
+
+
+class ClientPool:
+    """Bounded pools of multiplexed connections, one pool per host:port.
+
+    request() may be called from any thread and returns a Future. The
+    connections are served by one selector loop on a background thread.
+    New requests go to the least busy connection; another connection is
+    opened only while all of them have max_in_flight requests pending
+    and there are fewer than max_connections. Servers must run with
+    keep-alive.
+    """
+
+    def __init__(self, max_connections: int = 4, max_in_flight: int = 64,
+                 header_format: str = "json") -> None:
+        self.max_connections = max_connections
+        self.max_in_flight = max_in_flight
+        self.header_format = header_format
+        self.selector = selectors.DefaultSelector()
+        self._connections: dict[tuple, list[PooledConnection]] = {}
+        self._submissions: deque = deque()
+        self._closing = False
+        # Writing a byte to _wakeup_send interrupts selector.select()
+        self._wakeup_receive, self._wakeup_send = socketpair()
+        self._wakeup_receive.setblocking(False)
+        self.selector.register(
+            self._wakeup_receive, selectors.EVENT_READ, data=None)
+        self._thread = threading.Thread(
+            target=self._run, name="client-pool", daemon=True)
+        self._thread.start()
+
+    def request(self, host: str, port: int, request: dict,
+                callback=None) -> Future:
+        """Send a request dict; the future's result is the reply content."""
+        future = Future()
+        if callback is not None:
+            future.add_done_callback(callback)
+        if self._closing:
+            raise RuntimeError("ClientPool is closed.")
+        self._submissions.append((host, port, request, future))
+        self._wakeup_send.send(b"\0")
+        return future
+
+    def close(self):
+        """Fail outstanding requests, close every connection, and stop."""
+        self._closing = True
+        self._wakeup_send.send(b"\0")
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _run(self):
+        try:
+            while not self._closing:
+                for key, actions in self.selector.select():
+                    handler = key.data
+                    if handler is None:
+                        self._dispatch()
+                        continue
+                    try:
+                        if actions & selectors.EVENT_WRITE:
+                            handler.write()
+                        if actions & selectors.EVENT_READ:
+                            handler.read()
+                    except (ValueError, TypeError, OSError) as error:
+                        log.error("Error on %s: %s", handler, error)
+                        handler.close(error)
+        finally:
+            for connections in list(self._connections.values()):
+                for connection in list(connections):
+                    connection.close()
+            while self._submissions:
+                *_, future = self._submissions.popleft()
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(
+                        RuntimeError("ClientPool is closed."))
+            self.selector.close()
+            self._wakeup_receive.close()
+            self._wakeup_send.close()
+
+    def _dispatch(self):
+        try:
+            while self._wakeup_receive.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self._submissions:
+            host, port, request, future = self._submissions.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                self._connection_for(host, port).submit(request, future)
+            except OSError as error:
+                future.set_exception(error)
+
+    def _connection_for(self, host: str, port: int) -> PooledConnection:
+        connections = self._connections.setdefault((host, port), [])
+        least_busy = min(
+            connections, key=lambda connection: len(connection.pending),
+            default=None)
+        if least_busy is not None and (
+                len(least_busy.pending) < self.max_in_flight
+                or len(connections) >= self.max_connections):
+            return least_busy
+        socket = Socket(AF_INET, SOCK_STREAM)
+        socket.setblocking(False)
+        # Requests are buffered until the connection completes
+        socket.connect_ex((host, port))
+        connection = PooledConnection(
+            self, self.selector, socket, f"{host}:{port}",
+            self.header_format)
+        connection.register()
+        connections.append(connection)
+        return connection
+
+    def _discard(self, connection: PooledConnection):
+        for connections in self._connections.values():
+            if connection in connections:
+                connections.remove(connection)
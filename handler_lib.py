@@ -1,77 +1,493 @@
 import io
 import json
+import mmap
+import os
 import selectors
 import struct
 import sys
+import time
+from collections import deque
+from socket import SOCK_DGRAM
 from socket import socket as Socket
 
+from log_lib import Truncated, log
+from metrics_lib import metrics
+from socket_lib import Endpoint
+
+
+# Shared by every empty ReceiveBuffer; the export keeps it zero-length
+EMPTY_BUFFER = bytearray()
+EMPTY_VIEW = memoryview(EMPTY_BUFFER)
+
+
+class ReceiveBuffer:
+    """Receive buffer filled in place with socket.recv_into.
+
+    Unread bytes live in data[start:end]. take() hands out memoryviews
+    into the buffer instead of copies, so once a view has been lent the
+    bytearray is never compacted or resized in place; the unread tail is
+    moved to a fresh bytearray instead, and the lent views stay valid.
+
+    The bytearray is only allocated while there are bytes to hold: an
+    empty buffer shares EMPTY_BUFFER, so idle connections cost no buffer
+    memory. Dropping it doesn't invalidate lent views, which keep their
+    bytearray alive.
+    """
+
+    __slots__ = ("_initial_size", "_data", "_view", "_start", "_end",
+                 "_lent")
+    # Buffers this large are anonymous mappings, not bytearrays: their
+    # pages are backed by memory as bytes land in them, not zero-filled
+    # up front, so room reserved for a body costs nothing until it comes
+    MAP_THRESHOLD = 2**20
+
+    def __init__(self, size: int = 16384) -> None:
+        self._initial_size = size
+        self._release()
+
+    def __len__(self) -> int:
+        return self._end - self._start
+
+    def recv_into(self, socket: Socket, min_free: int = 4096,
+                  limit: int = None, max_unread: int = None) -> int:
+        """Receive into the free space at the end of the buffer.
+
+        With a limit, at most that many bytes, with room made for all of
+        them. With max_unread, no more than makes that many unread bytes,
+        and ValueError if there are that many already. Returns the number
+        of bytes received, 0 if the peer closed.
+        """
+        if limit is not None:
+            min_free = limit
+        if max_unread is not None:
+            room = max_unread - len(self)
+            if room <= 0:
+                raise ValueError(
+                    f"Over {max_unread} bytes received and not parsed.")
+            min_free = min(min_free, room)
+            limit = room if limit is None else min(limit, room)
+        if len(self._data) - self._end < min_free:
+            self._ensure_free(min_free)
+        free = self._view[self._end:]
+        if limit is not None and limit < len(free):
+            free = free[:limit]
+        received = socket.recv_into(free)
+        self._end += received
+        return received
+
+    def write(self, data: bytes) -> None:
+        """Append bytes that were received some other way."""
+        size = len(data)
+        if len(self._data) - self._end < size:
+            self._ensure_free(size)
+        self._view[self._end:self._end + size] = data
+        self._end += size
+
+    def reserve(self, size: int) -> None:
+        """Make room for size unread bytes without further reallocation."""
+        if size > len(self):
+            self._ensure_free(size - len(self))
+
+    def unpack(self, fmt: str) -> tuple:
+        """Unpack and consume a struct from the front of the buffer."""
+        values = struct.unpack_from(fmt, self._data, self._start)
+        self._consume(struct.calcsize(fmt))
+        return values
+
+    def read_bytes(self, size: int) -> bytes:
+        """Consume size bytes as a copy, for small headers."""
+        data = self._view[self._start:self._start + size].tobytes()
+        self._consume(size)
+        return data
+
+    def take(self, size: int) -> memoryview:
+        """Consume size bytes as a view into the buffer, without copying."""
+        view = self._view[self._start:self._start + size]
+        self._start += size
+        self._lent = True
+        if self._start == self._end:
+            self._release()
+        return view
+
+    def chunk(self, size: int) -> memoryview:
+        """Consume size bytes as a short-lived view, for streaming.
+
+        Unlike take(), the view is only valid until the buffer is next
+        written to, so the buffer can go on reusing its memory.
+        """
+        view = self._view[self._start:self._start + size]
+        self._consume(size)
+        return view
+
+    def _consume(self, size: int) -> None:
+        self._start += size
+        if self._start == self._end:
+            self._release()
+
+    def _release(self) -> None:
+        self._data = EMPTY_BUFFER
+        self._view = EMPTY_VIEW
+        self._start = self._end = 0
+        self._lent = False
+
+    def _ensure_free(self, size: int) -> None:
+        if len(self._data) - self._end >= size:
+            return
+        unread = len(self)
+        required = unread + size
+        if required > len(self._data):
+            # Grow geometrically so a stream of small reads stays linear;
+            # an empty buffer starts at the default size
+            new_size = max(
+                required, 2 * len(self._data), self._initial_size)
+        elif self._lent:
+            # Lent views pin the old bytearray; start over at the default
+            # size so a buffer that grew for one large frame shrinks again
+            new_size = max(required, self._initial_size)
+        else:
+            new_size = 0
+        if new_size:
+            if new_size >= self.MAP_THRESHOLD:
+                data = mmap.mmap(-1, new_size)
+            else:
+                data = bytearray(new_size)
+            data[:unread] = self._view[self._start:self._end]
+            self._data = data
+            self._view = memoryview(data)
+        else:
+            self._view[:unread] = self._view[self._start:self._end]
+        self._start, self._end = 0, unread
+        self._lent = False
+
+
+class FileSegment:
+    """Part of an open file queued for sending with os.sendfile.
+
+    The file is closed once it has been sent, or with the connection.
+    """
+
+    __slots__ = ("file", "offset", "count")
+
+    def __init__(self, file, offset: int, count: int) -> None:
+        self.file = file
+        self.offset = offset
+        self.count = count
+
+    def __len__(self) -> int:
+        return self.count
+
+    def send(self, socket: Socket) -> int:
+        if hasattr(os, "sendfile"):
+            sent = os.sendfile(socket.fileno(), self.file.fileno(),
+                               self.offset, self.count)
+        else:
+            self.file.seek(self.offset)
+            sent = socket.send(self.file.read(min(self.count, 65536)))
+        if not sent:
+            raise ValueError(
+                f"{self.file.name} ended {self.count} bytes early.")
+        return sent
+
+    def __repr__(self):
+        return f"<{self.file.name} [{self.offset}:+{self.count}]>"
+
+
+# The out queue of every connection with nothing to send
+NO_SEGMENTS = ()
+
 
 class SocketHandler:
+    """Buffered, non-blocking sends and receives on a socket.
+
+    Mixed in with FrameParser, whose slots hold label and received. Only
+    one base of a class can lay out slots, so this one's state goes in
+    the slots of the classes mixing it in, named by SLOTS.
+    """
+
+    SLOTS = ("socket", "_out_queue", "_out_size", "_out_buffered",
+             "finished_writing")
+    __slots__ = ()
+    # Most segments passed to one sendmsg() call (writev); Linux allows
+    # 1024, a few frames' worth is enough to fill the socket buffer
+    MAX_SEGMENTS = 64
+    # Most bytes held in self.received at once; a peer that fills it
+    # without completing a frame is refused. None: no limit
+    max_received: int = None
+
     def __init__(self, socket: Socket, label: str) -> None:
         self.socket: Socket = socket
         self.label = label
-        self._out_buffer: bytes = b""
+        # memoryviews and FileSegments, sent in order without joining; a
+        # deque only while there is something to send
+        self._out_queue: deque = NO_SEGMENTS
+        self._out_size: int = 0
+        # The part of _out_size held in memory: FileSegments hold none
+        self._out_buffered: int = 0
         self.finished_writing: bool = True
-        self.received: bytes = b""
+        self.received = ReceiveBuffer()
 
     def __str__(self):
         return self.label
         
-    def buffer(self, message: bytes):
-        self._out_buffer += message
+    def buffer(self, *segments):
+        """Queue bytes-like segments to be sent in order, without copying.
+
+        The segments must not be modified until they have been sent.
+        """
+        for segment in segments:
+            if segment:
+                if self._out_queue is NO_SEGMENTS:
+                    self._out_queue = deque()
+                segment = memoryview(segment).cast("B")
+                self._out_queue.append(segment)
+                self._out_size += len(segment)
+                self._out_buffered += len(segment)
+                self.finished_writing = False
+
+    def buffer_file(self, file, offset: int = 0, count: int = None):
+        """Queue count bytes of an open binary file, from offset.
+
+        By default the rest of the file. It goes out with os.sendfile,
+        straight from the page cache, and is closed when done.
+        """
+        if count is None:
+            count = os.fstat(file.fileno()).st_size - offset
+        if count <= 0:
+            file.close()
+            return
+        if self._out_queue is NO_SEGMENTS:
+            self._out_queue = deque()
+        self._out_queue.append(FileSegment(file, offset, count))
+        self._out_size += count
         self.finished_writing = False
 
     def write(self):
         if not self.finished_writing:
-            print(f"Sending {self._out_buffer!r} to {self}")
+            head = self._out_queue[0]
+            log.debug("Sending %r to %s", Truncated(head), self)
             try:
-                sent = self.socket.send(self._out_buffer)
-                self._out_buffer = self._out_buffer[sent:]
+                if isinstance(head, FileSegment):
+                    sent = head.send(self.socket)
+                elif len(self._out_queue) == 1:
+                    sent = self.socket.send(head)
+                else:
+                    sent = self._send_segments()
+                if metrics.enabled:
+                    metrics.out_buffer_depth.record(self._out_size)
+                    metrics.bytes_out += sent
+                self._advance(sent)
             except BlockingIOError:
                 # Resource temporarily unavailable (errno EWOULDBLOCK)
                 pass
-            if not self._out_buffer:
+            if not self._out_queue:
+                self._out_queue = NO_SEGMENTS
                 self.finished_writing = True
 
-    def read(self):
+    def _send_segments(self) -> int:
+        segments = []
+        for segment in self._out_queue:
+            if (isinstance(segment, FileSegment)
+                    or len(segments) == self.MAX_SEGMENTS):
+                break
+            segments.append(segment)
+        if len(segments) == 1 or not hasattr(self.socket, "sendmsg"):
+            return self.socket.send(segments[0])
+        return self.socket.sendmsg(segments)
+
+    def _advance(self, sent: int):
+        """Drop sent bytes from the front of the out queue."""
+        self._out_size -= sent
+        queue = self._out_queue
+        while sent:
+            head = queue[0]
+            in_file = isinstance(head, FileSegment)
+            if not in_file:
+                self._out_buffered -= min(sent, len(head))
+            if sent < len(head):
+                if in_file:
+                    head.offset += sent
+                    head.count -= sent
+                else:
+                    queue[0] = head[sent:]
+                return
+            sent -= len(head)
+            queue.popleft()
+            if in_file:
+                head.file.close()
+
+    def read(self, size: int = None) -> int:
+        """Receive what the socket has, or at most size bytes; how many."""
         try:
-            if (data := self.socket.recv(4096)):
-                self.received += data
-            else:
-                raise ConnectionAbortedError("Peer closed.")
+            received = self.received.recv_into(
+                self.socket, limit=size, max_unread=self.max_received)
         except BlockingIOError:
             # Resource temporarily unavailable (errno EWOULDBLOCK)
-            pass
+            return 0
+        if not received:
+            self.peer_closed()
+            return 0
+        if metrics.enabled:
+            metrics.bytes_in += received
+        return received
+
+    def peer_closed(self):
+        """Called when a read finds the peer has closed; an error here."""
+        raise ConnectionAbortedError("Peer closed.")
 
     def close(self):
-        print(f"Closing connection to {self}")
+        log.info("Closing connection to %s", self)
         try:
             self.socket.close()
         except OSError as error:
-            print(
-                f"Error: socket.close() exception for {self}: {error!r}")
+            log.error("socket.close() exception for %s: %r", self, error)
         finally:
             # Delete reference to socket object for garbage collection
             self.socket = None
+            for segment in self._out_queue:
+                if isinstance(segment, FileSegment):
+                    segment.file.close()
+            self._out_queue = NO_SEGMENTS
+            self._out_size = self._out_buffered = 0
+            self.finished_writing = True
+
+
+class BufferBudget:
+    """A limit on the bytes held in memory to send across connections.
+
+    Connections stop reading while the total is over limit, and wait()
+    to be called back once it has fallen to three quarters of it.
+    """
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.resume_below = limit * 3 // 4
+        self.used = 0
+        self._over = False
+        # Callbacks of the connections waiting for room, by connection
+        self._waiting: dict = {}
+
+    def over(self) -> bool:
+        if self.used > self.limit:
+            self._over = True
+        elif self.used <= self.resume_below:
+            self._over = False
+        return self._over
+
+    def wait(self, connection, callback) -> None:
+        self._waiting[connection] = callback
+
+    def forget(self, connection) -> None:
+        self._waiting.pop(connection, None)
+
+    def release(self, size: int) -> None:
+        self.used -= size
+        if self._waiting and not self.over():
+            waiting, self._waiting = self._waiting, {}
+            for callback in waiting.values():
+                callback()
 
 
 class SocketSelector(SocketHandler):
-    def __init__(self, selector, socket, label) -> None:
-        SocketHandler.__init__(self, socket, label)
+    """A SocketHandler whose events are dispatched by a selector.
+
+    An idle socket is always writable, so EVENT_WRITE is only selected
+    while the out queue holds data: write() adds it when a send leaves
+    data behind, and drops it once the queue is empty. The registered
+    events are tracked, so unchanged masks cost no selector.modify().
+
+    With a high_watermark, EVENT_READ is dropped while more than that
+    many bytes are held in memory to send, until they are down to
+    low_watermark, so a peer that doesn't read can't make the queue
+    grow without bound. With a budget, reading also stops while all the
+    connections sharing it hold more than its limit. Queued files don't
+    count: sendfile() sends them from the page cache.
+
+    Like SocketHandler's, its state goes in the slots named by SLOTS, and
+    __init__() only sets that up: it follows SocketHandler.__init__().
+    """
+
+    SLOTS = ("selector", "_events", "_registered", "_read_paused",
+             "_reading_held")
+    __slots__ = ()
+    high_watermark: int = None
+    low_watermark: int = None
+    budget: BufferBudget = None
+
+    def __init__(self, selector) -> None:
         self.selector: selectors.BaseSelector = selector
-        
+        # The events registered with the selector
+        self._events: int = 0
+        self._registered: bool = False
+        # Whether EVENT_READ was dropped, for backpressure or a hold
+        self._read_paused: bool = False
+        self._reading_held: bool = False
+
     def register(self):
+        events = selectors.EVENT_READ
+        if not self.finished_writing:
+            events |= selectors.EVENT_WRITE
         try:
-            self.selector.register(
-                self.socket,
-                events=selectors.EVENT_READ | selectors.EVENT_WRITE,
-                data=self)
+            self.selector.register(self.socket, events=events, data=self)
+            self._events = events
+            self._registered = True
         except Exception as error:
-            print(
-                f"Error: selector.register() exception for {self}: {error!r}"
-            )
+            log.error(
+                "selector.register() exception for %s: %r", self, error)
 
         self.socket.setblocking(False)
+        self._apply_backpressure()
+
+    def buffer(self, *segments):
+        buffered = self._out_buffered
+        super().buffer(*segments)
+        if self.budget is not None:
+            self.budget.used += self._out_buffered - buffered
+        if self._registered:
+            self._apply_backpressure()
+
+    def write(self):
+        buffered = self._out_buffered
+        super().write()
+        if self.budget is not None:
+            self.budget.release(buffered - self._out_buffered)
+        self._apply_backpressure()
+        if self.finished_writing:
+            # Leave a write-only mask alone: the handler is about to close
+            if self._events & ~selectors.EVENT_WRITE or self._read_paused:
+                self._set_events(self._events & ~selectors.EVENT_WRITE)
+        elif self.socket:
+            self._set_events(self._events | selectors.EVENT_WRITE)
+
+    def hold_reading(self, held: bool):
+        """Drop EVENT_READ, whatever the queue, until released with False."""
+        self._reading_held = held
+        self._apply_backpressure()
+
+    def _apply_backpressure(self):
+        if not self.socket or (
+                self.high_watermark is None and self.budget is None
+                and not self._reading_held and not self._read_paused):
+            return
+        over_budget = self.budget is not None and self.budget.over()
+        if self._read_paused:
+            limit = self.low_watermark
+        else:
+            limit = self.high_watermark
+        backlogged = over_budget or (
+            limit is not None and self._out_buffered > limit)
+        paused = backlogged or self._reading_held
+        if paused and not self._read_paused:
+            if self._events & selectors.EVENT_READ:
+                self._read_paused = True
+                if metrics.enabled and backlogged:
+                    metrics.read_pauses += 1
+                self._set_events(self._events & ~selectors.EVENT_READ)
+        elif not paused and self._read_paused:
+            self._read_paused = False
+            self._set_events(self._events | selectors.EVENT_READ)
+        if self._read_paused and self.budget is not None:
+            # Called back when the other connections free some budget
+            self.budget.wait(self, self._apply_backpressure)
 
     def set_selector_events_mask(self, mode: str):
         """Set selector to listen for events.
@@ -86,16 +502,35 @@ class SocketSelector(SocketHandler):
             events = selectors.EVENT_READ | selectors.EVENT_WRITE
         else:
             raise ValueError(f"Invalid events mask mode {mode!r}.")
-        self.selector.modify(self.socket, events, data=self)
+        if self._read_paused:
+            events &= ~selectors.EVENT_READ
+        self._set_events(events)
+
+    def _set_events(self, events: int):
+        if events == self._events:
+            return
+        # A paused connection with nothing to send selects nothing at all
+        if not events:
+            self.selector.unregister(self.socket)
+        elif not self._events:
+            self.selector.register(self.socket, events, data=self)
+        else:
+            self.selector.modify(self.socket, events, data=self)
+        self._events = events
 
     def close(self):
+        if self.budget is not None:
+            self.budget.forget(self)
+            self.budget.release(self._out_buffered)
         try:
-            self.selector.unregister(self.socket)
+            if self._events:
+                self.selector.unregister(self.socket)
         except Exception as error:
-            print(
-                f"Error: selector.unregister() exception for {self}: {error!r}"
-            )
+            log.error(
+                "selector.unregister() exception for %s: %r", self, error)
         finally:
+            self._events = 0
+            self._registered = False
             super().close()
 
 
@@ -103,207 +538,650 @@ def json_encode(obj, encoding: str) -> bytes:
     return json.dumps(obj, ensure_ascii=False).encode(encoding)
 
 def json_decode(json_bytes: bytes, encoding: str) -> dict:
-    wrapper = io.TextIOWrapper(
-        io.BytesIO(json_bytes), encoding=encoding, newline=""
-    )
-    decoded_jason = json.load(wrapper)
-    wrapper.close()
+    try:
+        wrapper = io.TextIOWrapper(
+            io.BytesIO(json_bytes), encoding=encoding, newline=""
+        )
+    except LookupError:
+        # The encoding comes from the peer's header
+        raise ValueError(f"Unknown encoding {encoding!r}.") from None
+    try:
+        decoded_jason = json.load(wrapper)
+    except RecursionError:
+        raise ValueError("JSON nested too deeply.") from None
+    finally:
+        wrapper.close()
     return decoded_jason
 
-class MessageHandler(SocketHandler):
-    def __init__(self, socket, label) -> None:
-        SocketHandler.__init__(self, socket, label)
+# A protoheader of 0xFFnn announces a fixed-layout binary header, version
+# nn, in place of a JSON header that long. JSON headers never get that big.
+BINARY_HEADER_MAGIC = 0xFF00
+# A binary header content-length with every bit set announces a chunked
+# body, like "transfer-encoding": "chunked" in a JSON header
+BINARY_CHUNKED_LENGTH = 2**64 - 1
+# Each chunk of a chunked body follows its length; length 0 ends the body
+CHUNK_PREFIX = struct.Struct(">I")
+# The largest UDP payload over IPv4: requests and responses that don't
+# fit in a datagram go over TCP
+MAX_DATAGRAM = 65507
+# The protoheader and the longest header after it
+MAX_HEADER_SIZE = 2 + 0xFFFF
+BINARY_HEADERS = {
+    # byteorder, content-type and content-encoding codes, content-length
+    1: struct.Struct(">BBBQ"),
+    # version 1 followed by a request-id
+    2: struct.Struct(">BBBQI"),
+}
+BYTEORDERS = ("little", "big")
+CONTENT_TYPES = (
+    "text/json",
+    "binary/custom-client-binary-type",
+    "binary/custom-server-binary-type",
+)
+CONTENT_ENCODINGS = ("utf-8", "binary", "shared-memory")
+# A binary body handed over in a shared memory segment: the frame
+# carries a shm_lib descriptor naming it instead of the body
+SHARED_MEMORY = "shared-memory"
+BINARY_PROTOHEADERS = {
+    version: struct.pack(">H", BINARY_HEADER_MAGIC | version)
+    for version in BINARY_HEADERS
+}
+BYTEORDER_CODES = {name: code for code, name in enumerate(BYTEORDERS)}
+CONTENT_TYPE_CODES = {name: code for code, name in enumerate(CONTENT_TYPES)}
+CONTENT_ENCODING_CODES = {
+    name: code for code, name in enumerate(CONTENT_ENCODINGS)}
+
+
+def encode_header(content_length: int, content_type, content_encoding,
+                  header_format: str = "json",
+                  request_id: int = None) -> bytes:
+    """The protoheader and header that go before content_length bytes.
+
+    header_format "binary" packs the header with BINARY_HEADERS, falling
+    back to JSON for a type or encoding that has no code. A request_id
+    lets a client match responses that come back out of order. A
+    content_length of None announces a chunked body.
+    """
+    if (header_format == "binary"
+            and content_type in CONTENT_TYPE_CODES
+            and content_encoding in CONTENT_ENCODING_CODES):
+        fields = [
+            BYTEORDER_CODES[sys.byteorder],
+            CONTENT_TYPE_CODES[content_type],
+            CONTENT_ENCODING_CODES[content_encoding],
+            BINARY_CHUNKED_LENGTH if content_length is None
+            else content_length,
+        ]
+        version = 1
+        if request_id is not None:
+            fields.append(request_id)
+            version = 2
+        return (BINARY_PROTOHEADERS[version]
+                + BINARY_HEADERS[version].pack(*fields))
+    json_header = {
+        "byteorder": sys.byteorder,
+        "content-type": content_type,
+        "content-encoding": content_encoding,
+    }
+    if content_length is None:
+        json_header["transfer-encoding"] = "chunked"
+    else:
+        json_header["content-length"] = content_length
+    if request_id is not None:
+        json_header["request-id"] = request_id
+    json_header_bytes = json_encode(json_header, "utf-8")
+    message_header = struct.pack(">H", len(json_header_bytes))
+    return message_header + json_header_bytes
+
+def encode_message(content_bytes, content_type, content_encoding,
+                   header_format: str = "json",
+                   request_id: int = None) -> bytes:
+    """Frame content: protoheader, header, then the content."""
+    return encode_header(
+        len(content_bytes), content_type, content_encoding, header_format,
+        request_id) + content_bytes
+
+def encode_chunk(chunk) -> bytes:
+    """The prefix that goes before one chunk of a chunked body."""
+    return CHUNK_PREFIX.pack(len(chunk))
+
+def encode_request(request: dict) -> dict:
+    """Turn a request dict into create_message() arguments.
+
+    A request with a "file" instead of "content" gives the arguments of
+    create_file_message().
+    """
+    content_type = request["type"]
+    content_encoding = request["encoding"]
+    if "file" in request:
+        return {
+            "content_file": request["file"],
+            "content_type": content_type,
+            "content_encoding": content_encoding,
+        }
+    content = request["content"]
+    if content_type == "text/json":
+        content_bytes = json_encode(content, content_encoding)
+    else:
+        content_bytes = content
+    return {
+        "content_bytes": content_bytes,
+        "content_type": content_type,
+        "content_encoding": content_encoding,
+    }
+
+# Actions the server answers from a JSON request; anything else is sent
+# as binary content
+JSON_ACTIONS = ("search", "batch_search", "stats", "fetch")
+
+def create_request(action: str, value: str, **fields) -> dict:
+    """A request for action on value; JSON actions carry extra fields."""
+    if action in JSON_ACTIONS:
+        return {
+            "type": "text/json",
+            "encoding": "utf-8",
+            "content": {"action": action, "value": value, **fields},
+        }
+    else:
+        return {
+            "type": "binary/custom-client-binary-type",
+            "encoding": "binary",
+            "content": (action + value).encode(),
+        }
+
+
+class FrameParser:
+    """Sans-IO parser for the length-prefixed JSON-header wire format.
+
+    Bytes go in through feed() or straight into self.received, and each
+    complete frame is passed to message_received(). It does no I/O, so the
+    selector handlers and the asyncio protocols share it.
+
+    Bodies are either content-length bytes or, with "transfer-encoding":
+    "chunked", length-prefixed chunks ending with an empty one. With a
+    chunk_size, binary bodies are not buffered: they go to content_chunk()
+    in pieces of at most chunk_size bytes as they arrive, and self.content
+    becomes whatever content_done() returns.
+
+    A binary body with content-encoding "shared-memory" is a descriptor of
+    a segment holding the real body, which self.content becomes a read-only
+    view of. Peers on the same host can send large bodies that way without
+    pushing them through the socket, if shared_memory is enabled.
+
+    Connections are many and mostly idle, so the handler classes keep
+    their state in __slots__ rather than a dict per instance. This is the
+    one base laying out slots; the mixins have none of their own.
+    """
+
+    __slots__ = ("label", "received", "keep_alive", "header_format",
+                 "_json_header_len", "_binary_header", "json_header",
+                 "content", "_phase_started", "_streaming", "_body_left",
+                 "_body")
+    # Stream binary bodies in pieces of at most this many bytes; None
+    # buffers every body whole
+    chunk_size: int = None
+    # Read the segments of shared memory bodies; off, they are refused
+    shared_memory: bool = False
+    # Refuse bodies over this many bytes that would be buffered whole;
+    # streamed ones never are
+    max_frame_size: int = 2**30
+
+    def __init__(self, label: str = "", keep_alive: bool = False,
+                 header_format: str = "json") -> None:
+        self.label = label
+        self.received = ReceiveBuffer()
+        # With keep_alive, one connection carries any number of frames
+        self.keep_alive: bool = keep_alive
+        # "json" or "binary"; set to the peer's format by each frame read
+        self.header_format: str = header_format
+        self.reset()
+
+    def __str__(self):
+        return self.label
+
+    def reset(self):
+        """Clear the per-message state, ready to parse the next frame."""
         self._json_header_len: int = None
         self.json_header: dict = None
-        self.content: bytes = None
-
-    def create_message(self, content_bytes, content_type, content_encoding):
-        json_header = {
-            "byteorder": sys.byteorder,
-            "content-type": content_type,
-            "content-encoding": content_encoding,
-            "content-length": len(content_bytes),
-        }
-        json_header_bytes = json_encode(json_header, "utf-8")
-        message_header = struct.pack(">H", len(json_header_bytes))
-        message = message_header + json_header_bytes + content_bytes
-        self.buffer(message)
+        self.content: memoryview = None
+        self._phase_started: float = None
+        self._streaming: bool = False
+        # Body bytes left to read, or left in the current chunk
+        self._body_left: int = 0
+        # A chunked body being buffered whole
+        self._body: bytearray = None
 
-    def read(self):
-        super().read()
+    def feed(self, data: bytes):
+        self.received.write(data)
+        while self._process_frame():
+            self.message_received()
+            if not self.keep_alive:
+                break
+            self.reset()
+
+    def parse_datagram(self, datagram: bytes):
+        """Parse a datagram, which must hold one whole frame and no more.
+
+        Unlike feed(), it doesn't call message_received(), and nothing is
+        left over for the next datagram.
+        """
+        self.reset()
+        self.received.write(datagram)
+        try:
+            if not self._process_frame() or len(self.received):
+                raise ValueError("A datagram must hold exactly one frame.")
+        finally:
+            self.received.take(len(self.received))
+
+    def _process_frame(self) -> bool:
+        """Parse what has been received; True once a frame completes."""
+        if (metrics.enabled and self._phase_started is None
+                and len(self.received)):
+            self._phase_started = time.perf_counter()
         if self._json_header_len is None:
             self._process_protoheader()
+            if metrics.enabled and self._json_header_len is not None:
+                self._phase_done("protoheader")
         if self._json_header_len:
             if self.json_header is None:
                 self._process_json_header()
+                if metrics.enabled and self.json_header is not None:
+                    self._phase_done("header")
             if self.json_header:
                 if self.content is None:
                     self._process_content()
-                if self.content:
-                    self.decode_content()
+                    if self.content is not None:
+                        if metrics.enabled:
+                            self._phase_done("content")
+                            metrics.frames_parsed += 1
+                        self.decode_content()
+                        return True
+        return False
+
+    def _phase_done(self, phase: str):
+        now = time.perf_counter()
+        metrics.phases[phase].record(now - (self._phase_started or now))
+        self._phase_started = now
+
+    def message_received(self):
+        """Handle the complete frame in self.content. Override this."""
+
+    def content_chunk(self, chunk: memoryview):
+        """Handle the next piece of a streamed body. Override this.
+
+        chunk is only valid during the call; copy what must be kept.
+        """
+
+    def content_done(self):
+        """The self.content of a streamed body, once it has all arrived."""
+        return b""
 
     def _process_protoheader(self):
         header_length = 2
         if len(self.received) >= header_length:
-            self._json_header_len = struct.unpack(
-                ">H", self.received[:header_length]
-            )[0]
-            self.received = self.received[header_length:]
+            protoheader = self.received.unpack(">H")[0]
+            if protoheader & 0xFF00 == BINARY_HEADER_MAGIC:
+                version = protoheader & 0xFF
+                if version not in BINARY_HEADERS:
+                    raise ValueError(
+                        f"Unsupported binary header version {version}.")
+                self.header_format = "binary"
+                self._binary_header = BINARY_HEADERS[version]
+                self._json_header_len = self._binary_header.size
+            else:
+                self.header_format = "json"
+                self._json_header_len = protoheader
 
     def _process_json_header(self):
         header_length = self._json_header_len
         if len(self.received) >= header_length:
-            self.json_header = json_decode(
-                self.received[:header_length], "utf-8"
-            )
-            self.received = self.received[header_length:]
+            if self.header_format == "binary":
+                self.json_header = self._decode_binary_header()
+            else:
+                self.json_header = json_decode(
+                    self.received.read_bytes(header_length), "utf-8"
+                )
+                if not isinstance(self.json_header, dict):
+                    raise ValueError("Header is not a JSON object.")
+            chunked = (
+                self.json_header.get("transfer-encoding") == "chunked")
             for required_header in (
                 "byteorder",
-                "content-length",
                 "content-type",
                 "content-encoding",
-            ):
+            ) + (() if chunked else ("content-length",)):
                 if required_header not in self.json_header:
                     raise ValueError(
                         f"Missing required header '{required_header}'.")
+            shared = self.json_header["content-encoding"] == SHARED_MEMORY
+            if shared and (not self.shared_memory or self.json_header[
+                    "content-type"] == "text/json"):
+                raise ValueError("Shared memory content not accepted.")
+            # Descriptors are tiny: only the bodies they name are big
+            self._streaming = (
+                self.chunk_size is not None and not shared
+                and self.json_header["content-type"] != "text/json")
+            if chunked:
+                self._body_left = 0
+                if not self._streaming:
+                    self._body = bytearray()
+            else:
+                content_length = self.json_header["content-length"]
+                if not isinstance(content_length, int) or content_length < 0:
+                    raise ValueError(
+                        f"Invalid content-length {content_length!r}.")
+                self._body_left = content_length
+                if not self._streaming:
+                    self._check_frame_size(content_length)
+                    # Let the whole body land contiguously in one
+                    # allocation. The length is only the peer's claim,
+                    # but a large buffer takes memory as bytes arrive.
+                    try:
+                        self.received.reserve(content_length)
+                    except (MemoryError, OSError):
+                        raise ValueError(
+                            f"No memory for a {content_length} byte "
+                            f"body.") from None
+
+    def _check_frame_size(self, size: int):
+        if size > self.max_frame_size:
+            raise ValueError(f"A {size} byte body is over the "
+                             f"{self.max_frame_size} byte limit.")
+
+    def _decode_binary_header(self) -> dict:
+        byteorder, content_type, content_encoding, content_length, *rest = (
+            self.received.unpack(self._binary_header.format))
+        try:
+            header = {
+                "byteorder": BYTEORDERS[byteorder],
+                "content-type": CONTENT_TYPES[content_type],
+                "content-encoding": CONTENT_ENCODINGS[content_encoding],
+            }
+        except IndexError:
+            raise ValueError("Unknown code in binary header.") from None
+        if content_length == BINARY_CHUNKED_LENGTH:
+            header["transfer-encoding"] = "chunked"
+        else:
+            header["content-length"] = content_length
+        if rest:
+            header["request-id"] = rest[0]
+        return header
 
     def _process_content(self):
-        content_len = self.json_header["content-length"]
-        if len(self.received) >= content_len:
-            self.content = self.received[:content_len]
-            self.received = self.received[content_len:]
+        if self._body is None and not self._streaming:
+            content_len = self._body_left
+            if len(self.received) >= content_len:
+                # A view into the receive buffer, not a copy
+                self.content = self.received.take(content_len)
+            return
+        chunked = self.json_header.get("transfer-encoding") == "chunked"
+        while self.content is None:
+            if not self._body_left:
+                if chunked and len(self.received) < CHUNK_PREFIX.size:
+                    return
+                if chunked:
+                    self._body_left = self.received.unpack(
+                        CHUNK_PREFIX.format)[0]
+                    if not self._streaming:
+                        self._check_frame_size(
+                            len(self._body) + self._body_left)
+                if not self._body_left:
+                    # Every byte, or the empty last chunk, has arrived
+                    if self._streaming:
+                        self.content = self.content_done()
+                    else:
+                        self.content = self._body
+                    return
+                if self._streaming:
+                    # Room for a whole piece, and no more
+                    self.received.reserve(
+                        min(self._body_left, self.chunk_size))
+            size = min(len(self.received), self._body_left)
+            if self._streaming:
+                size = min(size, self.chunk_size)
+            if not size:
+                return
+            chunk = self.received.chunk(size)
+            self._body_left -= size
+            if self._streaming:
+                self.content_chunk(chunk)
+            else:
+                self._body += chunk
 
     def decode_content(self):
         if self.json_header["content-type"] == "text/json":
             encoding = self.json_header["content-encoding"]
             self.content = json_decode(self.content, encoding)
-            print(f"Received {self.content!r} from {self}")
+            log.debug("Received %r from %s", Truncated(self.content), self)
         else:
             # Binary or unknown content-type
-            print(
-                f"Received {self.json_header['content-type']} from {self}"
-            )
+            if self.json_header["content-encoding"] == SHARED_MEMORY:
+                from shm_lib import read_segment
+                self.content = read_segment(
+                    self.content, self.max_frame_size)
+            log.debug("Received %s from %s",
+                      self.json_header["content-type"], self)
 
 
-class ClientHandler(MessageHandler, SocketSelector):
-    def __init__(self, selector, socket, label, request):
-        MessageHandler.__init__(self, socket, label)
-        SocketSelector.__init__(self, selector, socket, label)
-        self.request: dict = request
-        self._request_queued: bool = False
+class MessageHandler(FrameParser, SocketHandler):
+    __slots__ = SocketHandler.SLOTS + ("parsing_held", "_segments")
+    # Content smaller than this is copied onto its header, since one
+    # small segment is cheaper to queue and send than two
+    COPY_THRESHOLD = 16384
 
-    def register(self):
-        self.selector.register(
-            self.socket,
-            events=selectors.EVENT_WRITE,
-            data=self)
-        self.socket.setblocking(False)
+    def __init__(self, socket, label, keep_alive: bool = False,
+                 header_format: str = "json") -> None:
+        SocketHandler.__init__(self, socket, label)
+        self.keep_alive: bool = keep_alive
+        self.header_format: str = header_format
+        # While True, received frames wait in self.received unparsed
+        self.parsing_held: bool = False
+        # Names of the shared memory segments sent, oldest first
+        self._segments: deque = NO_SEGMENTS
+        self.reset()
 
-    def queue_request(self):
-        content = self.request["content"]
-        content_type = self.request["type"]
-        content_encoding = self.request["encoding"]
-        if content_type == "text/json":
-            content_bytes = json_encode(content, content_encoding)
+    def create_message(self, content_bytes, content_type, content_encoding,
+                       request_id=None):
+        if content_encoding == SHARED_MEMORY:
+            content_bytes = self._share(content_bytes)
+        # Servers answer in the header format the request came in
+        header = encode_header(
+            len(content_bytes), content_type, content_encoding,
+            self.header_format, request_id)
+        if len(content_bytes) < self.COPY_THRESHOLD:
+            self.buffer(header + content_bytes)
         else:
-            content_bytes = content
-        self.create_message(
-            content_bytes, content_type, content_encoding)
-        self._request_queued = True
+            # Large content is queued as its own segment, never copied
+            self.buffer(header, content_bytes)
 
-    def write(self):
-        if not self._request_queued:
-            self.queue_request()
-        super().write()
-        if self.finished_writing:
-            self.set_selector_events_mask("r")
+    def send_frame(self, frame: bytes):
+        """Send a message encoded beforehand, header and all."""
+        self.buffer(frame)
+
+    def create_file_message(self, content_file, content_type,
+                            content_encoding, request_id=None):
+        """Send the rest of an open binary file as the content."""
+        if content_encoding == SHARED_MEMORY:
+            with content_file:
+                descriptor = self._share(content_file)
+            self.buffer(encode_header(
+                len(descriptor), content_type, content_encoding,
+                self.header_format, request_id) + descriptor)
+            return
+        content_length = (os.fstat(content_file.fileno()).st_size
+                          - content_file.tell())
+        self.buffer(encode_header(
+            content_length, content_type, content_encoding,
+            self.header_format, request_id))
+        self.buffer_file(content_file, content_file.tell(), content_length)
+
+    def create_chunked_message(self, chunks, content_type, content_encoding,
+                               request_id=None):
+        """Send an iterable of bytes-like chunks as a chunked body."""
+        self.buffer(encode_header(
+            None, content_type, content_encoding, self.header_format,
+            request_id))
+        for chunk in chunks:
+            if chunk:
+                self.buffer(encode_chunk(chunk), chunk)
+        self.buffer(encode_chunk(b""))
+
+    def _share(self, content) -> bytes:
+        """Put content in a shared memory segment; the descriptor to send.
+
+        The peer removes the segment's name as it reads it, and the names it
+        never got to are removed on close, so a segment outlives neither.
+        Only a killed process leaves some: shm_lib.remove_orphans().
+        """
+        from shm_lib import create_segment, segment_exists
+        segments = self._segments
+        # The peer reads segments in the order they were sent: forget the
+        # ones it is done with
+        while segments and not segment_exists(segments[0]):
+            segments.popleft()
+        if segments is NO_SEGMENTS:
+            self._segments = segments = deque()
+        name, descriptor = create_segment(content)
+        segments.append(name)
+        return descriptor
 
     def read(self):
-        super().read()
-        if self.content:
-            # the full message has been read
-            if self.json_header["content-type"] == "text/json":
-                self._process_response_json_content()
+        SocketHandler.read(self)
+        self.process_received()
+
+    def process_received(self, frames: int = None) -> bool:
+        """Handle the frames received, or at most frames of them.
+
+        True if that left bytes unparsed, which may hold whole frames.
+        """
+        # Pipelined peers may have sent several frames in one read
+        while (self.socket and not self.parsing_held
+               and self._process_frame()):
+            self.message_received()
+            if not self.keep_alive:
+                break
+            self.reset()
+            if frames is not None:
+                frames -= 1
+                if not frames:
+                    return bool(self.socket and len(self.received))
+        return False
+
+    def close(self):
+        if self._segments:
+            from shm_lib import remove_segment
+            for name in self._segments:
+                remove_segment(name)
+        self._segments = NO_SEGMENTS
+        super().close()
+
+
+class ClientHandler(MessageHandler, SocketSelector):
+    __slots__ = SocketSelector.SLOTS + ("requests", "_replies_pending")
+
+    def __init__(self, selector, socket, label, *requests,
+                 keep_alive=False, header_format="json"):
+        MessageHandler.__init__(
+            self, socket, label, keep_alive, header_format)
+        SocketSelector.__init__(self, selector)
+        self.requests: list[dict] = list(requests)
+        self._replies_pending: int = 0
+
+    def register(self):
+        # Queued first, so the socket is registered for EVENT_WRITE too
+        self.queue_request()
+        super().register()
+
+    def queue_request(self):
+        # Without keep-alive the server answers one request per connection
+        requests = self.requests if self.keep_alive else self.requests[:1]
+        for request in requests:
+            message = encode_request(request)
+            if "content_file" in message:
+                self.create_file_message(**message)
             else:
-                self._process_response_binary_content()
+                self.create_message(**message)
+        # All requests go out before any reply is read (pipelining)
+        self._replies_pending = len(requests)
+
+    def message_received(self):
+        if self.json_header["content-type"] == "text/json":
+            self._process_response_json_content()
+        else:
+            self._process_response_binary_content()
+        self._replies_pending -= 1
+        if not self._replies_pending:
             self.close()
 
     def _process_response_json_content(self):
         content = self.content
         result = content.get("result")
-        print(f"Got result: {result}")
+        log.info("Got result: %s", Truncated(result, 1000))
 
     def _process_response_binary_content(self):
         content = self.content
-        print(f"Got response: {content!r}")
-
+        log.info("Got response: %r", Truncated(content, 1000))
 
-request_search = {
-    "morpheus": "Follow the white rabbit. \U0001f430",
-    "ring": "In the caves beneath the Misty Mountains. \U0001f48d",
-    "\U0001f436": "\U0001f43e Playing ball! \U0001f3d0",
-}
 
+class DatagramClient:
+    """Sends requests to a server's UDP socket, one datagram each.
 
-class ServerHandler(MessageHandler, SocketSelector):
-    def __init__(self, selector, socket, label) -> None:
-        MessageHandler.__init__(self, socket, label)
-        SocketSelector.__init__(self, selector, socket, label)
-        self._response_created: bool = False
+    There is no connection to set up, so a lookup costs one round trip. A
+    request with no response within timeout seconds is sent again, up to
+    retries more times. Each request gets its own request-id, so a late
+    response to an earlier one is told apart and ignored.
+    """
 
-    def register(self):
-        self.selector.register(
-            self.socket,
-            events=selectors.EVENT_READ,
-            data=self)
-        self.socket.setblocking(False)
+    def __init__(self, endpoint: Endpoint, timeout: float = 1.0,
+                 retries: int = 3, header_format: str = "json") -> None:
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self.retries = retries
+        self.header_format = header_format
+        self.socket = Socket(endpoint.family, SOCK_DGRAM)
+        # Connected, so only the server's datagrams come in
+        self.socket.connect(endpoint.address)
+        self._parser = FrameParser(str(endpoint))
+        self._request_id = 0
 
-    def read(self):
-        super().read()
-        if self.content:
-            # the full message has been read
-            self.set_selector_events_mask("w")
+    def request(self, request: dict):
+        """The content of the response to a request dict."""
+        message = encode_request(request)
+        if "content_file" in message:
+            raise ValueError("Files are not sent in datagrams.")
+        self._request_id = (self._request_id + 1) % 2**32
+        frame = encode_message(
+            **message, header_format=self.header_format,
+            request_id=self._request_id)
+        if len(frame) > MAX_DATAGRAM:
+            raise ValueError(
+                f"A {len(frame)} byte request doesn't fit in a datagram.")
+        for attempt in range(1, self.retries + 2):
+            self.socket.send(frame)
+            deadline = time.monotonic() + self.timeout
+            while (left := deadline - time.monotonic()) > 0:
+                self.socket.settimeout(left)
+                try:
+                    datagram = self.socket.recv(MAX_DATAGRAM)
+                except TimeoutError:
+                    break
+                try:
+                    self._parser.parse_datagram(datagram)
+                except ValueError as error:
+                    log.warning("Ignored datagram from %s: %s",
+                                self._parser, error)
+                    continue
+                header = self._parser.json_header
+                if header.get("request-id") != self._request_id:
+                    continue
+                if header["content-type"] == "text/json":
+                    return self._parser.content
+                return bytes(self._parser.content)
+            log.debug("No response from %s to attempt %s",
+                      self.endpoint, attempt)
+        raise TimeoutError(f"No response from {self.endpoint} after "
+                           f"{self.retries + 1} attempts.")
 
-    def create_response(self):
-        if self.json_header["content-type"] == "text/json":
-            response = self._create_response_json_content()
-        else:
-            # Binary or unknown content-type
-            response = self._create_response_binary_content()
-        self.create_message(**response)
-        self._response_created = True
-
-    def _create_response_json_content(self):
-        action = self.content.get("action")
-        if action == "search":
-            query = self.content.get("value")
-            answer = request_search.get(query) or f"No match for '{query}'."
-            content = {"result": answer}
-        else:
-            content = {"result": f"Error: invalid action '{action}'."}
-        content_encoding = "utf-8"
-        response = {
-            "content_bytes": json_encode(content, content_encoding),
-            "content_type": "text/json",
-            "content_encoding": content_encoding,
-        }
-        return response
-
-    def _create_response_binary_content(self):
-        response = {
-            "content_bytes": b"First 10 bytes of request: "
-            + self.content[:10],
-            "content_type": "binary/custom-server-binary-type",
-            "content_encoding": "binary",
-        }
-        return response
+    def close(self):
+        self.socket.close()
 
-    def write(self):
-        if self.content:
-            # the full message has been read
-            if not self._response_created:
-                self.create_response()
-        super().write()
-        if self._response_created:
-            if self.finished_writing:
-                self.close()
@@ -1,27 +1,133 @@
+import json
+import sys
+import time
 from argparse import ArgumentParser, Namespace
 from selectors import DefaultSelector, EVENT_READ , EVENT_WRITE
-from socket import AF_INET, SOCK_STREAM
 from socket import socket as Socket
 
-from handler_lib import ClientHandler
+from handler_lib import JSON_ACTIONS, SHARED_MEMORY, ClientHandler
+from handler_lib import DatagramClient, create_request
+from log_lib import Truncated, log, setup_logging
+from socket_lib import Endpoint
+
 
 def parse_args() -> Namespace:
     parser = ArgumentParser()
     parser.add_argument('--host', default='localhost')
     parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix', metavar='PATH',
+                        help="connect to the Unix domain socket at PATH "
+                             "instead of --host and --port")
+    parser.add_argument('--channel-fd', metavar='FD', type=int,
+                        help="send everything over the connected socket "
+                             "inherited as FD, such as one end of a "
+                             "socketpair(); implies --keep-alive")
+    parser.add_argument('--udp', action='store_true',
+                        help="send each request in a UDP datagram to "
+                             "--host and --port, without connecting")
+    parser.add_argument('--timeout', type=float, default=1.0,
+                        help="with --udp, seconds to wait for a response "
+                             "before sending the request again")
+    parser.add_argument('--retries', type=int, default=3,
+                        help="with --udp, times to send a request again")
     parser.add_argument('--action', default='GET ')
-    parser.add_argument('--value', default='/')
-    return parser.parse_args()
+    parser.add_argument('--value', nargs='+', default=['/'])
+    parser.add_argument('--values-from', metavar='PATH',
+                        help="read the values from PATH, one per line, "
+                             "instead of --value; - reads stdin")
+    parser.add_argument('--batch-size', type=int,
+                        help="send the values as batch_search requests of "
+                             "this many each")
+    parser.add_argument('--mode', choices=['exact', 'prefix', 'fuzzy'],
+                        help="how the search action matches the value")
+    parser.add_argument('--limit', type=int,
+                        help="most matches a prefix or fuzzy search returns")
+    parser.add_argument('--keep-alive', action='store_true',
+                        help="send every value over one connection")
+    parser.add_argument('--repeat', type=int, default=1,
+                        help="send each value this many times")
+    parser.add_argument('--binary-header', action='store_true',
+                        help="send compact binary headers instead of JSON")
+    parser.add_argument('--upload', metavar='PATH',
+                        help="send the file at PATH as a binary request, "
+                             "instead of --action and --value")
+    parser.add_argument('--shared-memory', action='store_true',
+                        help="hand the --upload file over in shared memory "
+                             "instead of sending it, to a server on the "
+                             "same host run with --shared-memory")
+    parser.add_argument('--batch', metavar='PATH',
+                        help="read requests from PATH, one per line, - "
+                             "for stdin, and write each response to stdout "
+                             "as a JSON line; a line is a JSON object with "
+                             "an action and a value, or an action and its "
+                             "value. The server must run with --keep-alive")
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help="with --batch, most connections to open")
+    parser.add_argument('--pipeline', type=int, default=64,
+                        help="with --batch, most requests in flight on "
+                             "each connection")
+    parser.add_argument('--order', choices=['input', 'completion'],
+                        default='input',
+                        help="with --batch, write the responses in the "
+                             "order of the requests, or as they arrive")
+    parser.add_argument('--log-level', default='INFO')
+    args = parser.parse_args()
+    if args.batch and (args.unix or args.channel_fd is not None
+                       or args.udp or args.upload):
+        parser.error("--batch sends requests to --host and --port only")
+    if args.udp and (args.unix or args.channel_fd is not None
+                     or args.upload):
+        parser.error("--udp sends requests to --host and --port only")
+    return args
+
+
+def read_values(path: str) -> list[str]:
+    """The non-empty lines of path, or of stdin for -."""
+    if path == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(path, encoding="utf-8") as file:
+            lines = file.read().splitlines()
+    return [line for line in lines if line]
 
 
-def main(host: str, port: int, action: str, value: str) -> None:
+def main(endpoint: Endpoint, action: str, values: list,
+         keep_alive: bool = False, repeat: int = 1,
+         binary_header: bool = False, upload: str = None,
+         channel: Socket = None, shared_memory: bool = False,
+         datagram_client: DatagramClient = None, **fields) -> None:
+    """Send the requests to endpoint, or by channel or datagram_client."""
     selector = DefaultSelector()
-    socket = Socket(AF_INET, SOCK_STREAM)
-    socket.connect_ex((host, port))
-    label = f"{host}:{port}"
-    print(f"Starting connection to {label}")
-    request = create_request(action, value)
-    ClientHandler(selector, socket, label, request).register()
+    label = str(endpoint) if channel is None else f"channel {channel.fileno()}"
+    if upload:
+        # Sent with sendfile, or copied into shared memory likewise, never
+        # read into memory
+        requests = [{
+            "type": "binary/custom-client-binary-type",
+            "encoding": SHARED_MEMORY if shared_memory else "binary",
+            "file": open(upload, "rb"),
+        } for _ in range(repeat)]
+    else:
+        requests = [create_request(action, value, **fields)
+                    for value in values for _ in range(repeat)]
+    if datagram_client is not None:
+        send_datagrams(datagram_client, requests)
+        return
+    if keep_alive or channel is not None:
+        # One connection, all requests pipelined before the first reply
+        batches = [requests]
+    else:
+        batches = [[request] for request in requests]
+    for batch in batches:
+        if channel is None:
+            socket = endpoint.connect()
+        else:
+            socket = channel
+        log.info("Starting connection to %s", label)
+        ClientHandler(selector, socket, label, *batch,
+                      keep_alive=keep_alive,
+                      header_format="binary" if binary_header else "json",
+                      ).register()
     try:
         while selector.get_map():
             # while there are sockets being monitored
@@ -34,30 +140,160 @@ def main(host: str, port: int, action: str, value: str) -> None:
                     if actions & EVENT_READ:
                         handler.read()
                 except (ValueError, TypeError, ConnectionError) as error:
-                    print(f"Error on {handler}:\n{error}")
+                    log.error("Error on %s: %s", handler, error)
                     handler.close()
-        print("All connections closed. Exiting.")
+        log.info("All connections closed. Exiting.")
     except KeyboardInterrupt:
-        print("\nKeyboard interrupt received, exiting.")
+        log.info("Keyboard interrupt received, exiting.")
     finally:
         selector.close()
 
 
-def create_request(action, value):
-    if action == "search":
-        return {
-            "type": "text/json",
-            "encoding": "utf-8",
-            "content": {"action": action, "value": value},
-        }
-    else:
-        return {
-            "type": "binary/custom-client-binary-type",
-            "encoding": "binary",
-            "content": (action + value).encode(),
-        }
+def send_datagrams(client: DatagramClient, requests: list[dict]) -> None:
+    """Send the requests one at a time, each awaiting its response."""
+    try:
+        for request in requests:
+            try:
+                content = client.request(request)
+            except (ValueError, TimeoutError, ConnectionError) as error:
+                log.error("Error on udp:%s: %s", client.endpoint, error)
+                continue
+            if isinstance(content, dict):
+                log.info("Got result: %s",
+                         Truncated(content.get("result"), 1000))
+            else:
+                log.info("Got response: %r", Truncated(content, 1000))
+    finally:
+        client.close()
+
+
+def parse_request(line: str, fields: dict) -> dict:
+    """The request on a --batch line.
+
+    A JSON object has an "action", a "value" and any other search
+    fields. Otherwise the first word is the action if the server answers
+    it from JSON, and the rest of the line its value; any other line is
+    sent whole as binary content, like --action "GET " --value /.
+    """
+    if line.startswith("{"):
+        request = {**fields, **json.loads(line)}
+        return create_request(
+            request.pop("action"), request.pop("value", ""), **request)
+    action, _, value = line.partition(" ")
+    if action in JSON_ACTIONS:
+        return create_request(action, value.strip(), **fields)
+    return create_request(line, "")
+
+
+def send_batch(host: str, port: int, lines, concurrency: int = 4,
+               pipeline: int = 64, in_order: bool = True,
+               binary_header: bool = False, **fields) -> int:
+    """Send the request on each line, writing responses as JSON lines.
+
+    Lines are read as they are needed, so a pipe can stream requests.
+    Each output line has the number of its input line and the response,
+    or an error. Returns the number of errors.
+    """
+    # Only batches need threads and futures
+    from concurrent.futures import FIRST_COMPLETED, Future, wait
+
+    from client_pool import ClientPool
+
+    output = sys.stdout
+    errors = 0
+
+    def write(number: int, future: Future) -> None:
+        nonlocal errors
+        try:
+            content = future.result()
+        except (ValueError, OSError, RuntimeError) as error:
+            errors += 1
+            output.write(json.dumps({"line": number, "error": str(error)}))
+        else:
+            if not isinstance(content, dict):
+                content = content.decode("utf-8", "replace")
+            output.write(json.dumps(
+                {"line": number, "response": content}, ensure_ascii=False))
+        output.write("\n")
+
+    def write_done() -> None:
+        # About to block: let what's written so far out first
+        output.flush()
+        if in_order:
+            future = next(iter(pending))
+            write(pending.pop(future), future)
+        else:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                write(pending.pop(future), future)
+
+    window = concurrency * pipeline
+    # Futures in input order, each with its line number
+    pending: dict[Future, int] = {}
+    start = time.perf_counter()
+    requests = 0
+    with ClientPool(concurrency, pipeline,
+                    "binary" if binary_header else "json") as pool:
+        for number, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line:
+                continue
+            requests += 1
+            try:
+                future = pool.request(host, port, parse_request(line, fields))
+            except (ValueError, KeyError, TypeError) as error:
+                # Failed in its place, so input order holds
+                future = Future()
+                future.set_exception(
+                    ValueError(f"Invalid request: {error!r}"))
+            pending[future] = number
+            while len(pending) >= window:
+                write_done()
+        while pending:
+            write_done()
+        output.flush()
+    log.info("Sent %d requests to %s:%d in %.3fs, %d errors",
+             requests, host, port, time.perf_counter() - start, errors)
+    return errors
 
 
 if __name__ == '__main__':
     args = parse_args()
-    main(args.host, args.port, args.action, args.value)
+    setup_logging(args.log_level)
+    # Only the search fields given, so servers see the same requests
+    fields = {name: value for name, value in
+              (("mode", args.mode), ("limit", args.limit))
+              if value is not None}
+    if args.batch:
+        if args.batch == "-":
+            batch = sys.stdin
+        else:
+            batch = open(args.batch, encoding="utf-8")
+        with batch:
+            errors = send_batch(
+                args.host, args.port, batch, args.concurrency,
+                args.pipeline, args.order == "input", args.binary_header,
+                **fields)
+        sys.exit(1 if errors else 0)
+    action, values = args.action, args.value
+    if args.values_from:
+        values = read_values(args.values_from)
+    if args.batch_size:
+        action = "batch_search"
+        values = [values[start:start + args.batch_size]
+                  for start in range(0, len(values), args.batch_size)]
+    if args.unix:
+        endpoint = Endpoint.unix(args.unix)
+    else:
+        endpoint = Endpoint.tcp(args.host, args.port)
+    channel = None
+    if args.channel_fd is not None:
+        channel = Socket(fileno=args.channel_fd)
+    datagram_client = None
+    if args.udp:
+        datagram_client = DatagramClient(
+            Endpoint.udp(args.host, args.port), args.timeout, args.retries,
+            "binary" if args.binary_header else "json")
+    main(endpoint, action, values, args.keep_alive or channel is not None,
+         args.repeat, args.binary_header, args.upload, channel,
+         args.shared_memory, datagram_client, **fields)
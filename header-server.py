@@ -1,58 +1,472 @@
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import time
 from argparse import ArgumentParser, Namespace
+from concurrent.futures import Executor, ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
 from selectors import BaseSelector, DefaultSelector, EVENT_READ, EVENT_WRITE
-from socket import AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR
 from socket import socket as Socket
 
-from handler_lib import ServerHandler
+from cache_lib import ResponseCache
+from handler_lib import MAX_HEADER_SIZE, BufferBudget
+from log_lib import log, setup_logging
+from metrics_lib import metrics
+from offload_lib import Offloader
+from sched_lib import Scheduler
+from search_lib import load_backend
+from server_lib import DatagramHandler, ResponseBuilder, ServerHandler
+from shm_lib import remove_orphans
+from socket_lib import AcceptBackoff, Endpoint, SocketOptions
+from socket_lib import add_socket_arguments, peer_label
+from timer_lib import TimerWheel
+
+# The --index and --fuzzy options, reloaded on SIGHUP
+search_index: tuple[str, bool] = None
+# The --offload and --offload-workers options, for each worker process
+offload_pool: tuple[str, int] = None
+# The --udp option, for each worker process
+serve_datagrams = False
+reload_requested = False
 
 
 def parse_args() -> Namespace:
     parser = ArgumentParser()
     parser.add_argument('--host', default='localhost')
     parser.add_argument('--port', type=int, default=8000)
-    return parser.parse_args()
+    parser.add_argument('--unix', metavar='PATH',
+                        help="also listen on a Unix domain socket at PATH, "
+                             "for clients on the same host")
+    parser.add_argument('--channel-fd', metavar='FD', type=int,
+                        action='append', default=[],
+                        help="also serve the connected socket inherited as "
+                             "FD, such as one end of a socketpair(); "
+                             "repeatable, not with --workers")
+    parser.add_argument('--udp', action='store_true',
+                        help="also answer requests sent in datagrams to "
+                             "--port over UDP")
+    parser.add_argument('--keep-alive', action='store_true',
+                        help="serve many requests on each connection")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="fork this many SO_REUSEPORT worker processes")
+    parser.add_argument('--log-level', default='INFO',
+                        help="DEBUG logs every message sent and received")
+    parser.add_argument('--files', metavar='DIR',
+                        help="serve files under DIR to the 'fetch' action")
+    parser.add_argument('--index', metavar='PATH',
+                        help="answer searches from PATH: a JSON object, "
+                             "loaded into memory, or a file written by "
+                             "build-index.py, memory-mapped")
+    parser.add_argument('--fuzzy', action='store_true',
+                        help="build a trigram index of a JSON --index for "
+                             "fuzzy searches")
+    parser.add_argument('--cache-bytes', type=int, default=2**24,
+                        help="keep this many bytes of encoded search "
+                             "responses, per worker (0: no cache)")
+    parser.add_argument('--cache-ttl', type=float, default=0,
+                        help="answer from the cache for at most this many "
+                             "seconds (0: until SIGHUP reloads --index)")
+    parser.add_argument('--chunk-size', type=int,
+                        help="stream binary request bodies in pieces of "
+                             "this many bytes instead of buffering them")
+    parser.add_argument('--shared-memory', action='store_true',
+                        help="accept binary bodies handed over in shared "
+                             "memory by clients on the same host")
+    parser.add_argument('--idle-timeout', type=float, default=60,
+                        help="close connections that send and receive "
+                             "nothing for this many seconds (0: never)")
+    parser.add_argument('--header-timeout', type=float, default=10,
+                        help="close connections whose message header is "
+                             "incomplete this many seconds after its "
+                             "first byte (0: never)")
+    parser.add_argument('--request-timeout', type=float, default=0,
+                        help="close connections whose whole message is "
+                             "incomplete this many seconds after its "
+                             "first byte (0: never)")
+    parser.add_argument('--high-watermark', type=int, default=2**20,
+                        help="stop reading from a connection with more "
+                             "than this many bytes queued to send to it "
+                             "(0: never)")
+    parser.add_argument('--low-watermark', type=int, default=2**18,
+                        help="and start again once it is down to this many")
+    parser.add_argument('--max-frame-size', type=int, default=2**30,
+                        help="refuse requests whose body is over this "
+                             "many bytes, unless streamed with "
+                             "--chunk-size")
+    parser.add_argument('--max-received', type=int,
+                        help="refuse connections holding more than this "
+                             "many bytes received and not yet parsed "
+                             "(default: --max-frame-size plus the "
+                             "longest header)")
+    parser.add_argument('--frame-budget', type=int, default=16,
+                        help="while connections compete, handle at most "
+                             "this many frames of one per loop iteration, "
+                             "the rest in later ones, round-robin (0: all "
+                             "at once, reading as much as there is room "
+                             "for)")
+    parser.add_argument('--read-budget', type=int, default=65536,
+                        help="with --frame-budget, read at most this many "
+                             "bytes from a connection per loop iteration "
+                             "while connections compete")
+    parser.add_argument('--buffer-budget', type=int, default=2**28,
+                        help="stop reading from every connection while "
+                             "they have more than this many bytes queued "
+                             "in all, per worker (0: no limit)")
+    parser.add_argument('--offload', choices=['thread', 'process'],
+                        help="answer expensive requests in a pool of "
+                             "worker threads or processes, not inline")
+    parser.add_argument('--offload-workers', type=int, default=4,
+                        help="pool size for --offload, per worker")
+    parser.add_argument('--offload-bytes', type=int, default=65536,
+                        help="with --offload, decode JSON bodies over this "
+                             "many bytes in the pool too")
+    parser.add_argument('--metrics', action='store_true',
+                        help="collect runtime metrics, served by the "
+                             "'stats' action (per worker)")
+    parser.add_argument('--metrics-interval', type=float, default=0,
+                        help="also print metrics as JSON every so many "
+                             "seconds")
+    add_socket_arguments(parser)
+    args = parser.parse_args()
+    if args.channel_fd and args.workers:
+        parser.error("--channel-fd is served without --workers")
+    return args
+
+
+def main(host: str, port: int, keep_alive: bool = False,
+         workers: int = 0, metrics_interval: float = 0,
+         unix_path: str = None, channel_fds: list[int] = ()) -> None:
+    unix_socket = None
+    if unix_path:
+        # Opened before forking: the workers share the one path
+        unix_socket = create_listening_socket(Endpoint.unix(unix_path))
+    try:
+        if workers:
+            supervise(host, port, keep_alive, workers, metrics_interval,
+                      unix_socket)
+        else:
+            listening_sockets = [
+                create_listening_socket(Endpoint.tcp(host, port))]
+            if unix_socket is not None:
+                listening_sockets.append(unix_socket)
+            channels = [Socket(fileno=fd) for fd in channel_fds]
+            serve(listening_sockets, keep_alive, metrics_interval,
+                  channels, create_datagram_sockets(host, port))
+    finally:
+        if unix_socket is not None:
+            unix_socket.close()
+            os.unlink(unix_path)
+
+
+def create_listening_socket(endpoint: Endpoint,
+                            reuse_port: bool = False) -> Socket:
+    listening_socket = endpoint.listen(
+        ServerHandler.socket_options, reuse_port)
+    log.info("Listening on %s", endpoint)
+    return listening_socket
+
+
+def create_datagram_sockets(host: str, port: int,
+                            reuse_port: bool = False) -> list[Socket]:
+    """The UDP socket to serve with --udp, or none."""
+    if not serve_datagrams:
+        return []
+    endpoint = Endpoint.udp(host, port)
+    datagram_socket = endpoint.bind_datagram(
+        ServerHandler.socket_options, reuse_port)
+    log.info("Listening on udp:%s", endpoint)
+    return [datagram_socket]
 
 
-def main(host: str, port: int) -> None:
+def serve(listening_sockets: list[Socket], keep_alive: bool = False,
+          metrics_interval: float = 0, channels: list[Socket] = (),
+          datagram_sockets: list[Socket] = ()) -> None:
     selector = DefaultSelector()
-    listening_socket = Socket(AF_INET, SOCK_STREAM)
-    # Avoid bind() exception: OSError: [Errno 48] Address already in use
-    listening_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-    listening_socket.bind((host, port))
-    listening_socket.listen()
-    listening_socket.setblocking(False)
-    print(f"Listening on to {host}:{port}")
-    selector.register(listening_socket, EVENT_READ, data=None)
+    for listening_socket in listening_sockets:
+        selector.register(listening_socket, EVENT_READ, data=None)
+    for datagram_socket in datagram_sockets:
+        # Served by the same loop as the connections
+        DatagramHandler(selector, datagram_socket).register()
+    timers = TimerWheel()
+    backoff = AcceptBackoff(selector)
+    for channel in channels:
+        # Already connected, like an accepted connection
+        ServerHandler(selector, channel, f"channel {channel.fileno()}",
+                      keep_alive, timers).register()
+    offloader = None
+    if offload_pool is not None:
+        offloader = ServerHandler.offloader = Offloader(
+            selector, create_executor(*offload_pool))
+    scheduler = ServerHandler.scheduler
+    next_dump = time.monotonic() + metrics_interval
     try:
         while True:
             # while there are sockets being monitored
-            events = selector.select(timeout=None)
+            # Wake for the next deadline or metrics dump, if any
+            now = time.monotonic()
+            timeout = timers.timeout(now)
+            if (resume_in := backoff.timeout(now)) is not None:
+                timeout = resume_in if timeout is None else min(
+                    timeout, resume_in)
+            if metrics_interval:
+                dump_in = max(next_dump - now, 0)
+                timeout = dump_in if timeout is None else min(
+                    timeout, dump_in)
+            if scheduler is not None:
+                # Don't wait while connections have frames to handle
+                timeout = scheduler.timeout(timeout)
+            if metrics.enabled:
+                started = time.perf_counter()
+            events = selector.select(timeout=timeout)
+            if metrics.enabled:
+                selected = time.perf_counter()
+                metrics.select_seconds += selected - started
+            if scheduler is not None:
+                scheduler.start(len(events))
+            backoff.resume(time.monotonic())
+            if reload_requested:
+                reload_search(offloader)
             for key, actions in events:
                 handler = key.data
                 try:
                     if handler is None:
-                        accept_wrapper(selector, key.fileobj)
+                        accept_wrapper(selector, key.fileobj, keep_alive,
+                                       timers, backoff)
                     else:
                         if actions & EVENT_READ:
                             handler.read()
-                        if actions & EVENT_WRITE:
+                        # Unless reading closed it
+                        if actions & EVENT_WRITE and handler.socket:
                             handler.write()
                 except (ValueError, TypeError, ConnectionError) as error:
-                    print(f"Error on {handler}:\n{error}")
-                    handler.close()
+                    handler_failed(handler, error)
+            if scheduler is not None:
+                # The turns of the connections deferred, round-robin
+                for handler in scheduler.due():
+                    try:
+                        handler.resume()
+                    except (ValueError, TypeError,
+                            ConnectionError) as error:
+                        handler_failed(handler, error)
+            for handler in timers.expire(time.monotonic()):
+                log.info("Closing %s after %s timeout",
+                         handler, handler.timeout_reason)
+                if metrics.enabled:
+                    metrics.timeouts += 1
+                handler.close()
+            if metrics.enabled:
+                metrics.handler_seconds += time.perf_counter() - selected
+            if metrics_interval and time.monotonic() >= next_dump:
+                log.info("Metrics: %s", json.dumps(metrics.snapshot()))
+                next_dump += metrics_interval
     except KeyboardInterrupt:
-        print("\nKeyboard interrupt received, exiting.")
+        log.info("Keyboard interrupt received, exiting.")
     finally:
+        if offloader is not None:
+            offloader.close()
         selector.close()
+        for listening_socket in listening_sockets:
+            listening_socket.close()
+        for datagram_socket in datagram_sockets:
+            datagram_socket.close()
+
+
+def handler_failed(handler: ServerHandler, error: Exception) -> None:
+    if metrics.enabled:
+        if isinstance(error, ConnectionError):
+            metrics.connection_errors += 1
+        else:
+            metrics.parse_errors += 1
+    log.error("Error on %s: %s", handler, error)
+    handler.close()
+
+
+def accept_wrapper(selector: BaseSelector, socket: Socket,
+                   keep_alive: bool, timers: TimerWheel,
+                   backoff: AcceptBackoff) -> None:
+    # Drains a burst of connections a batch at a time
+    for connection, addr in ServerHandler.socket_options.accept(
+            socket, backoff):
+        if metrics.enabled:
+            metrics.accepts += 1
+        label = peer_label(connection, addr)
+        log.info("Accepting connection from %s", label)
+        ServerHandler(
+            selector, connection, label, keep_alive, timers).register()
+
+
+def load_search(index: str, fuzzy: bool = False) -> None:
+    """Answer searches from index, forgetting responses to the old one."""
+    ResponseBuilder.search_backend = load_backend(index, fuzzy)
+    if ResponseBuilder.response_cache is not None:
+        ResponseBuilder.response_cache.invalidate()
+    log.info("Loaded %s search keys from %s",
+             len(ResponseBuilder.search_backend), index)
+
+
+def request_reload(signum, frame) -> None:
+    # Done by the event loop, not in the middle of a response
+    global reload_requested
+    reload_requested = True
 
 
-def accept_wrapper(selector: BaseSelector, socket: Socket) -> None:
-    connection, addr = socket.accept()
-    label = f"{addr[0]}:{addr[1]}"
-    print(f"Accepting connection from {label}")
-    ServerHandler(selector, connection, label).register()
+def create_executor(kind: str, workers: int) -> Executor:
+    if kind == "process":
+        # Forked, so the workers start with the index already loaded
+        return ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context("fork"))
+    return ThreadPoolExecutor(workers, thread_name_prefix="offload")
+
+
+def reload_search(offloader: Offloader = None) -> None:
+    global reload_requested
+    reload_requested = False
+    if search_index is None:
+        log.warning("SIGHUP ignored: no --index to reload")
+        return
+    try:
+        load_search(*search_index)
+    except (OSError, ValueError) as error:
+        log.error("Keeping the old search index: %s", error)
+        return
+    if offloader is not None and offloader.pickles:
+        # Worker processes still have the old index
+        offloader.replace_executor(create_executor(*offload_pool))
+
+
+def terminate(signum, frame) -> None:
+    # Unwind through the finally clauses, closing sockets on the way
+    sys.exit(0)
+
+
+def spawn_worker(host: str, port: int, keep_alive: bool,
+                 metrics_interval: float = 0,
+                 unix_socket: Socket = None) -> int:
+    # Don't let the child inherit, and later repeat, buffered output
+    sys.stdout.flush()
+    pid = os.fork()
+    if pid:
+        return pid
+    status = 0
+    # The parent's log listener thread doesn't exist in the child
+    listener = setup_logging(logging.getLogger().level)
+    try:
+        signal.signal(signal.SIGTERM, terminate)
+        signal.signal(signal.SIGHUP, request_reload)
+        metrics.reset()
+        listening_sockets = [create_listening_socket(
+            Endpoint.tcp(host, port), reuse_port=True)]
+        if unix_socket is not None:
+            # Inherited: the workers take turns accepting on it
+            listening_sockets.append(unix_socket)
+        serve(listening_sockets, keep_alive, metrics_interval,
+              datagram_sockets=create_datagram_sockets(host, port, True))
+    except SystemExit:
+        pass
+    except BaseException as error:
+        log.error("Worker %s failed: %r", os.getpid(), error)
+        status = 1
+    finally:
+        # Never return into the supervisor's code in the child
+        listener.stop()
+        sys.stdout.flush()
+        os._exit(status)
+
+
+def supervise(host: str, port: int, keep_alive: bool, workers: int,
+              metrics_interval: float = 0,
+              unix_socket: Socket = None) -> None:
+    """Run worker processes, restarting any that die, until SIGTERM."""
+    signal.signal(signal.SIGTERM, terminate)
+    started = {}
+
+    def forward(signum, frame):
+        for pid in started:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    # Each worker reloads its own index
+    signal.signal(signal.SIGHUP, forward)
+    try:
+        for _ in range(workers):
+            pid = spawn_worker(host, port, keep_alive, metrics_interval,
+                               unix_socket)
+            started[pid] = time.monotonic()
+        log.info("Supervising %s workers: %s", workers, sorted(started))
+        while True:
+            pid, status = os.wait()
+            started_at = started.pop(pid, None)
+            if started_at is None:
+                continue
+            log.warning(
+                "Worker %s exited with status %s, restarting", pid, status)
+            if time.monotonic() - started_at < 1:
+                # Don't fork in a tight loop if workers fail on startup
+                time.sleep(1)
+            pid = spawn_worker(host, port, keep_alive, metrics_interval,
+                               unix_socket)
+            started[pid] = time.monotonic()
+    except KeyboardInterrupt:
+        log.info("Keyboard interrupt received, exiting.")
+    finally:
+        for pid in started:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in started:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        log.info("All workers stopped.")
 
 
 if __name__ == '__main__':
     args = parse_args()
-    main(args.host, args.port)
+    setup_logging(args.log_level)
+    ResponseBuilder.files_root = args.files
+    if args.cache_bytes:
+        ResponseBuilder.response_cache = ResponseCache(
+            args.cache_bytes, args.cache_ttl)
+    if args.index:
+        search_index = (args.index, args.fuzzy)
+        load_search(*search_index)
+    signal.signal(signal.SIGHUP, request_reload)
+    ServerHandler.chunk_size = args.chunk_size
+    ServerHandler.max_frame_size = args.max_frame_size
+    # Any one frame fits; more than that is only ever pipelined frames,
+    # which wait in the socket while the ones before are handled
+    ServerHandler.max_received = args.max_received or (
+        max(args.max_frame_size, args.chunk_size or 0) + MAX_HEADER_SIZE)
+    serve_datagrams = args.udp
+    if args.shared_memory:
+        ServerHandler.shared_memory = True
+        if removed := remove_orphans():
+            log.info("Removed %s shared memory segments of exited "
+                     "processes", removed)
+    ServerHandler.socket_options = SocketOptions.from_args(args)
+    ServerHandler.idle_timeout = args.idle_timeout
+    ServerHandler.header_timeout = args.header_timeout
+    ServerHandler.request_timeout = args.request_timeout
+    if args.high_watermark:
+        ServerHandler.high_watermark = args.high_watermark
+        ServerHandler.low_watermark = min(
+            args.low_watermark, args.high_watermark)
+    if args.frame_budget:
+        ServerHandler.scheduler = Scheduler(
+            args.read_budget, args.frame_budget)
+    if args.buffer_budget:
+        # Each forked worker gets its own copy
+        ServerHandler.budget = BufferBudget(args.buffer_budget)
+    if args.offload:
+        offload_pool = (args.offload, args.offload_workers)
+        ServerHandler.offload_bytes = args.offload_bytes
+    metrics.enabled = args.metrics or bool(args.metrics_interval)
+    main(args.host, args.port, args.keep_alive, args.workers,
+         args.metrics_interval, args.unix, args.channel_fd)
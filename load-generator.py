@@ -0,0 +1,278 @@
+import json
+import random
+import resource
+import time
+from argparse import ArgumentParser, Namespace
+from collections import deque
+from selectors import DefaultSelector
+from selectors import EVENT_READ as READ
+from selectors import EVENT_WRITE as WRITE
+from socket import AF_INET, SOCK_STREAM
+from socket import socket as Socket
+
+from handler_lib import FrameParser, create_request, encode_message
+from handler_lib import encode_request
+from metrics_lib import Histogram
+
+
+class ReplyParser(FrameParser):
+    """Calls frame_received() for each reply, leaving it undecoded."""
+
+    __slots__ = ("frame_received",)
+
+    def __init__(self, frame_received, header_format: str) -> None:
+        FrameParser.__init__(self, keep_alive=True,
+                             header_format=header_format)
+        self.frame_received = frame_received
+
+    def message_received(self):
+        self.frame_received()
+
+    def decode_content(self):
+        # FrameParser reports every frame; load runs stay quiet
+        pass
+
+
+class Connection:
+    """One load-generating connection and its requests in flight.
+
+    Neither protocol tags replies, so they are matched to requests in
+    order: echo replies by byte count, framed replies one per frame.
+    """
+
+    def __init__(self, conn_id: int, socket: Socket, protocol: str,
+                 header_format: str, histogram: Histogram) -> None:
+        self.conn_id = conn_id
+        self.socket = socket
+        self.histogram = histogram
+        self.out_buffer = b""
+        self.events = READ
+        # Start times (and, for echo, lengths) of requests in flight
+        self.in_flight: deque = deque()
+        self.echo_received = 0
+        self._now = 0.0
+        self.completed = 0
+        self.parser = None
+        if protocol == "framed":
+            self.parser = ReplyParser(self._frame_received, header_format)
+
+    def send(self, request: bytes, started: float) -> None:
+        self.out_buffer += request
+        self.in_flight.append((started, len(request)))
+
+    def received(self, data: bytes, now: float) -> None:
+        self._now = now
+        if self.parser:
+            self.parser.feed(data)
+            return
+        self.echo_received += len(data)
+        while self.in_flight and self.echo_received >= self.in_flight[0][1]:
+            started, length = self.in_flight.popleft()
+            self.echo_received -= length
+            self._complete(started)
+
+    def _frame_received(self) -> None:
+        started, _ = self.in_flight.popleft()
+        self._complete(started)
+
+    def _complete(self, started: float) -> None:
+        self.histogram.record(self._now - started)
+        self.completed += 1
+
+
+class PayloadSizes:
+    """Draws payload sizes from 'fixed:N', 'uniform:MIN:MAX' or 'exp:MEAN'."""
+
+    def __init__(self, spec: str) -> None:
+        kind, *params = spec.split(":")
+        values = [int(param) for param in params]
+        if kind == "fixed" and len(values) == 1:
+            self.draw = lambda: values[0]
+        elif kind == "uniform" and len(values) == 2:
+            self.draw = lambda: random.randint(*values)
+        elif kind == "exp" and len(values) == 1:
+            rate = 1 / values[0]
+            self.draw = lambda: max(1, round(random.expovariate(rate)))
+        else:
+            raise ValueError(f"Invalid payload size spec {spec!r}.")
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(
+        description="Generate load and report throughput and latency.")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--protocol', choices=['echo', 'framed'],
+                        default='framed',
+                        help="multiconn-server echo, or handler_lib frames "
+                             "(the server needs --keep-alive)")
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help="number of connections")
+    parser.add_argument('--rate', type=float, default=0,
+                        help="open loop: total requests/s on a fixed "
+                             "schedule; 0 for closed loop, one request in "
+                             "flight per connection")
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--payload-size', default='fixed:64',
+                        help="fixed:N, uniform:MIN:MAX or exp:MEAN bytes")
+    parser.add_argument('--search', metavar='VALUE',
+                        help="framed: send JSON searches for VALUE instead "
+                             "of binary payloads")
+    parser.add_argument('--binary-header', action='store_true')
+    parser.add_argument('--fragment', action='store_true',
+                        help="send random-sized pieces, like messy-client")
+    parser.add_argument('--json', action='store_true',
+                        help="print the report as JSON")
+    return parser.parse_args()
+
+
+def make_request(args: Namespace, sizes: PayloadSizes) -> bytes:
+    if args.protocol == "echo":
+        return random.randbytes(sizes.draw())
+    if args.search is not None:
+        request = create_request("search", args.search)
+    else:
+        request = {
+            "type": "binary/custom-client-binary-type",
+            "encoding": "binary",
+            "content": random.randbytes(sizes.draw()),
+        }
+    return encode_message(
+        **encode_request(request),
+        header_format="binary" if args.binary_header else "json")
+
+
+def set_events(selector: DefaultSelector, connection: Connection) -> None:
+    # Only ask for EVENT_WRITE while there is something to send
+    events = READ | WRITE if connection.out_buffer else READ
+    if events != connection.events:
+        selector.modify(connection.socket, events, connection)
+        connection.events = events
+
+
+def run(args: Namespace) -> dict:
+    sizes = PayloadSizes(args.payload_size)
+    histogram = Histogram()
+    selector = DefaultSelector()
+    connections = []
+    for conn_id in range(args.concurrency):
+        socket = Socket(AF_INET, SOCK_STREAM)
+        socket.connect((args.host, args.port))
+        socket.setblocking(False)
+        connection = Connection(
+            conn_id, socket, args.protocol,
+            "binary" if args.binary_header else "json", histogram)
+        selector.register(socket, READ, connection)
+        connections.append(connection)
+
+    errors = 0
+    sent = 0
+    start = time.perf_counter()
+    stop_sending = start + args.duration
+    # Give requests still in flight a moment to finish after the run
+    give_up = stop_sending + 1.0
+    interval = 1 / args.rate if args.rate else 0
+    next_send = start
+    round_robin = 0
+    while connections:
+        now = time.perf_counter()
+        if now >= give_up:
+            break
+        sending = now < stop_sending
+        if sending and args.rate:
+            # Open loop: latency counts from the scheduled send time, so a
+            # stalled server can't hide its delay (coordinated omission)
+            while next_send <= now:
+                connection = connections[round_robin % len(connections)]
+                round_robin += 1
+                connection.send(make_request(args, sizes), next_send)
+                sent += 1
+                next_send += interval
+                set_events(selector, connection)
+        elif sending:
+            for connection in connections:
+                if not connection.in_flight:
+                    connection.send(make_request(args, sizes), now)
+                    sent += 1
+                    set_events(selector, connection)
+        if args.rate and sending:
+            timeout = max(next_send - time.perf_counter(), 0)
+        elif not any(connection.in_flight for connection in connections):
+            if not sending:
+                break
+            timeout = 0
+        else:
+            timeout = max(give_up - now, 0)
+        for key, actions in selector.select(timeout):
+            connection = key.data
+            try:
+                if actions & WRITE and connection.out_buffer:
+                    data = connection.out_buffer
+                    if args.fragment:
+                        data = data[:random.randint(1, len(data))]
+                    sent_length = connection.socket.send(data)
+                    connection.out_buffer = (
+                        connection.out_buffer[sent_length:])
+                    set_events(selector, connection)
+                if actions & READ:
+                    if not (data := connection.socket.recv(65536)):
+                        raise ConnectionAbortedError("Server closed.")
+                    connection.received(data, time.perf_counter())
+            except BlockingIOError:
+                pass
+            except (ValueError, ConnectionError) as error:
+                errors += 1 + len(connection.in_flight)
+                connection.in_flight.clear()
+                selector.unregister(connection.socket)
+                connection.socket.close()
+                connections.remove(connection)
+                if not args.json:
+                    print(f"Error on connection {connection.conn_id}: "
+                          f"{error}")
+    elapsed = min(time.perf_counter(), stop_sending) - start
+    for connection in connections:
+        connection.socket.close()
+    selector.close()
+    completed = histogram.count
+    return {
+        "protocol": args.protocol,
+        "concurrency": args.concurrency,
+        "mode": "open" if args.rate else "closed",
+        "target_rate": args.rate,
+        "duration": elapsed,
+        "sent": sent,
+        "completed": completed,
+        "errors": errors,
+        "incomplete": sent - completed - errors,
+        "requests_per_second": completed / elapsed if elapsed else 0.0,
+        "latency": histogram.summary(),
+    }
+
+
+def print_report(report: dict) -> None:
+    print(f"{report['protocol']} protocol, {report['mode']} loop, "
+          f"{report['concurrency']} connections, "
+          f"{report['duration']:.1f}s")
+    print(f"  sent {report['sent']}, completed {report['completed']}, "
+          f"errors {report['errors']}, incomplete {report['incomplete']}")
+    print(f"  throughput {report['requests_per_second']:.0f} requests/s")
+    latency = report["latency"]
+    print("  latency " + ", ".join(
+        f"{name} {value * 1e3:.3f}ms" for name, value in latency.items()
+        if name != "count"))
+
+
+def main(args: Namespace) -> None:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = min(hard, args.concurrency + 100)
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+    report = run(args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,78 @@
+import atexit
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+# Shared by handler_lib and the scripts
+log = logging.getLogger("sockets")
+
+
+class Truncated:
+    """Log argument showing at most limit characters of a payload.
+
+    The text is only built if the record is actually emitted, and only
+    from the first limit bytes, so large payloads are never copied whole.
+    %r shows the repr, and %s the plain text, like the value itself
+    would; bytes-like payloads show their repr either way.
+    """
+
+    __slots__ = ("value", "limit")
+
+    def __init__(self, value, limit: int = 80) -> None:
+        self.value = value
+        self.limit = limit
+
+    def __repr__(self) -> str:
+        return self._truncate(repr)
+
+    def __str__(self) -> str:
+        return self._truncate(str)
+
+    def _truncate(self, convert) -> str:
+        value = self.value
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            text = repr(bytes(value[:self.limit]))
+            if len(value) > self.limit:
+                text += f"... ({len(value)} bytes)"
+            return text
+        text = convert(value)
+        if len(text) > self.limit:
+            text = f"{text[:self.limit]}... ({len(text)} chars)"
+        return text
+
+
+class DeferredQueueHandler(QueueHandler):
+    """Queues records unformatted, so formatting happens on the listener.
+
+    QueueHandler formats in the logging thread by default. Here the
+    listener thread does it, so log arguments must not change after the
+    call. Payloads are immutable bytes or views the receive buffer never
+    reuses.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(level="INFO",
+                  fmt="%(asctime)s.%(msecs)03d: %(message)s",
+                  datefmt="%S") -> QueueListener:
+    """Send every log record through a queue to a background thread.
+
+    The calling thread (the selector loop) only enqueues records; a
+    QueueListener thread formats them and writes to stderr. The listener
+    is flushed and stopped at exit. A forked child must call this again,
+    since the listener thread does not survive the fork.
+    """
+    records = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(fmt, datefmt))
+    listener = QueueListener(records, stream_handler)
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(DeferredQueueHandler(records))
+    root.setLevel(level)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
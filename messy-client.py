@@ -1,4 +1,3 @@
-import logging as log
 import random
 import time
 from argparse import ArgumentParser, Namespace
@@ -9,6 +8,8 @@ from selectors import BaseSelector, DefaultSelector, SelectorKey
 from socket import AF_INET, SOCK_STREAM
 from socket import socket as Socket
 
+from log_lib import Truncated, log, setup_logging
+
 
 @dataclass
 class ConnectionState:
@@ -38,7 +39,7 @@ def main(host:str, port:int, num_conns: int, names: list[str]) -> None:
         socket = Socket(AF_INET, SOCK_STREAM)
         socket.setblocking(False)
         socket.connect_ex((host, port))
-        log.info(f"Starting connection {conn_index} to {host}:{port}")
+        log.info("Starting connection %s to %s:%s", conn_index, host, port)
         actions = READ | WRITE
         rand_names = [random.choice(byte_names) 
                       for _ in range(round(len(names)/2) or 1)]
@@ -56,7 +57,7 @@ def main(host:str, port:int, num_conns: int, names: list[str]) -> None:
                 service_connection(selector, key, actions)
         log.info("All connections closed. Exiting.")
     except KeyboardInterrupt:
-        log.error("\nKeyboard interrupt received, exiting.")
+        log.error("Keyboard interrupt received, exiting.")
     finally:
         selector.close()
 
@@ -72,7 +73,8 @@ def service_connection(selector: BaseSelector,
         data.out_buffer = data.messages.pop(0)
     if actions & WRITE:
         if data.out_buffer:
-            log.info(f"Sending {data.out_buffer} to connection {data.conn_id}")
+            log.info("Sending %s to connection %s",
+                     Truncated(data.out_buffer), data.conn_id)
             # send the data in the out buffer
             # and record the number of bytes sent successfully
             artificial_cap = random.randint(0, len(data.out_buffer))
@@ -84,9 +86,9 @@ def service_connection(selector: BaseSelector,
         if (recv_data := socket.recv(1024)):
             data.received_length += len(recv_data)
             data.in_buffer += recv_data
-            log.info(f"Recived data from connection {data.conn_id}")
+            log.info("Received data from connection %s", data.conn_id)
     if data.received_length == data.expected_echo_length:
-        log.info(f"Closing connection {data.conn_id}")
+        log.info("Closing connection %s", data.conn_id)
         socket.close()
         selector.unregister(socket)
     if data.in_buffer and data.in_buffer[-1] == 10: #'\n'
@@ -95,11 +97,7 @@ def service_connection(selector: BaseSelector,
         data.in_buffer = b''
 
 
-log.basicConfig(
-    format="%(asctime)s.%(msecs)03d: %(message)s", 
-    datefmt="%S",
-    level=log.INFO
-)
 if __name__ == '__main__':
     args = parse_args()
+    setup_logging()
     main(args.host, args.port, args.num_conns, args.names)
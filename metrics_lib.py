@@ -0,0 +1,154 @@
+import time
+
+
+class Histogram:
+    """Log-linear histogram, in the style of HdrHistogram.
+
+    Values are multiplied by scale (1e6 records seconds as microseconds)
+    and counted in buckets whose width grows with the value, so every
+    bucket is within 2 ** -(sub_bucket_bits - 1) of the values it holds
+    (under 2% by default) while a few hundred buckets span microseconds to
+    hours. Recording is O(1) and histograms merge by adding counts.
+    """
+
+    def __init__(self, scale: float = 1e6, sub_bucket_bits: int = 7) -> None:
+        self.scale = scale
+        self.sub_bucket_bits = sub_bucket_bits
+        self.counts: dict[int, int] = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def _index(self, value: int) -> int:
+        exponent = max(value.bit_length() - self.sub_bucket_bits, 0)
+        return (exponent << self.sub_bucket_bits) + (value >> exponent)
+
+    def _highest_value(self, index: int) -> int:
+        exponent = index >> self.sub_bucket_bits
+        mantissa = index - (exponent << self.sub_bucket_bits)
+        return ((mantissa + 1) << exponent) - 1
+
+    def record(self, value: float) -> None:
+        value = max(round(value * self.scale), 0)
+        index = self._index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: "Histogram") -> None:
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None
+                                      or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent: float) -> float:
+        """The value that percent of recordings do not exceed."""
+        if not self.count:
+            return 0.0
+        target = max(self.count * percent / 100, 1)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(self._highest_value(index), self.max) / self.scale
+        return self.max / self.scale
+
+    def mean(self) -> float:
+        return self.total / self.count / self.scale if self.count else 0.0
+
+    def summary(self, percents=(50, 90, 99, 99.9)) -> dict:
+        summary = {
+            "count": self.count,
+            "min": (self.min or 0) / self.scale,
+            "mean": self.mean(),
+            "max": self.max / self.scale,
+        }
+        for percent in percents:
+            summary[f"p{percent:g}"] = self.percentile(percent)
+        return summary
+
+
+class ServerMetrics:
+    """Counters and histograms describing a server's event loop.
+
+    Instrumented code tests metrics.enabled before touching anything else,
+    so while collection is off each call site costs one attribute lookup.
+    """
+
+    PHASES = ("protoheader", "header", "content")
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.reset()
+
+    def reset(self) -> None:
+        self.started = time.monotonic()
+        self.active_connections = 0
+        self.accepts = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames_parsed = 0
+        self.parse_errors = 0
+        self.connection_errors = 0
+        self.timeouts = 0
+        # Times a connection stopped reading for backpressure
+        self.read_pauses = 0
+        # Requests answered by an Offloader's workers
+        self.offloaded = 0
+        # Requests that came in datagrams, and responses to them that
+        # were dropped because the socket's send buffer was full
+        self.datagrams = 0
+        self.datagrams_dropped = 0
+        self.select_seconds = 0.0
+        self.handler_seconds = 0.0
+        # Wall time from the first byte of each phase to its completion
+        self.phases = {phase: Histogram() for phase in self.PHASES}
+        self.out_buffer_depth = Histogram(scale=1)
+        self._last_snapshot = (self.started, 0)
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        last_time, last_accepts = self._last_snapshot
+        self._last_snapshot = (now, self.accepts)
+        loop_seconds = self.select_seconds + self.handler_seconds
+        return {
+            "enabled": self.enabled,
+            "uptime": now - self.started,
+            "active_connections": self.active_connections,
+            "accepts": self.accepts,
+            "accepts_per_second": (
+                (self.accepts - last_accepts) / (now - last_time)
+                if now > last_time else 0.0),
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "frames_parsed": self.frames_parsed,
+            "parse_errors": self.parse_errors,
+            "connection_errors": self.connection_errors,
+            "timeouts": self.timeouts,
+            "read_pauses": self.read_pauses,
+            "offloaded": self.offloaded,
+            "datagrams": self.datagrams,
+            "datagrams_dropped": self.datagrams_dropped,
+            "select_seconds": self.select_seconds,
+            "handler_seconds": self.handler_seconds,
+            "handler_share": (
+                self.handler_seconds / loop_seconds if loop_seconds else 0.0),
+            "phases": {
+                phase: histogram.summary()
+                for phase, histogram in self.phases.items()
+            },
+            "out_buffer_depth": self.out_buffer_depth.summary(),
+        }
+
+
+# The process-wide metrics that handler_lib and the servers report into
+metrics = ServerMetrics()
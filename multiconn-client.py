@@ -1,11 +1,11 @@
-import logging as log
-import sys
+from argparse import ArgumentParser, Namespace
 from dataclasses import dataclass
 from selectors import BaseSelector, DefaultSelector, SelectorKey
 from selectors import EVENT_READ as READ
 from selectors import EVENT_WRITE as WRITE
-from socket import AF_INET, SOCK_STREAM
-from socket import socket as Socket
+
+from log_lib import Truncated, log, setup_logging
+from socket_lib import Endpoint
 
 
 @dataclass
@@ -17,13 +17,22 @@ class ConnectionState:
     out_buffer: bytes = b''
 
 
-def main(host:str, port:int, num_conns: int, messages: list[bytes]) -> None:
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description="Echo client opening connections.")
+    parser.add_argument('host')
+    parser.add_argument('port', type=int)
+    parser.add_argument('connections', type=int)
+    parser.add_argument('--unix', metavar='PATH',
+                        help="connect to the Unix domain socket at PATH "
+                             "instead of host and port")
+    return parser.parse_args()
+
+
+def main(endpoint: Endpoint, num_conns: int, messages: list[bytes]) -> None:
     selector = DefaultSelector()
     for conn_index in range(1, num_conns+1):
-        socket = Socket(AF_INET, SOCK_STREAM)
-        socket.setblocking(False)
-        socket.connect_ex((host, port))
-        log.info(f"Starting connection {conn_index} to {host}:{port}")
+        socket = endpoint.connect(blocking=False)
+        log.info("Starting connection %s to %s", conn_index, endpoint)
         actions = READ | WRITE
         data = ConnectionState(
             conn_id=conn_index,
@@ -39,7 +48,7 @@ def main(host:str, port:int, num_conns: int, messages: list[bytes]) -> None:
                     service_connection(selector, key, actions)
         log.info("All connections closed. Exiting.")
     except KeyboardInterrupt:
-        print("\nKeyboard interrupt received, exiting.")
+        log.info("Keyboard interrupt received, exiting.")
     finally:
         selector.close()
 
@@ -49,7 +58,8 @@ def service_connection(selector: BaseSelector,
     socket, data = key.fileobj, key.data
     if actions & WRITE:
         if data.out_buffer:
-            log.info(f"Sending {data.out_buffer} to connection {data.conn_id}")
+            log.info("Sending %s to connection %s",
+                     Truncated(data.out_buffer), data.conn_id)
             # send the data in the out buffer
             # and record the number of bytes sent successfully
             sent_length = socket.send(data.out_buffer)
@@ -62,24 +72,21 @@ def service_connection(selector: BaseSelector,
     if actions & READ:
         if (recv_data := socket.recv(1024)):
             data.received_length += len(recv_data)
-            log.info(f"Recived {recv_data} from connection {data.conn_id}")
+            log.info("Received %s from connection %s",
+                     Truncated(recv_data), data.conn_id)
             # Do nothing with this data
         if data.received_length == data.expected_message_length:
-            log.info(f"Closing connection {data.conn_id}")
+            log.info("Closing connection %s", data.conn_id)
             socket.close()
             selector.unregister(socket)
 
 
-log.basicConfig(
-    format="%(asctime)s.%(msecs)03d: %(message)s", 
-    datefmt="%S",
-    level=log.INFO
-)
 if __name__ == '__main__':
-    if len(sys.argv) != 4:
-        print(f"Usage: {sys.argv[0]} <host> <port> <number of connections>")
-        sys.exit(1)
-    host, port = sys.argv[1], int(sys.argv[2])
-    num_conns = int(sys.argv[3])
+    args = parse_args()
+    setup_logging()
+    if args.unix:
+        endpoint = Endpoint.unix(args.unix)
+    else:
+        endpoint = Endpoint.tcp(args.host, args.port)
     messages = [b"Message 1 from client.", b"Message 2 from client."]
-    main(host, port, num_conns, messages)
+    main(endpoint, args.connections, messages)
@@ -1,76 +1,187 @@
-import logging as log
-import sys
+import os
+import time
+from argparse import ArgumentParser, Namespace
 from dataclasses import dataclass
 from selectors import BaseSelector, DefaultSelector, SelectorKey
 from selectors import EVENT_READ as READ
 from selectors import EVENT_WRITE as WRITE
-from socket import AF_INET, SOCK_STREAM
 from socket import socket as Socket
 
+from handler_lib import BufferBudget
+from log_lib import Truncated, log, setup_logging
+from sched_lib import Scheduler
+from socket_lib import AcceptBackoff, Endpoint, SocketOptions
+from socket_lib import add_socket_arguments, peer_label
+from timer_lib import TimerWheel
 
-@dataclass
+# Close connections that send or receive nothing for this many seconds
+IDLE_TIMEOUT = 60
+# Stop reading from a connection with more than HIGH_WATERMARK bytes
+# waiting to be echoed, until it is down to LOW_WATERMARK, and from all
+# of them while they have more than BUFFER_BUDGET bytes waiting in all
+HIGH_WATERMARK = 2**20
+LOW_WATERMARK = 2**18
+BUFFER_BUDGET = 2**28
+
+budget = BufferBudget(BUFFER_BUDGET)
+# Set from the command line
+socket_options = SocketOptions()
+# Only its receive sizes: every byte read is echoed at once, so nothing
+# is left over for another turn
+scheduler = Scheduler()
+
+
+# eq=False keeps identity hashing, so buffers can be TimerWheel timers;
+# slots save a dict per connection
+@dataclass(eq=False, slots=True)
 class DataBuffer:
-    addr: tuple
+    label: str
+    socket: Socket
+    # Bytes the next recv() asks for
+    read_size: int
     in_buffer: bytes = b''
     out_buffer: bytes = b''
+    deadline: float = 0.0
+    # The events registered with the selector
+    events: int = READ
+    paused: bool = False
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description="Echo server for many clients.")
+    parser.add_argument('host')
+    parser.add_argument('port', type=int)
+    parser.add_argument('--unix', metavar='PATH',
+                        help="also listen on a Unix domain socket at PATH")
+    parser.add_argument('--read-budget', type=int, default=65536,
+                        help="most bytes read from a connection per loop "
+                             "iteration; reads start smaller, and grow "
+                             "while they fill up")
+    add_socket_arguments(parser)
+    return parser.parse_args()
 
 
-def main(host: str , port: int) -> None:
-    listening_socket = Socket(AF_INET, SOCK_STREAM)
-    listening_socket.bind((host, port))
-    listening_socket.listen()
-    listening_socket.setblocking(False)
-    print(f"Listening on {host}:{port}")
+def main(host: str , port: int, unix_path: str = None) -> None:
+    endpoints = [Endpoint.tcp(host, port)]
+    if unix_path:
+        endpoints.append(Endpoint.unix(unix_path))
     selector = DefaultSelector()
-    selector.register(listening_socket, READ, data=None)
+    listening_sockets = []
+    for endpoint in endpoints:
+        listening_sockets.append(endpoint.listen(socket_options))
+        log.info("Listening on %s", endpoint)
+        selector.register(listening_sockets[-1], READ, data=None)
+    timers = TimerWheel()
+    backoff = AcceptBackoff(selector)
     try:
         while True:
-            events = selector.select()
+            now = time.monotonic()
+            timeout = timers.timeout(now)
+            if (resume_in := backoff.timeout(now)) is not None:
+                timeout = resume_in if timeout is None else min(
+                    timeout, resume_in)
+            events = selector.select(timeout)
+            backoff.resume(time.monotonic())
             for key, actions in events:
                 if key.data is None:
                     # this socket has not yet been assigned a buffer
-                    accept_wrapper(selector, key.fileobj)
+                    accept_wrapper(selector, key.fileobj, timers, backoff)
                 else:
-                    service_connection(selector, key, actions)
+                    try:
+                        service_connection(selector, key, actions, timers)
+                    except ConnectionError as error:
+                        # Reset by the peer, say; the others carry on
+                        log.error("Error on %s: %s", key.data.label, error)
+                        close_connection(selector, key.data, timers)
+            for data in timers.expire(time.monotonic()):
+                log.info("Closing idle connection to %s", data.label)
+                close_connection(selector, data, timers)
     except KeyboardInterrupt:
-        print("\nKeyboard interrupt received, exiting.")
+        log.info("Keyboard interrupt received, exiting.")
     finally:
         selector.close()
+        for listening_socket in listening_sockets:
+            listening_socket.close()
+        if unix_path:
+            os.unlink(unix_path)
 
 
-def accept_wrapper(selector: BaseSelector, socket: Socket) -> None:
-    connection, addr = socket.accept()
-    connection.setblocking(False)
-    log.info(f"Accepting connection from {addr[0]}:{addr[1]}")
-    actions = READ | WRITE
-    data = DataBuffer(addr)
-    selector.register(connection, actions, data)
+def accept_wrapper(selector: BaseSelector, socket: Socket,
+                   timers: TimerWheel, backoff: AcceptBackoff) -> None:
+    # Drains a burst of connections a batch at a time
+    for connection, addr in socket_options.accept(socket, backoff):
+        connection.setblocking(False)
+        label = peer_label(connection, addr)
+        log.info("Accepting connection from %s", label)
+        data = DataBuffer(label, connection, scheduler.min_read)
+        selector.register(connection, READ, data)
+        timers.schedule(data, time.monotonic() + IDLE_TIMEOUT)
 
 
-def service_connection(selector: BaseSelector,
-                       key: SelectorKey, actions: int) -> None:
+def service_connection(selector: BaseSelector, key: SelectorKey,
+                       actions: int, timers: TimerWheel) -> None:
     socket, data = key.fileobj, key.data
+    timers.schedule(data, time.monotonic() + IDLE_TIMEOUT)
     if actions & READ:
-        if (received_data := socket.recv(1024)):
+        if (received_data := socket.recv(data.read_size)):
+            data.read_size = scheduler.read_size(
+                data.read_size, len(received_data))
+            if socket_options.quickack:
+                socket_options.received(socket)
             data.in_buffer += received_data
-            log.info(f"Received {received_data} from "
-                     f"{data.addr[0]}:{data.addr[1]}")
+            log.debug("Received %s from %s",
+                      Truncated(received_data), data.label)
+            budget.used += len(data.in_buffer)
             echo(data)
         else:
             # received no data this time, so all data is processed,
             # as far as the server is concerned
-            log.info(f"Closing connection to {data.addr[0]}:{data.addr[1]}")
-            socket.close()
-            selector.unregister(socket)
+            log.info("Closing connection to %s", data.label)
+            close_connection(selector, data, timers)
+            return
     if actions & WRITE:
         if data.out_buffer:
-            log.info(f"Sending {data.out_buffer} to "
-                     f"{data.addr[0]}:{data.addr[1]}")
+            log.debug("Sending %s to %s",
+                      Truncated(data.out_buffer), data.label)
             # send the data in the out buffer
             # and record the number of bytes sent successfully
             sent_length = socket.send(data.out_buffer)
             # remove the bytes successfully sent from the out buffer
             data.out_buffer = data.out_buffer[sent_length:]
+            budget.release(sent_length)
+    update_interest(selector, data)
+
+
+def update_interest(selector: BaseSelector, data: DataBuffer) -> None:
+    """Select WRITE while there is data to echo, and READ unless paused."""
+    limit = LOW_WATERMARK if data.paused else HIGH_WATERMARK
+    data.paused = budget.over() or len(data.out_buffer) > limit
+    if data.paused:
+        # Called back once the other connections have drained enough
+        budget.wait(data, lambda: update_interest(selector, data))
+    # An idle socket is always writable: only ask for WRITE when there is
+    # something to send, or select() never blocks
+    events = (0 if data.paused else READ) | (WRITE if data.out_buffer else 0)
+    if events == data.events:
+        return
+    # A paused connection with nothing to send selects nothing at all
+    if not events:
+        selector.unregister(data.socket)
+    elif not data.events:
+        selector.register(data.socket, events, data)
+    else:
+        selector.modify(data.socket, events, data)
+    data.events = events
+
+
+def close_connection(selector: BaseSelector, data: DataBuffer,
+                     timers: TimerWheel) -> None:
+    timers.cancel(data)
+    budget.forget(data)
+    budget.release(len(data.out_buffer))
+    if data.events:
+        selector.unregister(data.socket)
+    data.socket.close()
 
 
 def echo(data: DataBuffer) -> None:
@@ -78,14 +189,9 @@ def echo(data: DataBuffer) -> None:
     data.in_buffer = b''
 
 
-log.basicConfig(
-    format="%(asctime)s.%(msecs)03d: %(message)s",
-    datefmt="%S",
-    level=log.INFO
-)
 if __name__ == '__main__':
-    if len(sys.argv) != 3:
-        print(f"Usage: {sys.argv[0]} <host> <port>")
-        sys.exit(1)
-    host, port = sys.argv[1], int(sys.argv[2])
-    main(host, port)
+    args = parse_args()
+    setup_logging()
+    socket_options = SocketOptions.from_args(args)
+    scheduler = Scheduler(args.read_budget)
+    main(args.host, args.port, args.unix)
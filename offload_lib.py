@@ -0,0 +1,80 @@
+import selectors
+from collections import deque
+from concurrent import futures
+from concurrent.futures import Executor
+from socket import socketpair
+
+from log_lib import log
+
+
+class Offloader:
+    """Runs functions on an executor and calls back on the selector loop.
+
+    Workers can't touch the loop's handlers, so a finished future is
+    queued and a byte written to a socketpair registered with the
+    selector: the loop wakes up, and read() runs the callbacks on its
+    own thread. It is registered with itself as the key's data, so the
+    loop calls read() like any handler's.
+    """
+
+    def __init__(self, selector: selectors.BaseSelector,
+                 executor: Executor) -> None:
+        self.selector = selector
+        self.executor = executor
+        # Process pools pickle the arguments, and memoryviews can't be.
+        # Looked up here, since importing it imports multiprocessing: a
+        # client importing handler_lib never needs it
+        self.pickles = isinstance(executor, futures.ProcessPoolExecutor)
+        self.in_flight = 0
+        self._done: deque = deque()
+        self._wakeup_receive, self._wakeup_send = socketpair()
+        self._wakeup_receive.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        selector.register(
+            self._wakeup_receive, selectors.EVENT_READ, data=self)
+
+    def __str__(self):
+        return "offloader"
+
+    def submit(self, callback, function, *args) -> None:
+        """Run function(*args) on the executor, then callback(future)."""
+        self.in_flight += 1
+        future = self.executor.submit(function, *args)
+        future.add_done_callback(
+            lambda future: self._finished(callback, future))
+
+    def _finished(self, callback, future) -> None:
+        # On a worker thread, or the executor's management thread
+        self._done.append((callback, future))
+        try:
+            self._wakeup_send.send(b"\0")
+        except BlockingIOError:
+            # The loop has a wakeup pending already
+            pass
+
+    def read(self) -> None:
+        try:
+            while self._wakeup_receive.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self._done:
+            callback, future = self._done.popleft()
+            self.in_flight -= 1
+            try:
+                callback(future)
+            except Exception as error:
+                log.error("Offloaded callback %r failed: %r",
+                          callback, error)
+
+    def replace_executor(self, executor: Executor) -> None:
+        """Use executor from now on; the old one finishes its work."""
+        old, self.executor = self.executor, executor
+        self.pickles = isinstance(executor, futures.ProcessPoolExecutor)
+        old.shutdown(wait=False)
+
+    def close(self) -> None:
+        self.selector.unregister(self._wakeup_receive)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self._wakeup_receive.close()
+        self._wakeup_send.close()
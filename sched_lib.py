@@ -0,0 +1,64 @@
+from collections import deque
+
+
+class Scheduler:
+    """Shares each iteration of a selector loop fairly between connections.
+
+    In one iteration a connection reads at most read_budget bytes and
+    handles at most frame_budget frames, so a bulk upload or a deep
+    pipeline can't hold up everyone else. A connection that still has
+    whole frames received when its frame budget runs out is deferred: it
+    gets its next turn after the selected events of the next iteration,
+    in round-robin order, since select() won't report the bytes already
+    read. While any are deferred, the loop must not block in select().
+
+    The budgets only apply while connections compete: the loop calls
+    start() with the number of events selected, and a connection alone
+    in an iteration, with nothing deferred, reads and handles all it can.
+
+    Receive sizes adapt to how much data is pending: a read that fills
+    the size asked for doubles it, up to read_budget, and one that gets
+    less than a quarter of it halves it, down to min_read. Interactive
+    connections keep small reads, and bulk ones work up to big ones.
+    """
+
+    def __init__(self, read_budget: int = 65536, frame_budget: int = 16,
+                 min_read: int = 4096) -> None:
+        self.read_budget = read_budget
+        self.frame_budget = frame_budget
+        self.min_read = min(min_read, read_budget)
+        self._deferred: deque = deque()
+        # Whether this iteration's connections have to share it
+        self.contended: bool = False
+
+    def __len__(self) -> int:
+        return len(self._deferred)
+
+    def start(self, ready: int) -> None:
+        """Begin an iteration in which ready events were selected."""
+        self.contended = ready > 1 or bool(self._deferred)
+
+    def read_size(self, size: int, received: int) -> int:
+        """The next receive size, after received bytes of size asked for."""
+        if received >= size:
+            return min(size * 2, self.read_budget)
+        if received < size // 4:
+            return max(size // 2, self.min_read)
+        return size
+
+    def defer(self, connection) -> None:
+        """Give connection another turn in the next iteration."""
+        self._deferred.append(connection)
+
+    def due(self) -> deque:
+        """The connections deferred so far, oldest first.
+
+        Connections deferred while these take their turns wait for the
+        next iteration.
+        """
+        due, self._deferred = self._deferred, deque()
+        return due
+
+    def timeout(self, timeout: float = None) -> float:
+        """The select() timeout: 0 while connections are deferred."""
+        return 0 if self._deferred else timeout
@@ -0,0 +1,231 @@
+import json
+import math
+import mmap
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from collections import Counter
+
+
+class SearchBackend:
+    """Where the search action looks up its answers.
+
+    Keys and values are strings. get() finds one key exactly, and
+    get_many() a list of them, with None for each miss. prefix() finds
+    the keys starting with a prefix, in key order, and fuzzy() the keys
+    most like a query, best first. fuzzy() returns None when the backend
+    has no index for it.
+    """
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def get(self, key: str) -> str:
+        raise NotImplementedError
+
+    def get_many(self, keys: list[str]) -> list[str]:
+        return list(map(self.get, keys))
+
+    def prefix(self, prefix: str, limit: int) -> list[tuple[str, str]]:
+        raise NotImplementedError
+
+    def fuzzy(self, query: str, limit: int) -> list[tuple[str, str]]:
+        return None
+
+
+def trigrams(text: str) -> set[str]:
+    # Padded, so the ends of the key count too. Not with two spaces in
+    # front: a gram of just the first letter is in every 26th key
+    text = f" {text.lower()} "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class MemoryBackend(SearchBackend):
+    """A dict for exact lookups and a sorted key list for prefixes.
+
+    With ngrams, also an index from each trigram to the keys containing
+    it, and fuzzy() ranks keys by how many trigrams they share with the
+    query (Jaccard similarity). It adds about a fifth to the memory used,
+    and takes several seconds per million keys to build.
+    """
+
+    # Keys sharing less than this share of trigrams with the query are
+    # not returned by fuzzy()
+    MIN_SIMILARITY = 0.3
+
+    def __init__(self, entries: dict[str, str], ngrams: bool = False) -> None:
+        self._entries = entries
+        self._keys = sorted(entries)
+        self._postings: dict[str, array] = None
+        if ngrams:
+            self._postings = {}
+            # Trigrams per key, for the similarity
+            self._gram_counts = array("H")
+            for key_id, key in enumerate(self._keys):
+                grams = trigrams(key)
+                self._gram_counts.append(min(len(grams), 0xFFFF))
+                for gram in grams:
+                    posting = self._postings.get(gram)
+                    if posting is None:
+                        posting = self._postings[gram] = array("I")
+                    posting.append(key_id)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def get(self, key: str) -> str:
+        return self._entries.get(key)
+
+    def get_many(self, keys: list[str]) -> list[str]:
+        # dict.get straight from map(), with no Python frame per key
+        return list(map(self._entries.get, keys))
+
+    def prefix(self, prefix: str, limit: int) -> list[tuple[str, str]]:
+        found = []
+        for key_id in range(bisect_left(self._keys, prefix),
+                            len(self._keys)):
+            key = self._keys[key_id]
+            if len(found) == limit or not key.startswith(prefix):
+                break
+            found.append((key, self._entries[key]))
+        return found
+
+    def fuzzy(self, query: str, limit: int) -> list[tuple[str, str]]:
+        if self._postings is None:
+            return None
+        grams = trigrams(query)
+        shared = Counter()
+        for gram in grams:
+            posting = self._postings.get(gram)
+            if posting is not None:
+                shared.update(posting)
+        # The similarity is at most shared / len(grams), so keys sharing
+        # fewer trigrams than this can't be close enough
+        least = math.ceil(self.MIN_SIMILARITY * len(grams))
+        scored = []
+        for key_id, count in shared.items():
+            if count < least:
+                continue
+            similarity = count / (
+                len(grams) + self._gram_counts[key_id] - count)
+            if similarity >= self.MIN_SIMILARITY:
+                scored.append((-similarity, key_id))
+        scored.sort()
+        found = []
+        for _, key_id in scored[:limit]:
+            key = self._keys[key_id]
+            found.append((key, self._entries[key]))
+        return found
+
+
+# The index file: magic and entry count, then count + 1 offsets of the
+# records from the start of the file, then the records, sorted by key.
+# A record is the key's length, the UTF-8 key and the UTF-8 value; the
+# value runs to the next record.
+INDEX_MAGIC = b"SRCHIDX1"
+INDEX_HEADER = struct.Struct("<8sQ")
+INDEX_OFFSET = struct.Struct("<Q")
+INDEX_KEY_LENGTH = struct.Struct("<I")
+
+
+def write_index(path: str, entries: dict[str, str]) -> None:
+    """Write entries as an index file for MappedBackend."""
+    records = sorted(
+        (key.encode(), value.encode()) for key, value in entries.items())
+    offset = INDEX_HEADER.size + INDEX_OFFSET.size * (len(records) + 1)
+    offsets = array("Q")
+    for key, value in records:
+        offsets.append(offset)
+        offset += INDEX_KEY_LENGTH.size + len(key) + len(value)
+    offsets.append(offset)
+    if sys.byteorder == "big":
+        offsets.byteswap()
+    with open(path, "wb") as file:
+        file.write(INDEX_HEADER.pack(INDEX_MAGIC, len(records)))
+        offsets.tofile(file)
+        for key, value in records:
+            file.write(INDEX_KEY_LENGTH.pack(len(key)))
+            file.write(key)
+            file.write(value)
+
+
+class MappedBackend(SearchBackend):
+    """An index file written by write_index(), memory-mapped.
+
+    Opening it reads nothing but the header: lookups binary-search the
+    mapped file, and the OS pages in what they touch and can share it
+    between worker processes. It has no trigram index, so no fuzzy().
+    """
+
+    def __init__(self, path: str) -> None:
+        with open(path, "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count = INDEX_HEADER.unpack_from(self._map)
+        if magic != INDEX_MAGIC:
+            self._map.close()
+            raise ValueError(f"{path!r} is not a search index.")
+
+    def __len__(self) -> int:
+        return self._count
+
+    def close(self) -> None:
+        self._map.close()
+
+    def _offset(self, index: int) -> int:
+        return INDEX_OFFSET.unpack_from(
+            self._map, INDEX_HEADER.size + INDEX_OFFSET.size * index)[0]
+
+    def _key(self, index: int) -> bytes:
+        start = self._offset(index)
+        length = INDEX_KEY_LENGTH.unpack_from(self._map, start)[0]
+        start += INDEX_KEY_LENGTH.size
+        return self._map[start:start + length]
+
+    def _value(self, index: int, key: bytes) -> str:
+        start = self._offset(index) + INDEX_KEY_LENGTH.size + len(key)
+        return self._map[start:self._offset(index + 1)].decode()
+
+    def _search(self, key: bytes) -> int:
+        """Index of the first record whose key isn't less than key."""
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def get(self, key: str) -> str:
+        encoded = key.encode()
+        index = self._search(encoded)
+        if index < self._count and self._key(index) == encoded:
+            return self._value(index, encoded)
+        return None
+
+    def prefix(self, prefix: str, limit: int) -> list[tuple[str, str]]:
+        encoded = prefix.encode()
+        found = []
+        for index in range(self._search(encoded), self._count):
+            key = self._key(index)
+            if len(found) == limit or not key.startswith(encoded):
+                break
+            found.append((key.decode(), self._value(index, key)))
+        return found
+
+
+def load_backend(path: str, ngrams: bool = False) -> SearchBackend:
+    """A MappedBackend for an index file, else a MemoryBackend for JSON.
+
+    A JSON file holds one object mapping keys to values.
+    """
+    with open(path, "rb") as file:
+        magic = file.read(len(INDEX_MAGIC))
+    if magic == INDEX_MAGIC:
+        if ngrams:
+            raise ValueError("Fuzzy search needs a JSON file, loaded into "
+                             "memory, not an index file.")
+        return MappedBackend(path)
+    with open(path, encoding="utf-8") as file:
+        return MemoryBackend(json.load(file), ngrams)
@@ -0,0 +1,638 @@
+import hashlib
+import os
+import selectors
+import time
+from socket import socket as Socket
+
+from cache_lib import ResponseCache
+from handler_lib import MAX_DATAGRAM, FrameParser, MessageHandler
+from handler_lib import SocketHandler, SocketSelector, encode_header
+from handler_lib import json_decode, json_encode
+from log_lib import log
+from metrics_lib import metrics
+from offload_lib import Offloader
+from sched_lib import Scheduler
+from search_lib import MemoryBackend, SearchBackend
+from socket_lib import SocketOptions
+from timer_lib import TimerWheel
+
+
+request_search = {
+    "morpheus": "Follow the white rabbit. \U0001f430",
+    "ring": "In the caves beneath the Misty Mountains. \U0001f48d",
+    "\U0001f436": "\U0001f43e Playing ball! \U0001f3d0",
+}
+
+
+class ResponseBuilder:
+    """Answers the request in self.json_header and self.content.
+
+    Mixed into ServerHandler and the asyncio server protocol, which supply
+    create_message(), create_file_message() and send_frame() to send the
+    response.
+
+    With a response_cache, search responses are kept encoded, keyed by
+    the request, and a repeated search is answered with the cached frame.
+    A cached frame has no request-id, so requests with one reuse just its
+    content.
+    """
+
+    SLOTS = ("_body_digest", "_body_size", "_body_head")
+    __slots__ = ()
+    # Directory the "fetch" action serves files from; None disables it
+    files_root: str = None
+    # What the "search" action looks values up in
+    search_backend: SearchBackend = MemoryBackend(request_search)
+    # Most matches a prefix or fuzzy search returns
+    MAX_RESULTS = 100
+    # Most values one batch_search looks up
+    MAX_BATCH = 10000
+    # Encoded search responses; None disables caching
+    response_cache: ResponseCache = None
+    # Bytes of a binary request echoed in the response
+    ECHO_LENGTH = 10
+
+    def reset(self):
+        super().reset()
+        self._body_digest = None
+        self._body_size = 0
+        self._body_head = b""
+
+    def content_chunk(self, chunk):
+        # Streamed binary requests are hashed as they arrive; only the
+        # start is kept, for the response
+        if self._body_digest is None:
+            self._body_digest = hashlib.sha256()
+        self._body_digest.update(chunk)
+        self._body_size += len(chunk)
+        if len(self._body_head) < self.ECHO_LENGTH:
+            self._body_head += chunk[:self.ECHO_LENGTH - len(self._body_head)]
+
+    def content_done(self):
+        digest = self._body_digest or hashlib.sha256()
+        log.debug("Streamed %s bytes from %s, sha256 %s",
+                  self._body_size, self, digest.hexdigest())
+        return self._body_head
+
+    def create_response(self):
+        if (self.json_header["content-type"] == "text/json"
+                and not isinstance(self.content, dict)):
+            # Valid JSON, but a list, string or number from the peer
+            raise ValueError("Request content is not a JSON object.")
+        if (cache_key := self._cache_key()) is not None:
+            self._create_cached_response(cache_key)
+            return
+        if self.json_header["content-type"] == "text/json":
+            response = self._create_response_json_content()
+        else:
+            # Binary or unknown content-type
+            response = self._create_response_binary_content()
+        # Echo the request-id so the client can match the response
+        request_id = self.json_header.get("request-id")
+        if "content_file" in response:
+            self.create_file_message(**response, request_id=request_id)
+        else:
+            self.create_message(**response, request_id=request_id)
+
+    def _cache_key(self):
+        """The response cache key for this request, or None."""
+        if (self.response_cache is None
+                or self.json_header["content-type"] != "text/json"
+                or self.content.get("action") != "search"):
+            return None
+        key = (self.header_format, "search", self.content.get("value"),
+               self.content.get("mode"), self.content.get("limit"))
+        try:
+            hash(key)
+        except TypeError:
+            # A list or object where a string or number belongs
+            return None
+        return key
+
+    def _create_cached_response(self, cache_key):
+        cached = self.response_cache.get(cache_key)
+        if cached is None:
+            generation = self.response_cache.start(cache_key)
+            try:
+                response = self._create_response_json_content()
+            except BaseException:
+                self.response_cache.abandon(cache_key, generation)
+                raise
+            cached = self._encode_cached(response)
+            self.response_cache.put(cache_key, cached, generation)
+        self._send_cached(cached, self.json_header.get("request-id"))
+
+    def _encode_cached(self, response: dict) -> tuple:
+        """The frame for a response, its header length, type and encoding."""
+        header = encode_header(
+            len(response["content_bytes"]), response["content_type"],
+            response["content_encoding"], self.header_format)
+        return (header + response["content_bytes"], len(header),
+                response["content_type"], response["content_encoding"])
+
+    def _send_cached(self, cached: tuple, request_id=None):
+        frame, header_length, content_type, content_encoding = cached
+        if request_id is None:
+            self.send_frame(frame)
+        else:
+            self.create_message(memoryview(frame)[header_length:],
+                                content_type, content_encoding, request_id)
+
+    def _create_response_json_content(self):
+        action = self.content.get("action")
+        if action == "fetch" and (response := self._open_file()):
+            return response
+        if action == "search":
+            content = {"result": self._search()}
+        elif action == "batch_search":
+            content = {"result": self._batch_search()}
+        elif action == "stats":
+            content = {"result": metrics.snapshot()}
+            if self.response_cache is not None:
+                content["result"]["response_cache"] = (
+                    self.response_cache.stats())
+        elif action == "fetch":
+            query = self.content.get("value")
+            content = {"result": f"Error: no file '{query}'."}
+        else:
+            content = {"result": f"Error: invalid action '{action}'."}
+        content_encoding = "utf-8"
+        response = {
+            "content_bytes": json_encode(content, content_encoding),
+            "content_type": "text/json",
+            "content_encoding": content_encoding,
+        }
+        return response
+
+    def _search(self):
+        query = self.content.get("value")
+        mode = self.content.get("mode", "exact")
+        if not isinstance(query, str):
+            return f"Error: invalid value {query!r}."
+        if mode == "exact":
+            return (self.search_backend.get(query)
+                    or f"No match for '{query}'.")
+        limit = self.content.get("limit", self.MAX_RESULTS)
+        if not isinstance(limit, int) or limit < 1:
+            return f"Error: invalid limit {limit!r}."
+        limit = min(limit, self.MAX_RESULTS)
+        if mode == "prefix":
+            matches = self.search_backend.prefix(query, limit)
+        elif mode == "fuzzy":
+            matches = self.search_backend.fuzzy(query, limit)
+            if matches is None:
+                return "Error: fuzzy search is not enabled."
+        else:
+            return f"Error: invalid search mode '{mode}'."
+        # Pairs, in order: best or first match first
+        return [[key, value] for key, value in matches]
+
+    def _batch_search(self):
+        """Exact matches for a list of values, None for each miss."""
+        values = self.content.get("value")
+        # Checked without a Python-level loop over the values
+        if (not isinstance(values, list)
+                or not set(map(type, values)) <= {str}):
+            return "Error: batch_search needs a list of strings."
+        if len(values) > self.MAX_BATCH:
+            return f"Error: more than {self.MAX_BATCH} values."
+        return self.search_backend.get_many(values)
+
+    def _open_file(self):
+        """A file response for the fetch action, or None if not allowed."""
+        if self.files_root is None:
+            return None
+        root = os.path.realpath(self.files_root)
+        path = os.path.realpath(
+            os.path.join(root, str(self.content.get("value"))))
+        if not path.startswith(root + os.sep):
+            return None
+        try:
+            content_file = open(path, "rb")
+        except OSError:
+            return None
+        return {
+            "content_file": content_file,
+            "content_type": "binary/custom-server-binary-type",
+            "content_encoding": "binary",
+        }
+
+    def _create_response_binary_content(self):
+        response = {
+            "content_bytes": b"First 10 bytes of request: "
+            + self.content[:self.ECHO_LENGTH],
+            "content_type": "binary/custom-server-binary-type",
+            "content_encoding": "binary",
+        }
+        return response
+
+
+# Actions answered on the selector loop even when their body was decoded
+# by a worker: "fetch" opens a file for the loop to send, and "stats"
+# reports the loop's own metrics
+LOOP_ACTIONS = ("fetch", "stats")
+
+
+class OffloadedRequest(ResponseBuilder):
+    """A request answered by build_response(), away from the loop."""
+
+    __slots__ = ResponseBuilder.SLOTS + (
+        "json_header", "content", "header_format")
+
+    def __init__(self, json_header: dict, content,
+                 header_format: str) -> None:
+        self.json_header = json_header
+        self.content = content
+        self.header_format = header_format
+
+
+def build_response(json_header: dict, content, decoded: bool,
+                   header_format: str) -> tuple:
+    """Decode a JSON request if need be, and build its response.
+
+    Runs on an Offloader's executor, so it touches no connection state.
+    Returns the content if it decoded it here, and the response dict,
+    or None for LOOP_ACTIONS.
+    """
+    decoded_here = None
+    if not decoded:
+        content = decoded_here = json_decode(
+            content, json_header["content-encoding"])
+    if not isinstance(content, dict):
+        raise ValueError("Request content is not a JSON object.")
+    if content.get("action") in LOOP_ACTIONS:
+        return decoded_here, None
+    request = OffloadedRequest(json_header, content, header_format)
+    return decoded_here, request._create_response_json_content()
+
+
+class ServerHandler(ResponseBuilder, MessageHandler, SocketSelector):
+    __slots__ = SocketSelector.SLOTS + ResponseBuilder.SLOTS + (
+        "_response_created", "_undecoded", "timers", "deadline",
+        "timeout_reason", "_frame_started", "_read_size", "_deferred",
+        "_half_closed", "_offloads_pending")
+    # With a TimerWheel, the connection is closed once it has gone this
+    # many seconds without reading or writing anything, or once a frame's
+    # header or the whole frame is still incomplete this many seconds
+    # after its first byte. 0 disables a timeout.
+    idle_timeout: float = 0
+    header_timeout: float = 0
+    request_timeout: float = 0
+    # With an Offloader, expensive requests are answered by its workers,
+    # so they don't hold up the other connections: JSON bodies over
+    # offload_bytes, which are decoded there too, OFFLOAD_ACTIONS and
+    # searches in OFFLOAD_SEARCH_MODES, unless the response is cached.
+    # A connection stops reading while waiting for a response without a
+    # request-id, so its responses still go out in request order.
+    offloader: Offloader = None
+    offload_bytes: int = 65536
+    OFFLOAD_ACTIONS = ("batch_search",)
+    OFFLOAD_SEARCH_MODES = ("fuzzy",)
+    # How the server listens for, accepts and sets up connections
+    socket_options: SocketOptions = SocketOptions()
+    # With a Scheduler, each loop iteration in which connections compete
+    # reads and handles a bounded amount from every connection, and the
+    # loop gives deferred ones their turns; otherwise, a read takes
+    # whatever the buffer has room for, and every frame received is
+    # handled at once.
+    scheduler: Scheduler = None
+
+    def __init__(self, selector, socket, label, keep_alive=False,
+                 timers: TimerWheel = None) -> None:
+        MessageHandler.__init__(self, socket, label, keep_alive)
+        SocketSelector.__init__(self, selector)
+        self._response_created: bool = False
+        # Whether self.content is JSON left for a worker to decode
+        self._undecoded: bool = False
+        self.timers = timers
+        self.deadline: float = None
+        # "idle", "header" or "request": the timeout the deadline is for
+        self.timeout_reason: str = None
+        self._frame_started: float = None
+        # Bytes the next read asks for, with a scheduler
+        self._read_size: int = (
+            self.scheduler.min_read if self.scheduler is not None else 0)
+        # Whether it waits in the scheduler for its next turn
+        self._deferred: bool = False
+        # Whether the peer has sent all it will: the connection closes
+        # once everything it asked for has been sent
+        self._half_closed: bool = False
+        # Offloaded requests whose responses aren't queued yet
+        self._offloads_pending: int = 0
+
+    def register(self):
+        super().register()
+        self._update_deadline()
+        if metrics.enabled:
+            metrics.active_connections += 1
+
+    def close(self):
+        if self.timers is not None:
+            self.timers.cancel(self)
+        if metrics.enabled:
+            metrics.active_connections -= 1
+        super().close()
+
+    def read(self):
+        if self.scheduler is None or not (
+                self.scheduler.contended or self._deferred):
+            super().read()
+        elif not self._deferred:
+            received = SocketHandler.read(self, self._read_size)
+            self._read_size = self.scheduler.read_size(
+                self._read_size, received)
+            self._take_turn()
+        # A deferred connection has frames to handle first; what it was
+        # sent waits in the socket until its turn
+        if self.socket and self.socket_options.quickack:
+            self.socket_options.received(self.socket)
+        self._flush()
+
+    def peer_closed(self):
+        # Frames held back while an offloaded request is answered are
+        # parsed later; it's read again, and this checks again, then
+        if not self.parsing_held and (
+                self._json_header_len is not None or len(self.received)):
+            # In the middle of a frame
+            super().peer_closed()
+        # Between frames, a peer is just done: not an error. It may
+        # have shut down only its side, and still wait for responses
+        self._half_closed = True
+        self.hold_reading(True)
+        self._close_if_answered()
+
+    def _close_if_answered(self):
+        if (self._half_closed and self.socket and self.finished_writing
+                and not self.parsing_held and not self._offloads_pending):
+            log.info("%s closed the connection", self)
+            self.close()
+
+    def resume(self):
+        """Take the turn the scheduler deferred to this iteration."""
+        self._deferred = False
+        if self.socket:
+            self._take_turn()
+            self._flush()
+
+    def _take_turn(self):
+        if self.process_received(self.scheduler.frame_budget):
+            self._deferred = True
+            self.scheduler.defer(self)
+
+    def _flush(self):
+        if not self.socket:
+            return
+        # Send the responses straight away. The socket usually takes them
+        # all, and then EVENT_WRITE is never selected for them
+        if not self.finished_writing:
+            # Which updates the deadline too
+            self.write()
+        else:
+            self._update_deadline()
+
+    def decode_content(self):
+        self._undecoded = (
+            self.offloader is not None
+            and self.json_header["content-type"] == "text/json"
+            and len(self.content) > self.offload_bytes)
+        if not self._undecoded:
+            super().decode_content()
+
+    def message_received(self):
+        self._frame_started = None
+        if self.offloader is not None and self._offloadable():
+            self._offload()
+            return
+        # Respond now, before reset() discards the request
+        self.create_response()
+        self._response_created = True
+        if not self.keep_alive:
+            # One request per connection: stop reading
+            self.set_selector_events_mask("w")
+
+    def _offloadable(self) -> bool:
+        if self._undecoded:
+            return True
+        if (self.json_header["content-type"] != "text/json"
+                or not isinstance(self.content, dict)):
+            return False
+        action = self.content.get("action")
+        if action not in self.OFFLOAD_ACTIONS and not (
+                action == "search"
+                and self.content.get("mode") in self.OFFLOAD_SEARCH_MODES):
+            return False
+        cache_key = self._cache_key()
+        return cache_key is None or cache_key not in self.response_cache
+
+    def _offload(self):
+        json_header, content = self.json_header, self.content
+        request_id = json_header.get("request-id")
+        if metrics.enabled:
+            metrics.offloaded += 1
+        self._offloads_pending += 1
+        if self._undecoded or request_id is None or not self.keep_alive:
+            # Leave later frames unread until this one is answered
+            self.parsing_held = True
+            self.hold_reading(True)
+        cache_key = None if self._undecoded else self._cache_key()
+        generation = None
+        if cache_key is not None:
+            # _offloadable() found it wasn't cached
+            self.response_cache.misses += 1
+            # Identical requests already offloaded share that response
+            if self.response_cache.join(cache_key, lambda cached: (
+                    self._cached_response_ready(cached, request_id))):
+                return
+            generation = self.response_cache.start(cache_key)
+        if self._undecoded and self.offloader.pickles:
+            content = bytes(content)
+        self.offloader.submit(
+            lambda future: self._offload_done(
+                future, json_header, cache_key, generation, request_id),
+            build_response, json_header, content, not self._undecoded,
+            self.header_format)
+
+    def _offload_done(self, future, json_header, cache_key, generation,
+                      request_id):
+        try:
+            decoded, response = future.result()
+        except Exception as error:
+            if cache_key is not None:
+                self.response_cache.abandon(cache_key, generation)
+            if self.socket:
+                log.error("Error on %s: %s", self, error)
+                if metrics.enabled:
+                    metrics.parse_errors += 1
+                self.close()
+            return
+        if cache_key is not None:
+            cached = self._encode_cached(response)
+            # Answers the connections that joined this one first; not
+            # kept if the search backend was reloaded meanwhile
+            self.response_cache.put(cache_key, cached, generation)
+            self._cached_response_ready(cached, request_id)
+            return
+        if not self.socket:
+            return
+        if response is None:
+            # LOOP_ACTIONS, answered here once the worker decoded them;
+            # parsing is held, so nothing else is using the frame state
+            self.json_header, self.content = json_header, decoded
+            self.create_response()
+            self.reset()
+        else:
+            self.create_message(**response, request_id=request_id)
+        self._offloaded_response_sent()
+
+    def _cached_response_ready(self, cached, request_id):
+        if not self.socket:
+            return
+        if cached is None:
+            log.error("Error on %s: the identical request it waited "
+                      "for failed", self)
+            self.close()
+            return
+        self._send_cached(cached, request_id)
+        self._offloaded_response_sent()
+
+    def _offloaded_response_sent(self):
+        self._response_created = True
+        self._offloads_pending -= 1
+        # A connection without keep-alive reads no more, so its hold stays
+        if self.parsing_held and self.keep_alive:
+            self.parsing_held = False
+            self.hold_reading(False)
+            # Frames that arrived in the meantime
+            if self.scheduler is None:
+                self.process_received()
+            elif not self._deferred:
+                self._take_turn()
+        self._flush()
+
+    def write(self):
+        super().write()
+        if (self.finished_writing and self._response_created
+                and not self.keep_alive and self.socket):
+            self.close()
+        elif self.socket:
+            self._update_deadline()
+            self._close_if_answered()
+
+    def _update_deadline(self):
+        if self.timers is None:
+            return
+        now = time.monotonic()
+        if self._frame_started is None:
+            if self._json_header_len is None and not len(self.received):
+                # Between frames, only the idle timeout applies
+                if self.idle_timeout:
+                    self.timeout_reason = "idle"
+                    self.timers.schedule(self, now + self.idle_timeout)
+                else:
+                    self.timers.cancel(self)
+                return
+            self._frame_started = now
+        deadlines = []
+        if self.idle_timeout:
+            deadlines.append((now + self.idle_timeout, "idle"))
+        if self._frame_started is not None:
+            if self.header_timeout and self.json_header is None:
+                deadlines.append(
+                    (self._frame_started + self.header_timeout, "header"))
+            if self.request_timeout:
+                deadlines.append(
+                    (self._frame_started + self.request_timeout, "request"))
+        if deadlines:
+            deadline, self.timeout_reason = min(deadlines)
+            self.timers.schedule(self, deadline)
+        else:
+            self.timers.cancel(self)
+
+
+class DatagramHandler(ResponseBuilder, FrameParser):
+    """Answers requests that come one per datagram on a UDP socket.
+
+    Registered with the selector like a connection, but it keeps nothing
+    between datagrams: each holds one whole frame, and the response goes
+    back to its sender in one datagram. A response too big for one is
+    replaced by an error, as is a "fetch". Responses that find the send
+    buffer full are dropped, for the client to retry.
+    """
+
+    __slots__ = ResponseBuilder.SLOTS + ("socket", "selector", "peer")
+    # Most datagrams answered per wakeup, so the TCP connections get
+    # their turn during a flood
+    read_batch: int = 64
+    # Datagrams can come from any host, claiming any address
+    shared_memory = False
+
+    def __init__(self, selector, socket: Socket) -> None:
+        host, port = socket.getsockname()[:2]
+        FrameParser.__init__(self, f"udp:{host}:{port}")
+        self.socket = socket
+        self.selector = selector
+        # The sender of the datagram being answered. Logged as its parts:
+        # log arguments are formatted later, and this changes.
+        self.peer: tuple = None
+
+    def register(self):
+        self.selector.register(self.socket, selectors.EVENT_READ, self)
+
+    def read(self):
+        for _ in range(self.read_batch):
+            try:
+                datagram, self.peer = self.socket.recvfrom(MAX_DATAGRAM)
+            except BlockingIOError:
+                break
+            if metrics.enabled:
+                metrics.datagrams += 1
+                metrics.bytes_in += len(datagram)
+            try:
+                self.parse_datagram(datagram)
+                self.create_response()
+            except Exception as error:
+                # Whatever a datagram does, it's the only thing lost: there
+                # is no connection to close, and other peers still count
+                if metrics.enabled:
+                    metrics.parse_errors += 1
+                log.warning("Dropped datagram from %s:%s: %s",
+                            self.peer[0], self.peer[1], error)
+        self.peer = None
+        self.reset()
+
+    def create_message(self, content_bytes, content_type, content_encoding,
+                       request_id=None):
+        self.send_frame(encode_header(
+            len(content_bytes), content_type, content_encoding,
+            self.header_format, request_id) + content_bytes)
+
+    def create_file_message(self, content_file, content_type,
+                            content_encoding, request_id=None):
+        content_file.close()
+        self._send_error("files are not sent in datagrams")
+
+    def send_frame(self, frame: bytes):
+        if len(frame) > MAX_DATAGRAM:
+            self._send_error("the response doesn't fit in a datagram")
+            return
+        try:
+            self.socket.sendto(frame, self.peer)
+        except OSError as error:
+            if metrics.enabled:
+                metrics.datagrams_dropped += 1
+            log.debug("Dropped response to %s:%s: %s",
+                      self.peer[0], self.peer[1], error)
+            return
+        if metrics.enabled:
+            metrics.bytes_out += len(frame)
+
+    def _send_error(self, error: str):
+        content = json_encode({"result": f"Error: {error}; use TCP."},
+                              "utf-8")
+        self.send_frame(encode_header(
+            len(content), "text/json", "utf-8", self.header_format,
+            self.json_header.get("request-id")) + content)
+
+    def close(self):
+        self.selector.unregister(self.socket)
+        self.socket.close()
@@ -0,0 +1,138 @@
+import os
+import re
+import secrets
+import stat
+import struct
+import tempfile
+
+# Segments are files in here: tmpfs on Linux, so they live in memory
+SHM_DIRECTORY = (
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir())
+# Names carry the pid of the process that created the segment, so those
+# left behind by a killed process can be told apart and removed
+SEGMENT_PREFIX = "header-shm-"
+SEGMENT_NAME = re.compile(rf"{SEGMENT_PREFIX}(\d+)-[0-9a-f]{{16}}\Z")
+# The content of a shared memory frame: the length of the body, then the
+# name of the segment holding it
+DESCRIPTOR = struct.Struct(">Q")
+
+
+def create_segment(content) -> tuple[str, bytes]:
+    """Copy content into a new segment: its name and descriptor.
+
+    content is bytes-like, or an open binary file whose rest is copied
+    within the kernel. Only processes of the same user can map the
+    segment.
+    """
+    name = f"{SEGMENT_PREFIX}{os.getpid()}-{secrets.token_hex(8)}"
+    path = os.path.join(SHM_DIRECTORY, name)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW,
+                 0o600)
+    try:
+        if hasattr(content, "fileno"):
+            size = _copy_file(content, fd)
+        else:
+            # Written rather than copied into a mapping, which faults in
+            # every fresh page one at a time
+            content = memoryview(content).cast("B")
+            size = len(content)
+            while content:
+                content = content[os.write(fd, content):]
+    except BaseException:
+        os.unlink(path)
+        raise
+    finally:
+        os.close(fd)
+    return name, DESCRIPTOR.pack(size) + name.encode("ascii")
+
+
+def _copy_file(file, fd: int) -> int:
+    offset = file.tell()
+    size = os.fstat(file.fileno()).st_size - offset
+    copied = 0
+    while copied < size:
+        sent = os.sendfile(fd, file.fileno(), offset + copied, size - copied)
+        if not sent:
+            raise ValueError(f"{file.name} was truncated while copied.")
+        copied += sent
+    return size
+
+
+def read_segment(descriptor, max_size: int = None) -> memoryview:
+    """The body a descriptor names, copied out of its segment.
+
+    Only segments of this process's user that nobody else can write are
+    read. They are copied, not mapped: the peer can still truncate the
+    file, which faults a mapping, but only cuts a read short. The
+    segment's name is removed once it has been checked.
+    """
+    if len(descriptor) <= DESCRIPTOR.size:
+        raise ValueError("Shared memory descriptor too short.")
+    size = DESCRIPTOR.unpack_from(descriptor)[0]
+    name = bytes(descriptor[DESCRIPTOR.size:]).decode("ascii")
+    # Anything else could name a file that isn't a segment
+    if not SEGMENT_NAME.match(name):
+        raise ValueError(f"Invalid shared memory segment name {name!r}.")
+    if max_size is not None and size > max_size:
+        raise ValueError(
+            f"A {size} byte segment is over the {max_size} byte limit.")
+    path = os.path.join(SHM_DIRECTORY, name)
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+    except OSError as error:
+        raise ValueError(
+            f"Can't open shared memory segment {name}: "
+            f"{error.strerror}.") from None
+    try:
+        status = os.fstat(fd)
+        # Any local user can pass a name: only trust our own segments
+        if (not stat.S_ISREG(status.st_mode)
+                or status.st_uid != os.getuid()
+                or status.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+            raise ValueError(
+                f"Shared memory segment {name} isn't this user's alone.")
+        if status.st_size < size:
+            raise ValueError(
+                f"Shared memory segment {name} is not {size} bytes.")
+        remove_segment(name)
+        body = memoryview(bytearray(size))
+        read = 0
+        while read < size:
+            got = os.readv(fd, [body[read:]])
+            if not got:
+                raise ValueError(
+                    f"Shared memory segment {name} was truncated.")
+            read += got
+        return body
+    finally:
+        os.close(fd)
+
+
+def segment_exists(name: str) -> bool:
+    """Whether the segment's name is still there, unread by the peer."""
+    return os.path.exists(os.path.join(SHM_DIRECTORY, name))
+
+
+def remove_segment(name: str) -> None:
+    try:
+        os.unlink(os.path.join(SHM_DIRECTORY, name))
+    except FileNotFoundError:
+        pass
+
+
+def remove_orphans() -> int:
+    """Remove the segments of processes that have exited; how many."""
+    removed = 0
+    for name in os.listdir(SHM_DIRECTORY):
+        match = SEGMENT_NAME.match(name)
+        if not match:
+            continue
+        try:
+            os.kill(int(match[1]), 0)
+        except ProcessLookupError:
+            remove_segment(name)
+            removed += 1
+        except PermissionError:
+            # Alive, and another user's
+            pass
+    return removed
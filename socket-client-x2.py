@@ -1,14 +1,11 @@
-import logging as log
 import sys
 from socket import AF_INET, SOCK_STREAM
 from socket import socket as Socket
 
+from log_lib import Truncated, log, setup_logging
 
-log.basicConfig(
-   format="%(asctime)s: %(message)s", 
-   datefmt="%d/%b/%Y %H:%M:%S",
-   level=log.INFO
-)
+
+setup_logging(fmt="%(asctime)s: %(message)s", datefmt="%d/%b/%Y %H:%M:%S")
 host, port = 'localhost', 8000
 byte_message = b'Hello, server'
 long_message = b'Client data: ' + b'0000000100100011010001010110011110001001101010111100110111101111'*16
@@ -16,19 +13,19 @@ long_message = b'Client data: ' + b'00000001001000110100010101100111100010011010
 with Socket(family=AF_INET, type=SOCK_STREAM) as socket1:
     log.info("Connecting to port")
     socket1.connect((host, port))
-    log.info(f"Connected to host {host} port {port}")
-    log.info(f"Sending: {byte_message}")
+    log.info("Connected to host %s port %s", host, port)
+    log.info("Sending: %s", Truncated(byte_message))
     socket1.sendall(byte_message)
     data = socket1.recv(1024)
-    log.info(f"Received: {data}")
+    log.info("Received: %s", Truncated(data))
 with Socket(family=AF_INET, type=SOCK_STREAM) as socket2:
     log.info("Connecting to port")
     socket2.connect((host, port))
-    log.info(f"Connected to host {host} port {port}")
-    log.info(f"Sending: {long_message}")
+    log.info("Connected to host %s port %s", host, port)
+    log.info("Sending: %s", Truncated(long_message))
     socket2.sendall(long_message)
     data = socket2.recv(1024)
-    log.info(f"Received: {data}")
+    log.info("Received: %s", Truncated(data))
     data = socket2.recv(1024)
-    log.info(f"Received: {data}")
+    log.info("Received: %s", Truncated(data))
     
@@ -1,25 +1,22 @@
-import logging as log
 import sys
 from socket import AF_INET, SOCK_STREAM
 from socket import socket as Socket
 
-log.basicConfig(
-   format="%(asctime)s: %(message)s", 
-   datefmt="%d/%b/%Y %H:%M:%S",
-   level=log.INFO
-)
+from log_lib import Truncated, log, setup_logging
+
+setup_logging(fmt="%(asctime)s: %(message)s", datefmt="%d/%b/%Y %H:%M:%S")
 host, port = 'localhost', 8000
 
 with Socket(family=AF_INET, type=SOCK_STREAM) as socket:
     socket.bind((host, port))
     socket.listen()
-    log.info(f"Listening on address {host} port {port}")
+    log.info("Listening on address %s port %s", host, port)
     for _ in (1,2):
         conn, addr = socket.accept()
-        log.info(f"Accepting connection from {addr[0]}:{addr[1]}")
+        log.info("Accepting connection from %s:%s", *addr)
         with conn:
             while (data := conn.recv(1024)):
-                log.info(f"Received: {data}")
+                log.info("Received: %s", Truncated(data))
                 response = bytes(f"That was {len(data)} bytes long.", 'utf-8')
-                log.info(f"Sending: {response}")
+                log.info("Sending: %s", Truncated(response))
                 conn.sendall(response)
@@ -0,0 +1,273 @@
+import errno
+import os
+import socket
+import stat
+import time
+from argparse import ArgumentParser, BooleanOptionalAction, Namespace
+from socket import AF_INET, AF_UNIX, IPPROTO_TCP, SOCK_DGRAM, SOCK_STREAM
+from socket import SOL_SOCKET
+from socket import socket as Socket
+from typing import NamedTuple
+
+from log_lib import log
+
+# Linux only; None elsewhere, and the options are skipped
+TCP_DEFER_ACCEPT = getattr(socket, "TCP_DEFER_ACCEPT", None)
+TCP_QUICKACK = getattr(socket, "TCP_QUICKACK", None)
+# accept() errors for want of descriptors or memory; the connection
+# stays in the backlog until there are some to spare
+ACCEPT_RESOURCE_ERRORS = (errno.EMFILE, errno.ENFILE, errno.ENOBUFS,
+                          errno.ENOMEM)
+
+
+class AcceptBackoff:
+    """Listening sockets set aside while accept() runs out of resources.
+
+    Such a listening socket stays readable, so instead of being polled in
+    a busy loop, it is unregistered from its selector for delay seconds,
+    like asyncio does. The loop calls resume() once timeout() has passed.
+    """
+
+    def __init__(self, selector, delay: float = 1.0) -> None:
+        self.selector = selector
+        self.delay = delay
+        # Resume time, events and data of each socket set aside
+        self._paused: dict = {}
+
+    def pause(self, listening_socket: Socket, error: OSError) -> None:
+        log.error("Not accepting on %s for %ss: %s",
+                  listening_socket.getsockname(), self.delay, error)
+        key = self.selector.unregister(listening_socket)
+        self._paused[listening_socket] = (
+            time.monotonic() + self.delay, key.events, key.data)
+
+    def timeout(self, now: float) -> float:
+        """Seconds until a socket is due back, or None if none is."""
+        if not self._paused:
+            return None
+        return max(min(due for due, _, _ in self._paused.values()) - now, 0)
+
+    def resume(self, now: float) -> None:
+        for listening_socket, (due, events, data) in list(
+                self._paused.items()):
+            if due <= now:
+                del self._paused[listening_socket]
+                self.selector.register(listening_socket, events, data)
+
+
+class SocketOptions(NamedTuple):
+    """How a server listens, accepts and sets up accepted sockets.
+
+    Every readiness event of the listening socket accepts up to
+    accept_batch connections, so a burst drains the backlog in a few
+    select() calls rather than one per connection, without starving the
+    established connections either. The buffer sizes are set on the
+    listening socket before listen(), so accepted sockets inherit them
+    and the handshake advertises a matching window scale.
+    """
+
+    # Connections the kernel queues for accept(); it caps this at
+    # net.core.somaxconn, and drops SYNs or handshakes beyond it
+    backlog: int = 1024
+    accept_batch: int = 64
+    # Send each frame at once, instead of holding it back while earlier
+    # segments are unacknowledged (Nagle's algorithm), which stalls
+    # pipelined frames for as long as the peer delays its ACKs
+    nodelay: bool = True
+    # SO_SNDBUF and SO_RCVBUF; None leaves them to kernel autotuning
+    send_buffer: int = None
+    receive_buffer: int = None
+    # Seconds the kernel may hold a connection that has sent nothing
+    # before waking the listener for it; 0 wakes it on the handshake
+    defer_accept: int = 0
+    # Acknowledge received data at once instead of delaying ACKs. The
+    # kernel falls back to delayed ACKs by itself, so it's set again
+    # after every read, a system call each.
+    quickack: bool = False
+    # Probe idle connections, so dead peers are eventually noticed
+    keepalive: bool = False
+
+    @classmethod
+    def from_args(cls, args: Namespace) -> "SocketOptions":
+        return cls(**{name: getattr(args, name) for name in cls._fields})
+
+    def listen(self, listening_socket: Socket) -> None:
+        self.set_buffers(listening_socket)
+        if (self.defer_accept and TCP_DEFER_ACCEPT is not None
+                and listening_socket.family != AF_UNIX):
+            listening_socket.setsockopt(
+                IPPROTO_TCP, TCP_DEFER_ACCEPT, self.defer_accept)
+        listening_socket.listen(self.backlog)
+
+    def set_buffers(self, sock: Socket) -> None:
+        if self.send_buffer:
+            sock.setsockopt(SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer)
+        if self.receive_buffer:
+            sock.setsockopt(
+                SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer)
+
+    def accept(self, listening_socket: Socket, backoff: AcceptBackoff):
+        """Yield up to accept_batch pending (connection, address) pairs.
+
+        The listening socket must be non-blocking: this stops as soon as
+        the backlog is empty, or when the process is out of descriptors
+        or memory, and then backoff sets the listening socket aside.
+        """
+        for _ in range(self.accept_batch):
+            try:
+                connection, address = listening_socket.accept()
+            except BlockingIOError:
+                return
+            except ConnectionAbortedError:
+                # Reset by the peer while it waited in the backlog
+                continue
+            except OSError as error:
+                if error.errno not in ACCEPT_RESOURCE_ERRORS:
+                    raise
+                backoff.pause(listening_socket, error)
+                return
+            self.configure(connection)
+            yield connection, address
+
+    def configure(self, connection: Socket) -> None:
+        # The rest are TCP options
+        if connection.family == AF_UNIX:
+            return
+        if self.nodelay:
+            connection.setsockopt(IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.keepalive:
+            connection.setsockopt(SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.received(connection)
+
+    def received(self, connection: Socket) -> None:
+        """Call after reading from connection."""
+        if (self.quickack and TCP_QUICKACK is not None
+                and connection.family != AF_UNIX):
+            connection.setsockopt(IPPROTO_TCP, TCP_QUICKACK, 1)
+
+
+def add_socket_arguments(parser: ArgumentParser) -> None:
+    """Add the options SocketOptions.from_args() reads."""
+    defaults = SocketOptions()
+    group = parser.add_argument_group("socket options")
+    group.add_argument('--backlog', type=int, default=defaults.backlog,
+                       help="listen() backlog, capped by "
+                            "net.core.somaxconn")
+    group.add_argument('--accept-batch', type=int,
+                       default=defaults.accept_batch,
+                       help="most connections accepted per wakeup")
+    group.add_argument('--nodelay', action=BooleanOptionalAction,
+                       default=defaults.nodelay,
+                       help="set TCP_NODELAY, disabling Nagle's algorithm")
+    group.add_argument('--send-buffer', type=int, metavar='BYTES',
+                       help="SO_SNDBUF; kernel autotuning by default")
+    group.add_argument('--receive-buffer', type=int, metavar='BYTES',
+                       help="SO_RCVBUF; kernel autotuning by default")
+    group.add_argument('--defer-accept', type=int, metavar='SECONDS',
+                       default=defaults.defer_accept,
+                       help="TCP_DEFER_ACCEPT: accept connections once "
+                            "they send data, or after this long")
+    group.add_argument('--quickack', action='store_true',
+                       help="set TCP_QUICKACK after every read")
+    group.add_argument('--keepalive', action='store_true',
+                       help="set SO_KEEPALIVE")
+
+
+class Endpoint(NamedTuple):
+    """Where a socket listens or connects.
+
+    A (host, port) address over TCP, or for clients on the same host, the
+    path of a Unix domain socket, which skips the TCP/IP stack. A (host,
+    port) address also takes UDP datagrams.
+    """
+
+    family: int
+    address: object
+
+    @classmethod
+    def tcp(cls, host: str, port: int) -> "Endpoint":
+        return cls(AF_INET, (host, port))
+
+    @classmethod
+    def udp(cls, host: str, port: int) -> "Endpoint":
+        # The same address as TCP's: bind_datagram() makes it UDP
+        return cls(AF_INET, (host, port))
+
+    @classmethod
+    def unix(cls, path: str) -> "Endpoint":
+        return cls(AF_UNIX, path)
+
+    def __str__(self):
+        if self.family == AF_UNIX:
+            return f"unix:{self.address}"
+        return f"{self.address[0]}:{self.address[1]}"
+
+    def connect(self, blocking: bool = True) -> Socket:
+        """A socket connected to the endpoint, or for TCP, connecting."""
+        connection = Socket(self.family, SOCK_STREAM)
+        if blocking or self.family == AF_UNIX:
+            # Unix sockets connect at once, or fail with EAGAIN while the
+            # backlog is full instead of going on in the background
+            connection.connect(self.address)
+            connection.setblocking(blocking)
+        else:
+            connection.setblocking(False)
+            connection.connect_ex(self.address)
+        return connection
+
+    def listen(self, options: SocketOptions,
+               reuse_port: bool = False) -> Socket:
+        """A non-blocking socket listening on the endpoint."""
+        listening_socket = Socket(self.family, SOCK_STREAM)
+        if self.family == AF_UNIX:
+            remove_stale_socket(self.address)
+        else:
+            # Avoid bind() exception: OSError: [Errno 48] Address already
+            # in use
+            listening_socket.setsockopt(SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # Every worker binds its own socket to the same port,
+            # and the kernel spreads incoming connections between them
+            listening_socket.setsockopt(SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        listening_socket.bind(self.address)
+        options.listen(listening_socket)
+        listening_socket.setblocking(False)
+        return listening_socket
+
+    def bind_datagram(self, options: SocketOptions,
+                      reuse_port: bool = False) -> Socket:
+        """A non-blocking UDP socket bound to the endpoint."""
+        datagram_socket = Socket(self.family, SOCK_DGRAM)
+        if reuse_port:
+            datagram_socket.setsockopt(SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        # A bigger receive buffer drops fewer datagrams of a burst
+        options.set_buffers(datagram_socket)
+        datagram_socket.bind(self.address)
+        datagram_socket.setblocking(False)
+        return datagram_socket
+
+
+def remove_stale_socket(path: str) -> None:
+    """Remove the socket file at path, unless a server still listens."""
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return
+    except FileNotFoundError:
+        return
+    probe = Socket(AF_UNIX, SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        os.unlink(path)
+        return
+    finally:
+        probe.close()
+    raise OSError(errno.EADDRINUSE, f"A server is listening on {path}.")
+
+
+def peer_label(connection: Socket, address) -> str:
+    """How logs name an accepted connection."""
+    if connection.family == AF_UNIX:
+        # Clients of a Unix socket are unnamed: tell them apart by fd
+        return f"unix:{connection.getsockname()}#{connection.fileno()}"
+    return f"{address[0]}:{address[1]}"
@@ -0,0 +1,43 @@
+import time
+
+from cache_lib import ResponseCache
+
+
+def test_value_computed_before_invalidate_is_not_kept():
+    cache = ResponseCache(2**20)
+    old = cache.start("key")
+    joined_before = []
+    cache.join("key", joined_before.append)
+    # The search backend is reloaded while the value is computed
+    cache.invalidate()
+    assert not cache.join("key", print)
+    new = cache.start("key")
+    joined_after = []
+    cache.join("key", joined_after.append)
+    cache.put("key", (b"old",), old)
+    assert joined_before == [(b"old",)]
+    assert joined_after == []
+    assert "key" not in cache
+    cache.put("key", (b"new",), new)
+    assert joined_after == [(b"new",)]
+    assert cache.get("key") == (b"new",)
+
+
+def test_abandon_only_answers_its_generation():
+    cache = ResponseCache(2**20)
+    old = cache.start("key")
+    cache.invalidate()
+    cache.start("key")
+    joined_after = []
+    cache.join("key", joined_after.append)
+    cache.abandon("key", old)
+    assert joined_after == []
+
+
+def test_expired_entry_is_not_contained():
+    cache = ResponseCache(2**20, ttl=0.01)
+    cache.put("key", (b"value",), cache.start("key"))
+    assert "key" in cache
+    time.sleep(0.02)
+    assert "key" not in cache
+    assert cache.hits == cache.misses == 0
@@ -0,0 +1,108 @@
+import selectors
+import socket
+
+import pytest
+
+from handler_lib import FrameParser, create_request, encode_message
+from handler_lib import encode_request
+from server_lib import ServerHandler
+
+
+class Replies(FrameParser):
+    __slots__ = ("count",)
+
+    def __init__(self) -> None:
+        FrameParser.__init__(self, keep_alive=True)
+        self.count = 0
+
+    def message_received(self):
+        self.count += 1
+
+
+def request(action: str, value: str) -> bytes:
+    return encode_message(**encode_request(create_request(action, value)))
+
+
+def connect():
+    """A selector and a client socket, served by a ServerHandler."""
+    selector = selectors.DefaultSelector()
+    client, server = socket.socketpair()
+    handler = ServerHandler(selector, server, "test", keep_alive=True)
+    handler.register()
+    return selector, client, handler
+
+
+def exchange(selector, client: socket.socket, handler: ServerHandler,
+             outgoing: bytes, replies: FrameParser) -> int:
+    """Send outgoing, shut down the client's side, then read replies.
+
+    Dispatches events like header-server.py until the server closes;
+    how many bytes the client was sent.
+    """
+    client.setblocking(False)
+    outgoing = memoryview(outgoing)
+    received = 0
+    while True:
+        if outgoing:
+            try:
+                outgoing = outgoing[client.send(outgoing):]
+            except BlockingIOError:
+                pass
+            if not outgoing:
+                client.shutdown(socket.SHUT_WR)
+        for key, events in selector.select(timeout=1):
+            if events & selectors.EVENT_READ:
+                key.data.read()
+            if events & selectors.EVENT_WRITE and key.data.socket:
+                key.data.write()
+        if outgoing:
+            # Nothing read yet, so the responses back up in the server
+            continue
+        try:
+            data = client.recv(1 << 20)
+        except BlockingIOError:
+            continue
+        if not data:
+            assert handler.socket is None
+            return received
+        received += len(data)
+        replies.feed(data)
+
+
+def test_half_close_sends_queued_responses():
+    selector, client, handler = connect()
+    replies = Replies()
+    # More responses than the socket buffers hold, so some stay queued
+    outgoing = request("search", "morpheus") * 20000
+    exchange(selector, client, handler, outgoing, replies)
+    assert replies.count == 20000
+    assert handler.finished_writing
+
+
+def test_half_close_sends_queued_file(tmp_path, monkeypatch):
+    # Queued files don't hold back reading, so the EOF is read while the
+    # file is still being sent
+    size = 20 * 2**20
+    (tmp_path / "big.bin").write_bytes(b"f" * size)
+    monkeypatch.setattr(ServerHandler, "files_root", str(tmp_path))
+    selector, client, handler = connect()
+    replies = Replies()
+    received = exchange(selector, client, handler,
+                        request("fetch", "big.bin"), replies)
+    assert replies.count == 1
+    assert received > size
+
+
+@pytest.mark.parametrize("body", [
+    b"[1, 2]",
+    b'"search"',
+    # Deeper than the interpreter's recursion limit
+    b"[" * 10000 + b"]" * 10000,
+], ids=["list", "string", "nested"])
+def test_json_body_not_an_object_is_refused(body):
+    selector, client, handler = connect()
+    client.sendall(encode_message(body, "text/json", "utf-8"))
+    client.shutdown(socket.SHUT_WR)
+    with pytest.raises(ValueError):
+        while handler.socket:
+            handler.read()
@@ -0,0 +1,53 @@
+import os
+
+import pytest
+
+from shm_lib import SHM_DIRECTORY, create_segment, read_segment
+from shm_lib import remove_segment, segment_exists
+
+
+def test_read_segment_copies_and_removes_it():
+    name, descriptor = create_segment(b"body" * 1000)
+    body = read_segment(descriptor)
+    assert body == b"body" * 1000
+    assert not segment_exists(name)
+
+
+def test_writable_by_others_is_refused():
+    name, descriptor = create_segment(b"body")
+    os.chmod(os.path.join(SHM_DIRECTORY, name), 0o666)
+    try:
+        with pytest.raises(ValueError):
+            read_segment(descriptor)
+    finally:
+        remove_segment(name)
+
+
+@pytest.mark.skipif(os.getuid() != 0, reason="chown needs root")
+def test_other_users_segment_is_refused():
+    name, descriptor = create_segment(b"body")
+    os.chown(os.path.join(SHM_DIRECTORY, name), 65534, -1)
+    try:
+        with pytest.raises(ValueError):
+            read_segment(descriptor)
+    finally:
+        remove_segment(name)
+
+
+def test_truncated_segment_is_refused():
+    name, descriptor = create_segment(b"body" * 1000)
+    os.truncate(os.path.join(SHM_DIRECTORY, name), 10)
+    try:
+        with pytest.raises(ValueError):
+            read_segment(descriptor)
+    finally:
+        remove_segment(name)
+
+
+def test_segment_over_max_size_is_refused():
+    name, descriptor = create_segment(b"body" * 1000)
+    try:
+        with pytest.raises(ValueError):
+            read_segment(descriptor, max_size=100)
+    finally:
+        remove_segment(name)
@@ -0,0 +1,79 @@
+import errno
+import os
+import resource
+import selectors
+import socket
+import subprocess
+import sys
+import time
+
+from handler_lib import create_request, encode_message, encode_request
+from socket_lib import AcceptBackoff, SocketOptions
+
+
+class ExhaustedSocket(socket.socket):
+    """A listening socket whose process is out of descriptors."""
+
+    def accept(self):
+        raise OSError(errno.EMFILE, os.strerror(errno.EMFILE))
+
+
+def test_accept_sets_listener_aside_when_out_of_descriptors():
+    selector = selectors.DefaultSelector()
+    listening_socket = ExhaustedSocket()
+    listening_socket.bind(("127.0.0.1", 0))
+    listening_socket.listen()
+    listening_socket.setblocking(False)
+    selector.register(listening_socket, selectors.EVENT_READ, "listener")
+    client = socket.create_connection(listening_socket.getsockname())
+    backoff = AcceptBackoff(selector, delay=0.5)
+    assert list(SocketOptions().accept(listening_socket, backoff)) == []
+    assert listening_socket not in selector.get_map()
+    now = time.monotonic()
+    assert 0 < backoff.timeout(now) <= 0.5
+    backoff.resume(now)
+    assert listening_socket not in selector.get_map()
+    backoff.resume(now + 0.5)
+    assert selector.get_key(listening_socket).data == "listener"
+    assert backoff.timeout(now) is None
+    client.close()
+    listening_socket.close()
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def test_server_survives_running_out_of_descriptors():
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, "header-server.py", "--port", str(port),
+         "--keep-alive", "--log-level", "WARNING"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stderr=subprocess.DEVNULL,
+        preexec_fn=lambda: resource.setrlimit(
+            resource.RLIMIT_NOFILE, (40, 40)))
+    try:
+        for _ in range(50):
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.1)
+        # More connections than the server has descriptors for
+        connections = [socket.create_connection(("127.0.0.1", port))
+                       for _ in range(60)]
+        time.sleep(0.5)
+        for connection in connections:
+            connection.close()
+        assert server.poll() is None
+        client = socket.create_connection(("127.0.0.1", port), timeout=5)
+        client.sendall(encode_message(**encode_request(
+            create_request("search", "morpheus"))))
+        assert b"white rabbit" in client.recv(1024)
+        client.close()
+    finally:
+        server.terminate()
+        server.wait()
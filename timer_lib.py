@@ -0,0 +1,76 @@
+import math
+import time
+
+
+class TimerWheel:
+    """Hashed timer wheel for connection deadlines.
+
+    A timer is any hashable object with a deadline attribute, in
+    time.monotonic() seconds. It is filed in the slot for the tick its
+    deadline falls in, slots wrapping around every slots * tick seconds;
+    a timer due on a later lap stays in its slot until then. Scheduling,
+    rescheduling and cancelling are O(1). A deadline pushed later, the
+    common case for idle timeouts, doesn't move the timer at all: when
+    its old slot comes up, it is refiled instead of expired.
+    """
+
+    def __init__(self, tick: float = 0.25, slots: int = 512,
+                 now: float = None) -> None:
+        self.tick = tick
+        self._slots: list[set] = [set() for _ in range(slots)]
+        # The tick each timer is filed under
+        self._filed: dict = {}
+        # The next tick expire() has to look at
+        if now is None:
+            now = time.monotonic()
+        self._current: int = math.floor(now / tick)
+
+    def __len__(self) -> int:
+        return len(self._filed)
+
+    def schedule(self, timer, deadline: float) -> None:
+        """Set timer.deadline, filing the timer if it isn't already."""
+        timer.deadline = deadline
+        tick = max(math.ceil(deadline / self.tick), self._current)
+        filed = self._filed.get(timer)
+        if filed is not None:
+            if filed <= tick:
+                # Refiled when its current slot comes up
+                return
+            self._slots[filed % len(self._slots)].discard(timer)
+        self._slots[tick % len(self._slots)].add(timer)
+        self._filed[timer] = tick
+
+    def cancel(self, timer) -> None:
+        filed = self._filed.pop(timer, None)
+        if filed is not None:
+            self._slots[filed % len(self._slots)].discard(timer)
+
+    def timeout(self, now: float) -> float:
+        """Seconds until expire() has work to do, or None if never."""
+        if not self._filed:
+            return None
+        return max(self._current * self.tick - now, 0)
+
+    def expire(self, now: float) -> list:
+        """Remove and return the timers whose deadline has passed."""
+        expired = []
+        if not self._filed:
+            return expired
+        now_tick = math.floor(now / self.tick)
+        # After a long stall every slot is looked at once, not every tick
+        ticks = min(now_tick - self._current + 1, len(self._slots))
+        for tick in range(self._current, self._current + ticks):
+            slot = self._slots[tick % len(self._slots)]
+            for timer in list(slot):
+                if self._filed[timer] > now_tick:
+                    # Due on a later lap
+                    continue
+                slot.discard(timer)
+                del self._filed[timer]
+                if timer.deadline <= now:
+                    expired.append(timer)
+                else:
+                    self.schedule(timer, timer.deadline)
+        self._current = max(self._current, now_tick + 1)
+        return expired